@@ -0,0 +1,50 @@
+"""
+Measure ControlBlock lookup latency as the number of shared files grows.
+
+Run from the root directory:
+    python benchmark/bench_control_block.py
+"""
+
+import os
+import sys
+import timeit
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from common.control_block import ControlBlock
+
+SHARE_COUNTS = [10, 100, 1000, 10000, 100000]
+LOOKUPS = 100000
+
+
+def bench_lookups(share_count: int) -> float:
+    """Return the mean latency in nanoseconds of one lookup of each kind."""
+    control_blk = ControlBlock()
+    control_blk.file_list = [
+        f"/nonexistent/share/dir_{i % 100}/file_{i}.bin" for i in range(share_count)
+    ]
+    # Look up the most recently added name plus a miss, the worst cases for a scan.
+    hit = f"file_{share_count - 1}.bin"
+    miss = "missing.bin"
+
+    def lookup():
+        control_blk.check_file_available(hit)
+        control_blk.get_file_path(hit)
+        control_blk.get_file_size(hit)
+        control_blk.check_file_available(miss)
+
+    seconds = min(timeit.repeat(lookup, number=LOOKUPS, repeat=3))
+    return seconds / (LOOKUPS * 4) * 1e9
+
+
+def main():
+    print(f"{'shared files':>12}  {'ns / lookup':>11}")
+    for share_count in SHARE_COUNTS:
+        print(f"{share_count:>12}  {bench_lookups(share_count):>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
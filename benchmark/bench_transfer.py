@@ -0,0 +1,427 @@
+"""
+Measure transfer throughput, search latency and server scaling on loopback.
+
+Launches N peers as separate processes, each running the threaded file server
+and discovery listener on its own ports, seeds them with files of the given
+sizes and measures:
+
+    download            single- and multi-peer download throughput, with
+                        client and server CPU seconds per GB transferred
+    search              unicast search latency against 1..N peers
+    server_concurrency  aggregate throughput and request latency of one peer
+                        serving C concurrent connections
+
+Results are written as JSON (to stdout, or --output). Passing --compare with
+an earlier result file exits with status 1 if any throughput dropped or any
+latency rose by more than --tolerance.
+
+Run from the root directory:
+    python benchmark/bench_transfer.py --peers 4 --sizes 1K,1M,64M
+    python benchmark/bench_transfer.py --output new.json --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from common.control_block import ControlBlock
+from common.debug_print import configure_log_levels
+from common.manifest import PIECE_SIZE, load_manifest
+from common.protocol import pack_range_request
+from file_share.async_tcp import read_range_response
+from file_share.connection_pool import ConnectionPool
+from file_share.send_recv_tcp import (
+    get_server_addr_from_peer_addr,
+    receive_file_from_peers,
+    start_file_server,
+)
+from peer_discovery.discovery import (
+    listen_for_broadcast_and_handle_requests,
+    query_peers_for_file,
+)
+
+BASE_PORT = 51001  # File request port of the first peer; servers listen 10000 above
+SEED_CHUNK_SIZE = 16 * 1024 * 1024  # Random bytes written at a time when seeding
+SEARCH_ROUNDS = 50  # Queries per peer count in the search benchmark
+CONCURRENCY_LEVELS = [1, 4, 16, 64]
+REQUESTS_PER_CLIENT = 20  # Piece requests per connection in the scaling benchmark
+CONCURRENCY_FILE_PIECES = 16  # Size in pieces of the file served in that benchmark
+STARTUP_TIMEOUT = 30  # Seconds to wait for peers to start listening
+QUIET_LOG_LEVEL = "warning"  # Keeps progress messages out of the JSON on stdout
+
+# Metrics compared by --compare; all but throughput are latencies (lower is better).
+HIGHER_IS_BETTER = {"mb_per_s"}
+COMPARED_METRICS = ["mb_per_s", "median_ms", "p95_ms", "p50_ms", "p99_ms"]
+
+
+def parse_size(text: str) -> int:
+    """Parse sizes such as 512, 1K, 64M or 2G (binary multiples)."""
+    text = text.strip().upper()
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def seed_file(path: str, size: int) -> None:
+    with open(path, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            chunk = os.urandom(min(SEED_CHUNK_SIZE, remaining))
+            file.write(chunk)
+            remaining -= len(chunk)
+
+
+def run_peer(file_request_port: int, paths: list, piece_size: int, cache_dir, conn):
+    """
+    Body of a peer process: share `paths` until told to stop.
+
+    Answers "cpu" on `conn` with the process's CPU time so far, and "stop" by
+    shutting down and acknowledging.
+    """
+    configure_log_levels(QUIET_LOG_LEVEL)
+    control_blk = ControlBlock()
+    for path in paths:
+        control_blk.add_file(path, load_manifest(path, piece_size, cache_dir))
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=start_file_server,
+            args=(control_blk, stop),
+            kwargs={"port": file_request_port + 10000},
+        ),
+        threading.Thread(
+            target=listen_for_broadcast_and_handle_requests,
+            args=(stop, control_blk, file_request_port),
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    conn.send("ready")
+
+    while True:
+        command = conn.recv()
+        if command == "cpu":
+            conn.send(time.process_time())
+        elif command == "stop":
+            break
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    conn.send("stopped")
+
+
+class PeerCluster:
+    """
+    N peer processes sharing the same files on consecutive loopback ports.
+
+    Attributes:
+        peers (list): (ip, file request port) of every peer, in start order.
+    """
+
+    def __init__(self, count: int, paths: list, piece_size: int, cache_dir: str):
+        context = multiprocessing.get_context("spawn")
+        self.peers = []
+        self._processes = []
+        self._conns = []
+        for i in range(count):
+            port = BASE_PORT + i
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=run_peer,
+                args=(port, paths, piece_size, cache_dir, child_conn),
+                daemon=True,
+            )
+            process.start()
+            self.peers.append(("127.0.0.1", port))
+            self._processes.append(process)
+            self._conns.append(parent_conn)
+
+        for conn in self._conns:
+            if not conn.poll(STARTUP_TIMEOUT) or conn.recv() != "ready":
+                raise RuntimeError("peer failed to start")
+        time.sleep(0.5)  # Let the servers reach accept()
+
+    def get_cpu_time(self, count: int = None) -> float:
+        """Total CPU seconds used so far by the first `count` peers."""
+        total = 0.0
+        for conn in self._conns[:count]:
+            conn.send("cpu")
+            total += conn.recv()
+        return total
+
+    def stop(self) -> None:
+        for conn in self._conns:
+            conn.send("stop")
+        for conn, process in zip(self._conns, self._processes):
+            conn.poll(STARTUP_TIMEOUT)
+            process.join(STARTUP_TIMEOUT)
+
+
+def bench_download(cluster, name: str, size: int, peer_count: int, piece_size):
+    peers = [(peer, size) for peer in cluster.peers[:peer_count]]
+    pool = ConnectionPool()
+    server_cpu = cluster.get_cpu_time(peer_count)
+    client_cpu = time.process_time()
+    start = time.perf_counter()
+    success = receive_file_from_peers(peers, name, piece_size, pool)
+    seconds = time.perf_counter() - start
+    client_cpu = time.process_time() - client_cpu
+    server_cpu = cluster.get_cpu_time(peer_count) - server_cpu
+    pool.close_all()
+    os.remove(f"downloaded_{name}")
+
+    gigabytes = size / 1024**3
+    return {
+        "benchmark": "download",
+        "peers": peer_count,
+        "size": size,
+        "success": success,
+        "seconds": round(seconds, 6),
+        "mb_per_s": round(size / 1024**2 / seconds, 2),
+        "client_cpu_s_per_gb": round(client_cpu / gigabytes, 3),
+        "server_cpu_s_per_gb": round(server_cpu / gigabytes, 3),
+    }
+
+
+def bench_search(cluster, name: str, peer_count: int, rounds: int, hit: bool):
+    peers = cluster.peers[:peer_count]
+    query = name if hit else "missing.bin"
+    latencies = []
+    answered = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        results = query_peers_for_file(peers, query, timeout=2)
+        latencies.append((time.perf_counter() - start) * 1000)
+        answered += len(results)
+    return {
+        "benchmark": "search",
+        "peers": peer_count,
+        "hit": hit,
+        "rounds": rounds,
+        "holders_found": answered / rounds,
+        "median_ms": round(statistics.median(latencies), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+    }
+
+
+async def _fetch_pieces(address, name, size, piece_size, requests, latencies):
+    reader, writer = await asyncio.open_connection(*address)
+    buffer = memoryview(bytearray(piece_size))
+    piece_count = (size + piece_size - 1) // piece_size
+    received = 0
+    try:
+        for request_id in range(requests):
+            index = random.randrange(piece_count)
+            start = index * piece_size
+            end = min(start + piece_size, size)
+            begin = time.perf_counter()
+            writer.write(pack_range_request(request_id, name, start, end))
+            await writer.drain()
+            if not await read_range_response(reader, buffer[: end - start], request_id):
+                raise RuntimeError(f"piece {index} failed verification")
+            latencies.append((time.perf_counter() - begin) * 1000)
+            received += end - start
+    finally:
+        writer.close()
+    return received
+
+
+def bench_server_concurrency(cluster, name, size, piece_size, clients, requests):
+    address = get_server_addr_from_peer_addr(*cluster.peers[0])
+    latencies = []
+
+    async def run_clients():
+        return await asyncio.gather(
+            *(
+                _fetch_pieces(address, name, size, piece_size, requests, latencies)
+                for _ in range(clients)
+            )
+        )
+
+    start = time.perf_counter()
+    received = sum(asyncio.run(run_clients()))
+    seconds = time.perf_counter() - start
+    return {
+        "benchmark": "server_concurrency",
+        "clients": clients,
+        "requests": clients * requests,
+        "mb_per_s": round(received / 1024**2 / seconds, 2),
+        "p50_ms": round(percentile(latencies, 0.5), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+    }
+
+
+def get_result_key(result: dict) -> tuple:
+    params = ("benchmark", "peers", "size", "hit", "clients")
+    return tuple(result.get(param) for param in params)
+
+
+def compare_results(baseline: dict, current: dict, tolerance: float) -> list:
+    """Return a description of every metric that regressed beyond `tolerance`."""
+    baseline_results = {get_result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = baseline_results.get(get_result_key(result))
+        if old is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in result or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric]
+            if metric not in HIGHER_IS_BETTER:
+                change = -change
+            if change < -tolerance:
+                regressions.append(
+                    f"{get_result_key(result)} {metric}: "
+                    f"{old[metric]} -> {result[metric]} ({change:+.0%})"
+                )
+    return regressions
+
+
+def get_peer_counts(peers: int) -> list:
+    counts = [1]
+    while counts[-1] * 2 < peers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != peers:
+        counts.append(peers)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--peers", type=int, default=4, help="peer processes")
+    parser.add_argument(
+        "--sizes", default="1K,1M,64M", help="comma-separated file sizes to seed"
+    )
+    parser.add_argument("--piece-size", default=str(PIECE_SIZE))
+    parser.add_argument(
+        "--concurrency",
+        default=",".join(str(c) for c in CONCURRENCY_LEVELS),
+        help="comma-separated connection counts for server_concurrency",
+    )
+    parser.add_argument("--search-rounds", type=int, default=SEARCH_ROUNDS)
+    parser.add_argument(
+        "--benchmarks",
+        default="download,search,server_concurrency",
+        help="comma-separated subset of benchmarks to run",
+    )
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="earlier JSON results to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    configure_log_levels(QUIET_LOG_LEVEL)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    piece_size = parse_size(args.piece_size)
+    benchmarks = set(args.benchmarks.split(","))
+    concurrency_size = piece_size * CONCURRENCY_FILE_PIECES
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = os.path.join(tmp_dir, "manifests")
+        files = {f"seed_{size}.bin": size for size in sizes}
+        files[f"concurrency_{concurrency_size}.bin"] = concurrency_size
+        paths = []
+        for name, size in files.items():
+            path = os.path.join(tmp_dir, name)
+            seed_file(path, size)
+            load_manifest(path, piece_size, cache_dir)  # Hash once, peers reuse it
+            paths.append(path)
+
+        # Downloads land in the working directory.
+        original_dir = os.getcwd()
+        os.chdir(tmp_dir)
+        cluster = PeerCluster(args.peers, paths, piece_size, cache_dir)
+        results = []
+        try:
+            if "download" in benchmarks:
+                for name, size in files.items():
+                    if not name.startswith("seed_"):
+                        continue
+                    for peer_count in get_peer_counts(args.peers):
+                        result = bench_download(
+                            cluster, name, size, peer_count, piece_size
+                        )
+                        results.append(result)
+                        print(result, file=sys.stderr)
+
+            if "search" in benchmarks:
+                name = next(iter(files))
+                for peer_count in get_peer_counts(args.peers):
+                    for hit in (True, False):
+                        result = bench_search(
+                            cluster, name, peer_count, args.search_rounds, hit
+                        )
+                        results.append(result)
+                        print(result, file=sys.stderr)
+
+            if "server_concurrency" in benchmarks:
+                name = f"concurrency_{concurrency_size}.bin"
+                for clients in (int(c) for c in args.concurrency.split(",")):
+                    result = bench_server_concurrency(
+                        cluster,
+                        name,
+                        concurrency_size,
+                        piece_size,
+                        clients,
+                        REQUESTS_PER_CLIENT,
+                    )
+                    results.append(result)
+                    print(result, file=sys.stderr)
+        finally:
+            cluster.stop()
+            os.chdir(original_dir)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "peers": args.peers,
+            "piece_size": piece_size,
+        },
+        "results": results,
+    }
+    if output_path:
+        with open(output_path, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if compare_path:
+        with open(compare_path) as file:
+            regressions = compare_results(json.load(file), report, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
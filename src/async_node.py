@@ -0,0 +1,119 @@
+from typing import Optional
+import asyncio
+import threading
+from common.chunk_store import ChunkStore
+from common.control_block import ControlBlock
+from common.debug_print import get_logger
+from common.manifest import PIECE_SIZE
+from common.protocol import COMPRESSION_NONE
+from file_share import async_tcp
+from file_share.async_tcp import AsyncFileServer
+from file_share.rate_limiter import UploadLimiter
+from peer_discovery.async_discovery import open_discovery_endpoints, run_discovery
+from peer_discovery.discovery import MY_SERVER_PORT
+
+LOGGER = get_logger("node")
+
+
+class AsyncNode:
+    """
+    Runs discovery, the file server and downloads on one asyncio event loop.
+
+    This replaces the thread-per-role setup in main.py: the loop runs in a
+    single background thread, every connection, datagram and download worker
+    is a coroutine on it, and the blocking methods below let the CLI thread
+    drive it.
+
+    Attributes:
+        control_blk (ControlBlock): Shared peer and file state.
+        server_port (int): Port of the file server.
+        limiter (UploadLimiter): Upload rate limits of the file server, or None.
+    """
+
+    def __init__(
+        self,
+        control_blk: ControlBlock,
+        server_port: int = MY_SERVER_PORT,
+        limiter: UploadLimiter = None,
+    ):
+        self.control_blk = control_blk
+        self.server_port = server_port
+        self.limiter = limiter
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._startup_error = None
+
+    def start(self) -> None:
+        """Start the event loop thread and wait until the node is serving."""
+        self._thread = threading.Thread(
+            target=asyncio.run, args=(self._main(),), name="async-node", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+        if self._startup_error is not None:
+            self._thread.join()
+            raise self._startup_error
+
+    def stop(self) -> None:
+        """Stop discovery, let in-flight transfers finish and wait for the loop to exit."""
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+        self._thread = None
+
+    def download(
+        self,
+        peers: list,
+        file_name: str,
+        piece_size: int = PIECE_SIZE,
+        resume: bool = False,
+        compression: int = COMPRESSION_NONE,
+        root_hash: Optional[str] = None,
+        chunk_store: Optional[ChunkStore] = None,
+    ) -> bool:
+        """Blocking wrapper around async_tcp.receive_file_from_peers."""
+        future = asyncio.run_coroutine_threadsafe(
+            async_tcp.receive_file_from_peers(
+                peers,
+                file_name,
+                piece_size,
+                resume,
+                compression,
+                root_hash,
+                chunk_store,
+            ),
+            self._loop,
+        )
+        return future.result()
+
+    async def _main(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = AsyncFileServer(
+            self.control_blk, self.server_port, limiter=self.limiter
+        )
+        try:
+            await server.start()
+            transports = await open_discovery_endpoints(self.control_blk)
+        except OSError as e:
+            self._startup_error = e
+            self._ready.set()
+            if server.is_serving():
+                await server.close()
+            return
+
+        discovery = asyncio.create_task(
+            run_discovery(self.control_blk, self._stop, transports)
+        )
+        self._ready.set()
+        LOGGER.debug("Async node running")
+
+        try:
+            await self._stop.wait()
+        finally:
+            await server.close()
+            self._stop.set()
+            await discovery
@@ -0,0 +1,95 @@
+"""
+Index of the content-defined chunks of local files.
+
+Shared files and finished downloads are recorded chunk by chunk, so a
+download can copy any chunk we already hold from disk instead of fetching
+it (see send_recv_tcp.reuse_local_chunks). Only locations are stored, not
+data: a chunk is re-hashed whenever it is read, and locations whose file
+has since changed are dropped.
+"""
+
+from typing import List, Optional
+import hashlib
+import os
+import sqlite3
+import threading
+
+CHUNK_STORE_PATH = os.path.join(os.path.expanduser("~"), ".lanp2p", "chunks.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    hash BLOB NOT NULL,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (path, offset)
+);
+CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash);
+"""
+
+
+class ChunkStore:
+    """
+    SQLite map from chunk hash to the local files and offsets holding the chunk.
+
+    Attributes:
+        path (str): Database file, or ":memory:".
+    """
+
+    def __init__(self, path: str = CHUNK_STORE_PATH) -> None:
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+
+    def add_file(self, path: str, chunks: List[tuple]) -> None:
+        """Record the (length, hex hash) chunks of a file, replacing what was recorded for it."""
+        rows = []
+        offset = 0
+        for length, chunk_hash in chunks:
+            rows.append((bytes.fromhex(chunk_hash), path, offset, length))
+            offset += length
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+            self._conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", rows)
+
+    def remove_file(self, path: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE path = ?", (path,))
+
+    def move_file(self, path: str, new_path: str) -> None:
+        """Follow a file that was renamed."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE path = ?", (new_path,))
+            self._conn.execute(
+                "UPDATE chunks SET path = ? WHERE path = ?", (new_path, path)
+            )
+
+    def read_chunk(self, chunk_hash: str, length: int) -> Optional[bytes]:
+        """Return the chunk's bytes from a local file holding it, or None."""
+        digest = bytes.fromhex(chunk_hash)
+        with self._lock:
+            locations = self._conn.execute(
+                "SELECT path, offset FROM chunks WHERE hash = ? AND length = ?",
+                (digest, length),
+            ).fetchall()
+
+        for path, offset in locations:
+            try:
+                with open(path, "rb") as file:
+                    data = os.pread(file.fileno(), length, offset)
+            except OSError:
+                data = b""
+            if len(data) == length and hashlib.sha256(data).digest() == digest:
+                return data
+            # The file changed or is gone; its other chunks are suspect too.
+            self.remove_file(path)
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
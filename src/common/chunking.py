@@ -0,0 +1,95 @@
+"""
+Content-defined chunking, to find data a download shares with local files.
+
+Chunk boundaries are placed where a hash of the preceding WINDOW_SIZE bytes
+ends in BOUNDARY, so they follow the content rather than file offsets:
+inserting or deleting bytes only changes the chunks around the edit, and the
+chunks after it still match a local copy of the previous revision.
+
+The window hash of a whole block is computed at once with big-integer
+shifts and XORs, so scanning runs at C speed rather than a Python loop per
+byte. A run of one repeated byte hashes to zero, so runs such as sparse
+regions are cut every MIN_CHUNK_SIZE bytes into identical chunks. Every node
+must cut files the same way, so the hash tables are derived from fixed seeds
+and none of the constants below may change.
+"""
+
+from typing import List
+import hashlib
+import os
+
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+MIN_CHUNKED_FILE_SIZE = 4 * 1024 * 1024  # Smaller files are not worth chunking
+SCAN_BLOCK_SIZE = 4 * 1024 * 1024  # Bytes hashed per step while scanning a file
+WINDOW_SIZE = 8
+BOUNDARY = b"\0\0"  # Hash bytes marking a cut; one position in 64K on average
+
+
+def _make_table(seed: bytes) -> bytes:
+    return bytes(
+        sorted(range(256), key=lambda i: hashlib.sha256(seed + bytes([i])).digest())
+    )
+
+
+_TABLE_A = _make_table(b"lanp2p-chunk-a")
+_TABLE_B = _make_table(b"lanp2p-chunk-b")
+
+
+def _window_hash(data: bytes) -> bytes:
+    """
+    Return one hash byte per byte of `data`, each depending on the
+    WINDOW_SIZE bytes ending there (fewer for the first WINDOW_SIZE - 1).
+    """
+    a = int.from_bytes(data.translate(_TABLE_A), "big")
+    b = int.from_bytes(data.translate(_TABLE_B), "big")
+    # Byte i of `a >> 8` is byte i - 1 of `a`, so this pairs each byte with
+    # the one before it; the shifts below fold four such pairs together.
+    z = (a >> 8) ^ b
+    z ^= z >> 16
+    z ^= z >> 32
+    return z.to_bytes(len(data), "big")
+
+
+def chunk_file(path: str) -> List[tuple]:
+    """Split a file into content-defined chunks, as (length, hex SHA-256) in file order."""
+    chunks = []
+    hasher = hashlib.sha256()
+    cut = 0  # Start of the current chunk
+    offset = 0  # Start of the current block
+    tail = b""  # Last WINDOW_SIZE bytes of the previous block
+    with open(path, "rb") as file:
+        while True:
+            block = os.pread(file.fileno(), SCAN_BLOCK_SIZE, offset)
+            if not block:
+                break
+            end = offset + len(block)
+            data = tail + block
+            base = offset - len(tail)  # File offset of data[0]
+            marks = _window_hash(data)
+            hashed = offset  # Bytes of the block fed to `hasher` end here
+
+            while True:
+                # Boundaries ending in the tail were looked for in the previous
+                # block, except one straddling the two.
+                lowest = max(cut + MIN_CHUNK_SIZE - len(BOUNDARY), offset - 1)
+                highest = min(cut + MAX_CHUNK_SIZE, end)
+                found = marks.find(BOUNDARY, lowest - base, highest - base)
+                if found != -1:
+                    next_cut = base + found + len(BOUNDARY)
+                elif cut + MAX_CHUNK_SIZE <= end:
+                    next_cut = cut + MAX_CHUNK_SIZE
+                else:
+                    break
+                hasher.update(block[hashed - offset : next_cut - offset])
+                chunks.append((next_cut - cut, hasher.hexdigest()))
+                hasher = hashlib.sha256()
+                cut = hashed = next_cut
+
+            hasher.update(block[hashed - offset :])
+            tail = data[-WINDOW_SIZE:]
+            offset = end
+
+    if offset > cut:
+        chunks.append((offset - cut, hasher.hexdigest()))
+    return chunks
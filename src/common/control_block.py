@@ -1,36 +1,536 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
+from collections import deque
 import os
+import queue
+import threading
+import time
+from common.debug_print import get_logger
+from common.manifest import MANIFEST_CACHE_DIR, PIECE_SIZE, Manifest, load_manifest
+from common.chunk_store import ChunkStore
+from common.protocol import parse_content_name
+from common.share_index import ShareIndex
+
+CATALOG_LOG_SIZE = 4096  # Catalog changes kept for serving deltas to peers
+PEER_MAX_FAILURES = 3  # Consecutive failures before a peer is no longer targeted
+RTT_SMOOTHING = 0.125  # Weight of a new sample in the smoothed RTT, as in TCP
+
+LOGGER = get_logger("share")
+
+
+class SharedFile:
+    """
+    An entry in the local share index.
+
+    Attributes:
+        path (str): Path of the shared file.
+        name (str): Basename peers use to look the file up.
+        size (int): File size in bytes when it was indexed (0 if it could not be read).
+        mtime_ns (int): File modification time in nanoseconds when it was indexed.
+        manifest (Optional[Manifest]): Piece-hash manifest, if one has been built
+            (or, for files loaded from the share index, once it has been read).
+        root_hash (Optional[str]): Root hash of the manifest, None if not yet hashed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        manifest: Optional[Manifest] = None,
+        stat: Optional[os.stat_result] = None,
+    ) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        self.manifest = manifest
+        self.root_hash = manifest.root_hash if manifest is not None else None
+        self.size = 0
+        self.mtime_ns = 0
+        if manifest is not None:
+            self.size, self.mtime_ns = manifest.size, manifest.mtime_ns
+        else:
+            try:
+                stat = stat or os.stat(path)
+                self.size, self.mtime_ns = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                pass
+
+    @classmethod
+    def from_index(
+        cls, path: str, size: int, mtime_ns: int, root_hash: Optional[str]
+    ) -> "SharedFile":
+        """An entry as recorded in the share index, without touching the file."""
+        entry = cls.__new__(cls)
+        entry.path = path
+        entry.name = os.path.basename(path)
+        entry.manifest = None
+        entry.root_hash = root_hash
+        entry.size = size
+        entry.mtime_ns = mtime_ns
+        return entry
+
+
+class PeerInfo:
+    """
+    Liveness and performance statistics of a known peer.
+
+    Attributes:
+        address (tuple): (ip, file request port) identifying the peer.
+        last_seen (float): time.monotonic() of the last beacon or reply from the peer.
+        rtt (Optional[float]): Smoothed round-trip time in seconds, None until measured.
+        failures (int): Consecutive requests the peer failed to answer.
+    """
+
+    def __init__(self, address: tuple) -> None:
+        self.address = address
+        self.last_seen = time.monotonic()
+        self.rtt: Optional[float] = None
+        self.failures = 0
+
+    def get_priority(self) -> tuple:
+        """Sort key putting reliable, fast peers first."""
+        return (self.failures, self.rtt if self.rtt is not None else float("inf"))
+
+    def __repr__(self) -> str:
+        rtt = f"{self.rtt * 1000:.1f}ms" if self.rtt is not None else "?"
+        return f"PeerInfo({self.address}, rtt={rtt}, failures={self.failures})"
 
 
 class ControlBlock:
     """
     A class representing a control block for managing peer-to-peer file sharing.
 
+    Shared files are kept in an index keyed by basename, so lookups from the
+    discovery and transfer paths are O(1). Hashed files are also indexed by
+    the root hash of their manifest, so peers can ask for content by a
+    "sha256:<root hash>" name (see common.protocol) whatever it is called
+    here. The indexes are guarded by a lock since they are read from server
+    threads while the CLI thread modifies them.
+
+    Every change to the shared files bumps `catalog_version` and is logged, so
+    peers that saw an earlier version can pull just the delta.
+
+    With a ShareIndex, the shared files are loaded from it at startup and
+    every change is written back, so they survive restarts. Manifests are read
+    from the index lazily, and revalidate_files() finds files that changed
+    while the node was down.
+
+    With a ChunkStore, the chunks of every hashed file are recorded in it, so
+    downloads can reuse data this node already shares.
+
+    get_manifest() is called from the serving paths, so it never hashes: a
+    file found to have changed since hashing is served unhashed while a
+    background thread builds its new manifest, cached under `cache_dir`.
+
+    Peers are tracked in a table with last-seen times, RTT estimates and
+    failure counts. Peers that stop sending beacons are expired, and
+    `peer_list` only holds peers that are answering, fastest first.
+
     Attributes:
-        peer_list (List[str]): A list of IP addresses (or identifiers) of peers.
-        peer_to_file (Dict[str, List[str]]): A dictionary mapping peer IPs to a list of files they have.
-        file_list (List[str]): A list of filenames shared by the local peer.
+        peer_list (List[tuple]): Live peers as (ip, file request port), best first.
+        peers (Dict[tuple, PeerInfo]): Every known peer, including failing ones.
+        peer_to_file (Dict[tuple, Dict[str, tuple]]): Each peer's catalog, mapping filename to (size, root hash).
+        peer_catalog_versions (Dict[tuple, int]): Catalog version each entry of peer_to_file is at.
+        file_list (List[str]): Paths of the files shared by the local peer.
+        catalog_version (int): Version of the local catalog advertised in beacons.
+        share_index (Optional[ShareIndex]): Persistent store of the shared files, if any.
+        chunk_store (Optional[ChunkStore]): Index of local chunks for downloads, if any.
     """
 
-    def __init__(self) -> None:
-        self.peer_list: List[str] = []
-        self.peer_to_file: Dict[str, List[str]] = {}
-        self.file_list: List[str] = []
+    def __init__(
+        self,
+        share_index: Optional[ShareIndex] = None,
+        chunk_store: Optional[ChunkStore] = None,
+        cache_dir: str = MANIFEST_CACHE_DIR,
+    ) -> None:
+        self.peers: Dict[tuple, PeerInfo] = {}
+        self.peer_to_file: Dict[tuple, Dict[str, tuple]] = {}
+        self.peer_catalog_versions: Dict[tuple, int] = {}
+        self._peers_lock = threading.Lock()
+        self._files_by_name: Dict[str, SharedFile] = {}
+        self._files_by_hash: Dict[str, List[SharedFile]] = {}
+        self._files_lock = threading.Lock()
+        self._cache_dir = cache_dir  # Manifest cache used when rehashing
+        self._hash_queue: queue.Queue = queue.Queue()
+        self._hash_thread: Optional[threading.Thread] = None
+        self._hashing: set = set()  # Paths queued or being hashed
+        # Starts from the clock so versions keep increasing across restarts.
+        self.catalog_version = int(time.time() * 1000)
+        self._catalog_log = deque()
+        self._catalog_log_base = self.catalog_version
+        self.share_index = share_index
+        self.chunk_store = chunk_store
+        if share_index is not None:
+            for row in share_index.load_files():
+                entry = SharedFile.from_index(*row)
+                if self._files_by_name.setdefault(entry.name, entry) is entry:
+                    self._link_hash(entry)
+
+    @property
+    def peer_list(self) -> List[tuple]:
+        with self._peers_lock:
+            live_peers = [
+                peer
+                for peer in self.peers.values()
+                if peer.failures < PEER_MAX_FAILURES
+            ]
+        live_peers.sort(key=PeerInfo.get_priority)
+        return [peer.address for peer in live_peers]
+
+    @peer_list.setter
+    def peer_list(self, addresses: List[tuple]) -> None:
+        with self._peers_lock:
+            self.peers = {address: PeerInfo(address) for address in addresses}
+
+    def touch_peer(self, address: tuple) -> bool:
+        """
+        Record that a peer is alive. Returns True if it was not known before.
+
+        Each beacon also forgives one failure, so a peer hidden after a burst
+        of lost requests is tried again one beacon later.
+        """
+        with self._peers_lock:
+            peer = self.peers.get(address)
+            if peer is None:
+                self.peers[address] = PeerInfo(address)
+                return True
+            peer.last_seen = time.monotonic()
+            peer.failures = max(0, peer.failures - 1)
+            return False
+
+    def record_peer_rtt(self, address: tuple, rtt: float) -> None:
+        """Record a successful round trip to a peer."""
+        with self._peers_lock:
+            peer = self.peers.setdefault(address, PeerInfo(address))
+            peer.last_seen = time.monotonic()
+            peer.failures = 0
+            if peer.rtt is None:
+                peer.rtt = rtt
+            else:
+                peer.rtt += RTT_SMOOTHING * (rtt - peer.rtt)
+
+    def record_peer_failure(self, address: tuple) -> None:
+        """Record that a peer did not answer a request."""
+        with self._peers_lock:
+            peer = self.peers.get(address)
+            if peer is not None:
+                peer.failures = min(peer.failures + 1, PEER_MAX_FAILURES)
+
+    def expire_peers(self, max_age: float) -> List[tuple]:
+        """Forget peers not heard from in `max_age` seconds, with their catalogs."""
+        cutoff = time.monotonic() - max_age
+        with self._peers_lock:
+            expired = [
+                address
+                for address, peer in self.peers.items()
+                if peer.last_seen < cutoff
+            ]
+            for address in expired:
+                del self.peers[address]
+                self.peer_to_file.pop(address, None)
+                self.peer_catalog_versions.pop(address, None)
+        return expired
+
+    @property
+    def file_list(self) -> List[str]:
+        with self._files_lock:
+            return [entry.path for entry in self._files_by_name.values()]
+
+    @file_list.setter
+    def file_list(self, paths: List[str]) -> None:
+        entries = {}
+        for path in paths:
+            entry = SharedFile(path)
+            entries.setdefault(entry.name, entry)
+        with self._files_lock:
+            self._files_by_name = entries
+            self._files_by_hash = {}
+            for entry in entries.values():
+                self._link_hash(entry)
+            if self.share_index is not None:
+                self.share_index.replace_all(list(entries.values()))
+            # The whole catalog changed, so peers must pull a full snapshot.
+            self.catalog_version += 1
+            self._catalog_log.clear()
+            self._catalog_log_base = self.catalog_version
+
+    def add_file(self, path: str, manifest: Optional[Manifest] = None) -> SharedFile:
+        """Share a file, replacing any previously shared file with the same basename."""
+        entry = SharedFile(path, manifest)
+        with self._files_lock:
+            self._replace_entry(entry)
+            self._record_catalog_change(entry.name, entry)
+            if self.share_index is not None:
+                self.share_index.put_files([entry])
+        self._record_chunks(entry.path, manifest)
+        return entry
+
+    def add_files(self, files: List[tuple]) -> List[SharedFile]:
+        """
+        Share a batch of (path, os.stat_result) pairs under a single lock.
+
+        As with add_file, a later file replaces an earlier one with the same basename.
+        """
+        entries = [SharedFile(path, stat=stat) for path, stat in files]
+        with self._files_lock:
+            for entry in entries:
+                self._replace_entry(entry)
+                self._record_catalog_change(entry.name, entry)
+            if self.share_index is not None:
+                self.share_index.put_files(entries)
+        return entries
+
+    def set_manifest(self, manifest: Manifest) -> bool:
+        """
+        Attach a manifest built elsewhere to the shared file it describes.
+
+        Returns False if that file is no longer shared.
+        """
+        with self._files_lock:
+            entry = self._files_by_name.get(os.path.basename(manifest.path))
+            if entry is None or entry.path != manifest.path:
+                return False
+            self._store_manifest(entry, manifest)
+        self._record_chunks(entry.path, manifest)
+        return True
+
+    def remove_file(self, filename: str) -> bool:
+        with self._files_lock:
+            entry = self._files_by_name.pop(filename, None)
+            if entry is None:
+                return False
+            self._unlink_hash(entry)
+            self._record_catalog_change(filename, None)
+            if self.share_index is not None:
+                self.share_index.remove_file(filename)
+            return True
+
+    def get_shared_files(self) -> List[SharedFile]:
+        with self._files_lock:
+            return list(self._files_by_name.values())
+
+    def revalidate_files(self) -> List[str]:
+        """
+        Check every shared file against the disk, as after loading the share index.
+
+        Files that no longer exist stop being shared. Files whose size or
+        modification time changed lose their manifest. Returns the paths of the
+        files that need (re)hashing.
+        """
+        stale = []
+        for entry in self.get_shared_files():
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                stat = None
+            with self._files_lock:
+                if self._files_by_name.get(entry.name) is not entry:
+                    continue  # Replaced or removed meanwhile
+                if stat is None:
+                    del self._files_by_name[entry.name]
+                    self._unlink_hash(entry)
+                    self._record_catalog_change(entry.name, None)
+                    if self.share_index is not None:
+                        self.share_index.remove_file(entry.name)
+                    continue
+                if (entry.size, entry.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                    entry.size, entry.mtime_ns = stat.st_size, stat.st_mtime_ns
+                    self._store_manifest(entry, None)
+                if entry.root_hash is None:
+                    stale.append(entry.path)
+        return stale
+
+    def _replace_entry(self, entry: SharedFile) -> None:
+        # Caller must hold _files_lock.
+        old = self._files_by_name.get(entry.name)
+        if old is not None:
+            self._unlink_hash(old)
+        self._files_by_name[entry.name] = entry
+        self._link_hash(entry)
+
+    def _link_hash(self, entry: SharedFile) -> None:
+        # Caller must hold _files_lock.
+        if entry.root_hash is not None:
+            self._files_by_hash.setdefault(entry.root_hash, []).append(entry)
+
+    def _unlink_hash(self, entry: SharedFile) -> None:
+        # Caller must hold _files_lock.
+        entries = self._files_by_hash.get(entry.root_hash, [])
+        if entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self._files_by_hash[entry.root_hash]
+
+    def _record_catalog_change(self, name: str, entry: Optional[SharedFile]) -> None:
+        # Caller must hold _files_lock.
+        self.catalog_version += 1
+        self._catalog_log.append((self.catalog_version, _catalog_item(name, entry)))
+        if len(self._catalog_log) > CATALOG_LOG_SIZE:
+            self._catalog_log_base = self._catalog_log.popleft()[0]
+
+    def get_catalog_changes(self, since: int) -> tuple:
+        """
+        Return (version, full, items) bringing a peer at version `since` up to date.
+
+        Items are [name, size, root_hash] lists, with size None for removed
+        files. If the changes since `since` are no longer logged, `full` is
+        True and the items are a snapshot of the whole catalog.
+        """
+        with self._files_lock:
+            if self._catalog_log_base <= since <= self.catalog_version:
+                items = [item for version, item in self._catalog_log if version > since]
+                return self.catalog_version, False, items
+
+            items = [
+                _catalog_item(name, entry)
+                for name, entry in self._files_by_name.items()
+            ]
+            return self.catalog_version, True, items
+
+    def update_peer_catalog(
+        self, peer: tuple, version: int, items: List[list], since: Optional[int]
+    ) -> bool:
+        """
+        Apply catalog items received from a peer.
+
+        `since` is the version the items are a delta against, or None for a full
+        snapshot. Returns False if the delta does not apply to what we hold.
+        """
+        with self._peers_lock:
+            if since is None:
+                files = {}
+            elif self.peer_catalog_versions.get(peer) == since:
+                files = dict(self.peer_to_file.get(peer, {}))
+            else:
+                return False
+
+            for name, size, root_hash in items:
+                if size is None:
+                    files.pop(name, None)
+                else:
+                    files[name] = (size, root_hash)
+            self.peer_to_file[peer] = files
+            self.peer_catalog_versions[peer] = version
+            return True
+
+    def find_peers_with_content(self, root_hash: str) -> List[tuple]:
+        """Return (peer, size) for every peer whose gossiped catalog has a file with `root_hash`."""
+        with self._peers_lock:
+            holders = []
+            for peer, files in self.peer_to_file.items():
+                for size, file_root_hash in files.values():
+                    if file_root_hash == root_hash:
+                        holders.append((peer, size))
+                        break
+            return holders
+
+    def find_peers_with_file(self, filename: str) -> List[tuple]:
+        """Return (peer, size) for every peer whose gossiped catalog lists `filename`."""
+        with self._peers_lock:
+            return [
+                (peer, files[filename][0])
+                for peer, files in self.peer_to_file.items()
+                if filename in files
+            ]
+
+    def get_shared_file(self, filename: str) -> Optional[SharedFile]:
+        """Look a shared file up by basename or by "sha256:<root hash>" content name."""
+        root_hash = parse_content_name(filename)
+        with self._files_lock:
+            if root_hash is not None:
+                entries = self._files_by_hash.get(root_hash)
+                return entries[0] if entries else None
+            return self._files_by_name.get(filename)
 
     def get_file_size(self, filename: str) -> int:
-        for file in self.file_list:
-            if file.split("/")[-1] == filename and os.path.exists(file):
-                return os.path.getsize(file)
-        return 0
+        entry = self.get_shared_file(filename)
+        return entry.size if entry is not None else 0
 
     def check_file_available(self, filename: str) -> bool:
-        for file in self.file_list:
-            if file.split("/")[-1] == filename:
-                return True
-        return False
+        return self.get_shared_file(filename) is not None
 
     def get_file_path(self, filename: str) -> str:
-        for file in self.file_list:
-            if file.split("/")[-1] == filename:
-                return file
-        return ""
+        entry = self.get_shared_file(filename)
+        return entry.path if entry is not None else ""
+
+    def get_manifest(self, filename: str, build: bool = False) -> Optional[Manifest]:
+        """
+        Return the piece manifest of a shared file, or None if there is no current one.
+
+        A manifest whose file changed on disk since hashing is dropped, so the
+        file is served unhashed, and a new one is built in the background.
+        With `build`, a missing manifest is queued for building as well.
+        """
+        entry = self.get_shared_file(filename)
+        if entry is None:
+            return None
+
+        manifest = entry.manifest
+        index = self.share_index
+        if manifest is None and entry.root_hash is not None and index is not None:
+            manifest = index.load_manifest(entry.path)
+            with self._files_lock:
+                if entry.manifest is None:
+                    entry.manifest = manifest
+        if manifest is not None and manifest.is_current():
+            return manifest
+        if manifest is None and not build:
+            return None
+
+        piece_size = manifest.piece_size if manifest is not None else PIECE_SIZE
+        if manifest is not None:
+            try:
+                stat = os.stat(entry.path)
+            except OSError:
+                return None  # Gone; revalidate_files() stops sharing it
+            with self._files_lock:
+                if entry.manifest is manifest:
+                    entry.size, entry.mtime_ns = stat.st_size, stat.st_mtime_ns
+                    self._store_manifest(entry, None)
+        self._hash_in_background(entry.path, piece_size)
+        return None
+
+    def _hash_in_background(self, path: str, piece_size: int) -> None:
+        with self._files_lock:
+            if path in self._hashing:
+                return
+            self._hashing.add(path)
+            if self._hash_thread is None:
+                self._hash_thread = threading.Thread(
+                    target=self._run_hashing, name="manifest-hashing", daemon=True
+                )
+                self._hash_thread.start()
+        self._hash_queue.put((path, piece_size))
+
+    def _run_hashing(self) -> None:
+        while True:
+            path, piece_size = self._hash_queue.get()
+            try:
+                self.set_manifest(load_manifest(path, piece_size, self._cache_dir))
+            except Exception as e:
+                LOGGER.warning("Could not hash '%s': %s", path, e)
+            finally:
+                with self._files_lock:
+                    self._hashing.discard(path)
+
+    def _record_chunks(self, path: str, manifest: Optional[Manifest]) -> None:
+        if self.chunk_store is not None and manifest is not None and manifest.chunks:
+            self.chunk_store.add_file(path, manifest.chunks)
+
+    def _store_manifest(self, entry: SharedFile, manifest: Optional[Manifest]) -> None:
+        # Caller must hold _files_lock.
+        is_shared = self._files_by_name.get(entry.name) is entry
+        if is_shared:
+            self._unlink_hash(entry)
+        entry.manifest = manifest
+        entry.root_hash = manifest.root_hash if manifest is not None else None
+        if manifest is not None:
+            entry.size, entry.mtime_ns = manifest.size, manifest.mtime_ns
+        if is_shared:
+            self._link_hash(entry)
+            self._record_catalog_change(entry.name, entry)
+            if self.share_index is not None:
+                self.share_index.put_files([entry])
+
+
+def _catalog_item(name: str, entry: Optional[SharedFile]) -> list:
+    if entry is None:
+        return [name, None, None]
+    return [name, entry.size, entry.root_hash]
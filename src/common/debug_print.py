@@ -1,27 +1,116 @@
-import threading
+"""
+Logging for the whole application.
 
-DEBUG = False
+Every subsystem logs through its own child of the "lanp2p" logger (see
+get_logger), so levels can be set per subsystem. Messages use logging's lazy
+%-style arguments: a disabled debug call costs one level check and never
+formats its message. Records are handed to a queue and written to stdout by a
+single background listener thread, so discovery and transfer threads never
+block on the terminal.
+
+debug_print and regular_print remain as thin wrappers for code that still
+prints, with print-like arguments.
+"""
+
+from typing import Optional
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = "lanp2p"
+SUBSYSTEMS = ("cli", "discovery", "transfer", "node", "share")
+LOG_FORMAT = "[Thread-%(threadName)s]  %(message)s"
+DEFAULT_LEVEL = logging.INFO
+
+_ROOT = logging.getLogger(LOGGER_NAME)
+_QUEUE = queue.Queue()
+_LISTENER = None
+
+
+def _start_listener() -> None:
+    global _QUEUE, _LISTENER
+    # This module may be imported under two names (common.* and src.common.*);
+    # share the writer that is already attached rather than print twice.
+    for handler in _ROOT.handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            _QUEUE = handler.queue
+            return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    _LISTENER = logging.handlers.QueueListener(_QUEUE, stream_handler)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)  # Writes out whatever is still queued
+
+    _ROOT.addHandler(logging.handlers.QueueHandler(_QUEUE))
+    _ROOT.setLevel(DEFAULT_LEVEL)
+    _ROOT.propagate = False
+
+
+_start_listener()
+
+
+def get_logger(subsystem: str) -> logging.Logger:
+    """Return the logger of a subsystem, e.g. "discovery" or "transfer"."""
+    return logging.getLogger(f"{LOGGER_NAME}.{subsystem}")
+
+
+_CLI_LOGGER = get_logger("cli")
+
+
+def set_log_level(level, subsystem: Optional[str] = None) -> None:
+    """
+    Set the level of one subsystem, or of every subsystem without its own level.
+
+    `level` is a logging level or its name, e.g. "debug".
+    """
+    if isinstance(level, str):
+        level = level.upper()
+    logger = _ROOT if subsystem is None else get_logger(subsystem)
+    logger.setLevel(level)
+
+
+def configure_log_levels(spec: str) -> None:
+    """
+    Apply levels from a spec such as "info,transfer=debug".
+
+    A bare level applies to every subsystem; subsystem=level pairs override it.
+    Raises ValueError for an unknown subsystem or level.
+    """
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        subsystem, _, level = item.rpartition("=")
+        if subsystem and subsystem not in SUBSYSTEMS:
+            raise ValueError(f"unknown subsystem '{subsystem}'")
+        if not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError(f"unknown log level '{level}'")
+        set_log_level(level, subsystem or None)
+
+
+def flush_logs() -> None:
+    """Wait until every queued message has been written, e.g. before prompting."""
+    _QUEUE.join()
+
+
+def _join_args(args, kwargs) -> str:
+    return kwargs.get("sep", " ").join(str(arg) for arg in args)
 
 
 def debug_print(*args, **kwargs):
-    """Custom debug_print function that prefixes output with the current thread ID or name."""
-    if not DEBUG:
-        return
-    thread_name = threading.current_thread().name
-    print(f"[Thread-{thread_name}] ", *args, **kwargs)
+    """Log the arguments, joined like print() does, at debug level."""
+    if _ROOT.isEnabledFor(logging.DEBUG):
+        _ROOT.debug(_join_args(args, kwargs))
 
 
 def regular_print(*args, **kwargs):
-    """Custom debug_print function that prefixes output with the current thread ID or name."""
-    thread_name = threading.current_thread().name
-    print(f"[Thread-{thread_name}] ", *args, **kwargs)
+    """Log the arguments, joined like print() does, as CLI output."""
+    _CLI_LOGGER.info(_join_args(args, kwargs))
 
 
 def debug_print_on():
-    global DEBUG
-    DEBUG = True
+    set_log_level(logging.DEBUG)
 
 
 def debug_print_off():
-    global DEBUG
-    DEBUG = False
+    set_log_level(DEFAULT_LEVEL)
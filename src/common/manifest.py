@@ -0,0 +1,195 @@
+from typing import List, Optional
+import hashlib
+import json
+import os
+import time
+from common.chunking import MIN_CHUNKED_FILE_SIZE, chunk_file
+from common.metrics import HASH_TIME
+
+PIECE_SIZE = 1024 * 1024  # Bytes covered by each piece hash
+MANIFEST_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".lanp2p", "manifests")
+READ_SIZE = 1024 * 1024  # Read size while hashing pieces
+
+
+class Manifest:
+    """
+    Piece hashes of a shared file, tied to the on-disk identity they were computed from.
+
+    Attributes:
+        path (str): Path of the shared file.
+        size (int): File size in bytes when hashed.
+        mtime_ns (int): File modification time in nanoseconds when hashed.
+        inode (int): File inode number when hashed.
+        piece_size (int): Number of bytes covered by each piece (the last may be shorter).
+        piece_hashes (List[str]): Hex SHA-256 of each piece, in file order.
+        root_hash (str): Hex SHA-256 over the concatenated raw piece digests.
+        chunks (Optional[List[tuple]]): Content-defined chunks as (length, hex
+            SHA-256), for files of at least MIN_CHUNKED_FILE_SIZE bytes.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        mtime_ns: int,
+        inode: int,
+        piece_size: int,
+        piece_hashes: List[str],
+        chunks: Optional[List[tuple]] = None,
+    ) -> None:
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.inode = inode
+        self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
+        self.root_hash = get_root_hash(piece_hashes)
+        self.chunks = chunks
+
+    def matches_stat(self, stat: os.stat_result) -> bool:
+        return (
+            self.size == stat.st_size
+            and self.mtime_ns == stat.st_mtime_ns
+            and self.inode == stat.st_ino
+        )
+
+    def is_current(self) -> bool:
+        """Check that the file has not changed since the manifest was built."""
+        try:
+            return self.matches_stat(os.stat(self.path))
+        except OSError:
+            return False
+
+    def get_piece_range(self, index: int) -> tuple:
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.size)
+
+    def get_hash_for_range(self, start: int, end: int) -> Optional[str]:
+        """Return the cached hash if [start, end) is exactly one piece, else None."""
+        if start % self.piece_size != 0:
+            return None
+        index = start // self.piece_size
+        if index >= len(self.piece_hashes) or self.get_piece_range(index) != (
+            start,
+            end,
+        ):
+            return None
+        return self.piece_hashes[index]
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "size": self.size,
+            "mtime_ns": self.mtime_ns,
+            "inode": self.inode,
+            "piece_size": self.piece_size,
+            "piece_hashes": self.piece_hashes,
+            "chunks": self.chunks,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Manifest":
+        return cls(
+            data["path"],
+            data["size"],
+            data["mtime_ns"],
+            data["inode"],
+            data["piece_size"],
+            data["piece_hashes"],
+            [tuple(chunk) for chunk in data["chunks"]] if data.get("chunks") else None,
+        )
+
+
+def get_root_hash(piece_hashes: List[str]) -> str:
+    hasher = hashlib.sha256()
+    for piece_hash in piece_hashes:
+        hasher.update(bytes.fromhex(piece_hash))
+    return hasher.hexdigest()
+
+
+def hash_pieces(path: str, piece_size: int = PIECE_SIZE) -> List[str]:
+    """Hash a file in fixed-size pieces with a single sequential read."""
+    started = time.perf_counter()
+    piece_hashes = []
+    buffer = memoryview(bytearray(min(READ_SIZE, piece_size)))
+    with open(path, "rb") as file:
+        while True:
+            hasher = hashlib.sha256()
+            remaining = piece_size
+            while remaining > 0:
+                read = file.readinto(buffer[: min(len(buffer), remaining)])
+                if not read:
+                    break
+                hasher.update(buffer[:read])
+                remaining -= read
+            if remaining == piece_size:  # Nothing left to read
+                break
+            piece_hashes.append(hasher.hexdigest())
+            if remaining > 0:  # Short final piece
+                break
+    HASH_TIME.observe(time.perf_counter() - started, ("manifest",))
+    return piece_hashes
+
+
+def _get_cache_path(path: str, cache_dir: str) -> str:
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def _read_cached_manifest(cache_path: str) -> Optional[Manifest]:
+    try:
+        with open(cache_path, "r") as file:
+            return Manifest.from_dict(json.load(file))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_cached_manifest(cache_path: str, manifest: Manifest) -> None:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest.to_dict(), file)
+    # Atomic so a concurrent reader never sees a half-written manifest.
+    os.replace(tmp_path, cache_path)
+
+
+def load_manifest(
+    path: str, piece_size: int = PIECE_SIZE, cache_dir: str = MANIFEST_CACHE_DIR
+) -> Manifest:
+    """
+    Return the manifest for `path`, hashing the file only if the on-disk cache is stale.
+
+    Cache entries are keyed by path and only reused when size, mtime and inode
+    still match the file, so any modification triggers a rehash. Files of at
+    least MIN_CHUNKED_FILE_SIZE bytes are also split into chunks.
+    """
+    stat = os.stat(path)
+    cache_path = _get_cache_path(path, cache_dir)
+    needs_chunks = stat.st_size >= MIN_CHUNKED_FILE_SIZE
+
+    cached = _read_cached_manifest(cache_path)
+    if (
+        cached is not None
+        and cached.path == path
+        and cached.piece_size == piece_size
+        and cached.matches_stat(stat)
+    ):
+        if cached.chunks is not None or not needs_chunks:
+            return cached
+        manifest = cached  # Cached before chunk lists were kept
+        manifest.chunks = chunk_file(path)
+    else:
+        manifest = Manifest(
+            path,
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+            piece_size,
+            hash_pieces(path, piece_size),
+            chunk_file(path) if needs_chunks else None,
+        )
+    try:
+        _write_cached_manifest(cache_path, manifest)
+    except OSError:
+        pass  # The cache is only an optimisation
+    return manifest
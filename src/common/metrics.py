@@ -0,0 +1,282 @@
+"""
+Process-wide transfer metrics.
+
+Counters, gauges and histograms are updated once per range, piece or query
+(never per chunk), so they stay on in the hot send and receive paths. They can
+be printed with the CLI `stats` command or scraped in the Prometheus text
+format from a local HTTP endpoint (see start_metrics_server).
+"""
+
+from typing import Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import threading
+
+METRICS_HOST = "127.0.0.1"  # The HTTP endpoint is only reachable locally
+LATENCY_BUCKETS = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+]
+
+
+class Counter:
+    """
+    A monotonically increasing value, one per combination of label values.
+
+    Attributes:
+        name (str): Metric name as exported to Prometheus.
+        help (str): One-line description.
+        labelnames (tuple): Names of the labels each sample is keyed by.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels: tuple = ()) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def get_samples(self) -> List[tuple]:
+        """Return (suffix, labels, value) for every sample to export."""
+        with self._lock:
+            return [("", labels, value) for labels, value in self._values.items()]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(Counter):
+    """A value that can go up and down, such as the number of active transfers."""
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets.
+
+    Attributes:
+        name (str): Metric name as exported to Prometheus.
+        help (str): One-line description.
+        labelnames (tuple): Names of the labels each distribution is keyed by.
+        buckets (List[float]): Upper bounds of the buckets, ascending.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple = (),
+        buckets: List[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [per-bucket counts (+inf last), count, sum]
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def get_count(self, labels: tuple = ()) -> int:
+        with self._lock:
+            entry = self._values.get(labels)
+            return entry[1] if entry else 0
+
+    def get_label_sets(self) -> List[tuple]:
+        with self._lock:
+            return sorted(self._values)
+
+    def get_quantile(self, quantile: float, labels: tuple = ()) -> Optional[float]:
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        with self._lock:
+            entry = self._values.get(labels)
+            if not entry or not entry[1]:
+                return None
+            target = quantile * entry[1]
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry[0]):
+                cumulative += count
+                if cumulative >= target:
+                    return bound
+            return float("inf")
+
+    def get_samples(self) -> List[tuple]:
+        samples = []
+        with self._lock:
+            for labels, (counts, total, value_sum) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + [float("inf")], counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append(("_bucket", labels + (("le", le),), cumulative))
+                samples.append(("_count", labels, total))
+                samples.append(("_sum", labels, value_sum))
+        return samples
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+REGISTRY: List = []
+
+BYTES_SENT = Counter(
+    "lanp2p_bytes_sent_total", "File bytes served to each peer.", ("peer",)
+)
+BYTES_RECEIVED = Counter(
+    "lanp2p_bytes_received_total",
+    "Verified file bytes downloaded from each peer.",
+    ("peer",),
+)
+ACTIVE_TRANSFERS = Gauge(
+    "lanp2p_active_transfers",
+    "Ranges being uploaded and peers being downloaded from.",
+    ("direction",),
+)
+PIECE_LATENCY = Histogram(
+    "lanp2p_piece_latency_seconds",
+    "Time from requesting a piece to having it verified.",
+)
+HASH_TIME = Histogram(
+    "lanp2p_hash_seconds",
+    "Time spent hashing, per downloaded piece or per built manifest.",
+    ("stage",),
+)
+SEARCH_RTT = Histogram(
+    "lanp2p_search_rtt_seconds", "Round-trip time of file search replies."
+)
+ERRORS = Counter("lanp2p_errors_total", "Errors by kind.", ("kind",))
+PIECE_CACHE_LOOKUPS = Counter(
+    "lanp2p_piece_cache_lookups_total",
+    "Served ranges looked up in the piece cache, by hit or miss.",
+    ("result",),
+)
+UPLOAD_THROTTLED = Counter(
+    "lanp2p_upload_throttled_seconds_total",
+    "Time uploads were held back by the upload rate limits.",
+)
+
+
+def _format_labels(labelnames: tuple, labels: tuple) -> str:
+    # Histogram buckets append ("le", bound) to the regular label values.
+    pairs = []
+    for i, value in enumerate(labels):
+        if isinstance(value, tuple):
+            pairs.append(value)
+        else:
+            pairs.append((labelnames[i], value))
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus() -> str:
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, labels, value in metric.get_samples():
+            label_text = _format_labels(metric.labelnames, labels)
+            lines.append(f"{metric.name}{suffix}{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def format_stats() -> str:
+    """Return a human-readable summary of the metrics for the CLI."""
+    lines = []
+    for metric in REGISTRY:
+        if isinstance(metric, Histogram):
+            for labels in metric.get_label_sets():
+                count = metric.get_count(labels)
+                p50 = metric.get_quantile(0.5, labels)
+                p99 = metric.get_quantile(0.99, labels)
+                label_text = _format_labels(metric.labelnames, labels)
+                lines.append(
+                    f"{metric.name}{label_text}: count={count} "
+                    f"p50<={p50 * 1000:g}ms p99<={p99 * 1000:g}ms"
+                )
+        else:
+            for _, labels, value in sorted(metric.get_samples()):
+                label_text = _format_labels(metric.labelnames, labels)
+                lines.append(f"{metric.name}{label_text}: {value:.15g}")
+    return "\n".join(lines) if lines else "No activity recorded yet."
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would flood the CLI
+
+
+def start_metrics_server(port: int, host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """
+    Serve /metrics in the Prometheus text format from a daemon thread.
+
+    Call shutdown() and server_close() on the returned server to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    )
+    thread.start()
+    return server
@@ -0,0 +1,301 @@
+"""
+Binary wire format shared by peer discovery (UDP) and file transfer (TCP).
+
+Every message starts with a fixed 16-byte header:
+
+    version (u8) | type (u8) | flags (u16) | request ID (u32) | payload length (u64)
+
+followed by `length` bytes of payload. All integers are big-endian, and sizes
+and offsets are 64-bit. Parsers dispatch on the type byte and unpack payloads
+with precompiled structs, only decoding file names when a message carries one.
+"""
+
+from typing import List, Optional
+import struct
+
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct("!BBHIQ")
+HEADER_SIZE = HEADER.size
+
+# Discovery messages (UDP)
+MSG_HELLO = 1  # payload: file request port, catalog version
+MSG_FILE_QUERY = 2  # payload: file name
+MSG_FILE_AVAILABLE = 3  # payload: size, optional 32-byte root hash
+MSG_FILE_NOT_AVAILABLE = 4  # no payload
+MSG_CATALOG_REQUEST = 5  # payload: since version, optional datagram numbers
+MSG_CATALOG = 6  # payload: version, since, seq, total, JSON items
+
+# File transfer messages (TCP)
+MSG_RANGE_REQUEST = 16  # payload: start, end, file name; flags: compression wanted
+MSG_RANGE_DATA = 17  # payload: the bytes of the range; flags: compression used
+MSG_RANGE_DIGEST = 18  # payload: 32-byte SHA-256 of the range
+MSG_ERROR = 19  # payload: error code
+MSG_MANIFEST_REQUEST = 20  # payload: file name
+MSG_MANIFEST = 21  # payload: piece size, 32-byte hash of each piece
+MSG_CHUNKS_REQUEST = 22  # payload: file name
+MSG_CHUNKS = 23  # payload: length and 32-byte hash of each content-defined chunk
+
+# Compression codecs, carried in the low flag bits of RANGE_REQUEST (what the
+# client accepts) and RANGE_DATA (what the server actually used). Each range is
+# compressed on its own, and its digest is always of the uncompressed bytes.
+COMPRESSION_MASK = 0x3
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+COMPRESSION_NAMES = {
+    "none": COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "lzma": COMPRESSION_LZMA,
+}
+
+# Error codes carried by MSG_ERROR
+ERR_NOT_FOUND = 1
+ERR_INVALID_RANGE = 2
+ERR_INVALID_REQUEST = 3
+ERR_INTERNAL = 4
+
+ERROR_NAMES = {
+    ERR_NOT_FOUND: "FILE_NOT_FOUND",
+    ERR_INVALID_RANGE: "INVALID_RANGE",
+    ERR_INVALID_REQUEST: "INVALID_REQUEST",
+    ERR_INTERNAL: "ERROR",
+}
+
+DIGEST_SIZE = 32
+
+# File names of this form in FILE_QUERY, RANGE_REQUEST and MANIFEST_REQUEST
+# address a file by the root hash of its manifest instead of by basename.
+CONTENT_NAME_PREFIX = "sha256:"
+
+_HELLO = struct.Struct("!HQ")
+_SIZE = struct.Struct("!Q")
+_RANGE = struct.Struct("!QQ")
+_SINCE = struct.Struct("!q")
+_SEQ = struct.Struct("!H")
+_CATALOG = struct.Struct("!QqHH")
+_ERROR = struct.Struct("!B")
+_CHUNK = struct.Struct(f"!I{DIGEST_SIZE}s")
+
+
+class ProtocolError(ConnectionError):
+    """
+    Raised when a peer sends bytes that are not a valid message.
+
+    On a TCP connection this means the stream can no longer be trusted, so it
+    is a ConnectionError like any other broken connection.
+    """
+
+
+def _unpack(layout: struct.Struct, payload, offset: int = 0) -> tuple:
+    try:
+        return layout.unpack_from(payload, offset)
+    except struct.error as e:
+        raise ProtocolError(f"truncated payload: {e}") from None
+
+
+def _decode_name(payload) -> str:
+    try:
+        return bytes(payload).decode()
+    except UnicodeDecodeError:
+        raise ProtocolError("file name is not valid UTF-8") from None
+
+
+def pack_header(msg_type: int, request_id: int, length: int, flags: int = 0) -> bytes:
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, request_id, length)
+
+
+def pack_message(
+    msg_type: int, request_id: int = 0, payload: bytes = b"", flags: int = 0
+) -> bytes:
+    return pack_header(msg_type, request_id, len(payload), flags) + payload
+
+
+def unpack_header(data) -> tuple:
+    """Return (type, flags, request ID, payload length) from the start of `data`."""
+    if len(data) < HEADER_SIZE:
+        raise ProtocolError("truncated header")
+    version, msg_type, flags, request_id, length = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    return msg_type, flags, request_id, length
+
+
+def parse_datagram(data: bytes) -> tuple:
+    """Return (type, flags, request ID, payload) for a complete UDP message."""
+    msg_type, flags, request_id, length = unpack_header(data)
+    payload = memoryview(data)[HEADER_SIZE:]
+    if len(payload) != length:
+        raise ProtocolError("payload length mismatch")
+    return msg_type, flags, request_id, payload
+
+
+def pack_hello(port: int, catalog_version: int) -> bytes:
+    return pack_message(MSG_HELLO, 0, _HELLO.pack(port, catalog_version))
+
+
+def unpack_hello(payload) -> tuple:
+    """Return (file request port, catalog version)."""
+    return _unpack(_HELLO, payload)
+
+
+def pack_file_query(request_id: int, file_name: str) -> bytes:
+    return pack_message(MSG_FILE_QUERY, request_id, file_name.encode())
+
+
+def unpack_file_query(payload) -> str:
+    return _decode_name(payload)
+
+
+def pack_file_available(
+    request_id: int, size: int, root_hash: Optional[str] = None
+) -> bytes:
+    payload = _SIZE.pack(size)
+    if root_hash:
+        payload += bytes.fromhex(root_hash)
+    return pack_message(MSG_FILE_AVAILABLE, request_id, payload)
+
+
+def unpack_file_available(payload) -> tuple:
+    """Return (size, hex root hash or None)."""
+    (size,) = _unpack(_SIZE, payload)
+    root_hash = payload[_SIZE.size : _SIZE.size + DIGEST_SIZE]
+    return size, bytes(root_hash).hex() if len(root_hash) == DIGEST_SIZE else None
+
+
+def make_content_name(root_hash: str) -> str:
+    return CONTENT_NAME_PREFIX + root_hash
+
+
+def parse_content_name(file_name: str) -> Optional[str]:
+    """Return the root hash a content name refers to, or None for a plain name."""
+    if not file_name.startswith(CONTENT_NAME_PREFIX):
+        return None
+    root_hash = file_name[len(CONTENT_NAME_PREFIX) :]
+    try:
+        if len(bytes.fromhex(root_hash)) == DIGEST_SIZE:
+            return root_hash.lower()
+    except ValueError:
+        pass
+    return None
+
+
+def pack_catalog_request(since: int, seqs: List[int] = ()) -> bytes:
+    payload = _SINCE.pack(since) + b"".join(_SEQ.pack(seq) for seq in seqs)
+    return pack_message(MSG_CATALOG_REQUEST, 0, payload)
+
+
+def unpack_catalog_request(payload) -> tuple:
+    """Return (since, datagram numbers requested, empty for all)."""
+    (since,) = _unpack(_SINCE, payload)
+    seqs = payload[_SINCE.size :]
+    if len(seqs) % _SEQ.size:
+        raise ProtocolError("truncated datagram list")
+    return since, [seq for (seq,) in _SEQ.iter_unpack(seqs)]
+
+
+def pack_catalog(version: int, since: int, seq: int, total: int, items: bytes) -> bytes:
+    return pack_message(
+        MSG_CATALOG, 0, _CATALOG.pack(version, since, seq, total) + items
+    )
+
+
+def unpack_catalog(payload) -> tuple:
+    """Return (version, since, seq, total, JSON items as bytes)."""
+    version, since, seq, total = _unpack(_CATALOG, payload)
+    if seq >= total:
+        raise ProtocolError(f"catalog datagram {seq} of {total}")
+    return version, since, seq, total, bytes(payload[_CATALOG.size :])
+
+
+def pack_range_request(
+    request_id: int, file_name: str, start: int, end: int, flags: int = 0
+) -> bytes:
+    payload = _RANGE.pack(start, end) + file_name.encode()
+    return pack_message(MSG_RANGE_REQUEST, request_id, payload, flags)
+
+
+def unpack_range_request(payload) -> tuple:
+    """Return (start, end, file name)."""
+    start, end = _unpack(_RANGE, payload)
+    return start, end, _decode_name(payload[_RANGE.size :])
+
+
+def pack_manifest_request(request_id: int, file_name: str) -> bytes:
+    return pack_message(MSG_MANIFEST_REQUEST, request_id, file_name.encode())
+
+
+def unpack_manifest_request(payload) -> str:
+    return _decode_name(payload)
+
+
+def pack_manifest(request_id: int, piece_size: int, piece_hashes: List[str]) -> bytes:
+    payload = _SIZE.pack(piece_size) + b"".join(
+        bytes.fromhex(piece_hash) for piece_hash in piece_hashes
+    )
+    return pack_message(MSG_MANIFEST, request_id, payload)
+
+
+def unpack_manifest(payload) -> tuple:
+    """Return (piece size, hex piece hashes)."""
+    (piece_size,) = _unpack(_SIZE, payload)
+    digests = payload[_SIZE.size :]
+    if len(digests) % DIGEST_SIZE:
+        raise ProtocolError("truncated piece hash")
+    piece_hashes = [
+        bytes(digests[i : i + DIGEST_SIZE]).hex()
+        for i in range(0, len(digests), DIGEST_SIZE)
+    ]
+    return piece_size, piece_hashes
+
+
+def pack_chunks_request(request_id: int, file_name: str) -> bytes:
+    return pack_message(MSG_CHUNKS_REQUEST, request_id, file_name.encode())
+
+
+def pack_chunk_list(chunks: List[tuple]) -> bytes:
+    """Pack (length, hex hash) chunks as in a CHUNKS payload."""
+    return b"".join(
+        _CHUNK.pack(length, bytes.fromhex(chunk_hash)) for length, chunk_hash in chunks
+    )
+
+
+def unpack_chunk_list(data) -> List[tuple]:
+    """Return (length, hex hash) of each chunk of a CHUNKS payload."""
+    if len(data) % _CHUNK.size:
+        raise ProtocolError("truncated chunk list")
+    return [(length, digest.hex()) for length, digest in _CHUNK.iter_unpack(data)]
+
+
+def pack_chunks(request_id: int, chunks: List[tuple]) -> bytes:
+    return pack_message(MSG_CHUNKS, request_id, pack_chunk_list(chunks))
+
+
+def pack_error(request_id: int, code: int) -> bytes:
+    return pack_message(MSG_ERROR, request_id, _ERROR.pack(code))
+
+
+def unpack_error(payload) -> int:
+    return _unpack(_ERROR, payload)[0]
+
+
+def read_exact(reader, size: int) -> bytes:
+    """Read exactly `size` bytes from a buffered reader, raising ConnectionError on EOF."""
+    data = reader.read(size)
+    if len(data) != size:
+        raise ConnectionError("connection closed mid-message")
+    return data
+
+
+def read_message(reader, max_payload: int) -> tuple:
+    """
+    Read one small message from a buffered reader.
+
+    Returns (type, flags, request ID, payload). Messages announcing more than
+    `max_payload` bytes are rejected, so bulk payloads must be read separately.
+    """
+    msg_type, flags, request_id, length = unpack_header(read_exact(reader, HEADER_SIZE))
+    if length > max_payload:
+        raise ProtocolError(f"message of {length} bytes exceeds {max_payload}")
+    return msg_type, flags, request_id, read_exact(reader, length)
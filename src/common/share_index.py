@@ -0,0 +1,130 @@
+"""
+On-disk share index, so a restarted node serves its files without sharing them again.
+
+Each shared file is a row with its path, size and modification time, plus its
+manifest with the piece hashes packed as raw digests. Startup reads only the
+small columns; a file's piece hashes are read the first time they are needed.
+"""
+
+from typing import List, Optional
+import os
+import sqlite3
+import threading
+from common.manifest import Manifest
+from common.protocol import DIGEST_SIZE, pack_chunk_list, unpack_chunk_list
+
+SHARE_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".lanp2p", "shares.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_files (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    root_hash TEXT,
+    inode INTEGER,
+    piece_size INTEGER,
+    piece_hashes BLOB,
+    chunks BLOB
+);
+CREATE INDEX IF NOT EXISTS shared_files_name ON shared_files (name);
+"""
+
+
+class ShareIndex:
+    """
+    SQLite store of the local share index.
+
+    Writes come from the CLI, server and hashing threads, so they share one
+    connection behind a lock. Entries passed in are SharedFile-like objects
+    with path, name, size, mtime_ns and manifest attributes.
+
+    Attributes:
+        path (str): Database file, or ":memory:".
+    """
+
+    def __init__(self, path: str = SHARE_INDEX_PATH) -> None:
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        columns = [
+            row[1] for row in self._conn.execute("PRAGMA table_info(shared_files)")
+        ]
+        if "chunks" not in columns:  # Created before chunk lists were kept
+            self._conn.execute("ALTER TABLE shared_files ADD COLUMN chunks BLOB")
+
+    def load_files(self) -> List[tuple]:
+        """Return (path, size, mtime_ns, root_hash) for every indexed file."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT path, size, mtime_ns, root_hash FROM shared_files"
+            ).fetchall()
+
+    def load_manifest(self, path: str) -> Optional[Manifest]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, inode, piece_size, piece_hashes, chunks"
+                " FROM shared_files WHERE path = ? AND piece_hashes IS NOT NULL",
+                (path,),
+            ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, inode, piece_size, packed, chunks = row
+        piece_hashes = [
+            packed[i : i + DIGEST_SIZE].hex()
+            for i in range(0, len(packed), DIGEST_SIZE)
+        ]
+        if chunks is not None:
+            chunks = unpack_chunk_list(chunks)
+        return Manifest(path, size, mtime_ns, inode, piece_size, piece_hashes, chunks)
+
+    def put_files(self, entries: list) -> None:
+        """Insert or update entries, dropping other files with the same basename."""
+        with self._lock, self._conn:
+            for entry in entries:
+                self._conn.execute(
+                    "DELETE FROM shared_files WHERE name = ? AND path != ?",
+                    (entry.name, entry.path),
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO shared_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [_to_row(entry) for entry in entries],
+            )
+
+    def remove_file(self, name: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM shared_files WHERE name = ?", (name,))
+
+    def replace_all(self, entries: list) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM shared_files")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO shared_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [_to_row(entry) for entry in entries],
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _to_row(entry) -> tuple:
+    manifest = entry.manifest
+    if manifest is None:
+        return (entry.path, entry.name, entry.size, entry.mtime_ns) + (None,) * 5
+    return (
+        entry.path,
+        entry.name,
+        manifest.size,
+        manifest.mtime_ns,
+        manifest.root_hash,
+        manifest.inode,
+        manifest.piece_size,
+        b"".join(bytes.fromhex(piece_hash) for piece_hash in manifest.piece_hashes),
+        pack_chunk_list(manifest.chunks) if manifest.chunks is not None else None,
+    )
@@ -0,0 +1,567 @@
+"""
+asyncio versions of the file server and the multi-peer downloader.
+
+They speak the same protocol as send_recv_tcp and share its request lookup,
+response checks, piece bookkeeping and Download setup, as well as its
+scheduler, resume state and limits. Only the I/O differs: every connection is
+a coroutine on one event loop instead of a thread, so idle keep-alive
+connections and queued transfers cost no OS threads.
+"""
+
+from typing import Optional
+import asyncio
+import hashlib
+import time
+from collections import deque
+from common.chunk_store import ChunkStore
+from common.debug_print import get_logger
+from common.control_block import ControlBlock
+from common.compression import decompress_into
+from common.manifest import PIECE_SIZE
+from common.metrics import (
+    ACTIVE_TRANSFERS,
+    BYTES_SENT,
+    ERRORS,
+    HASH_TIME,
+)
+from common.protocol import (
+    HEADER_SIZE,
+    DIGEST_SIZE,
+    MSG_RANGE_REQUEST,
+    MSG_RANGE_DATA,
+    MSG_RANGE_DIGEST,
+    MSG_ERROR,
+    MSG_MANIFEST_REQUEST,
+    MSG_CHUNKS_REQUEST,
+    ERR_NOT_FOUND,
+    ERR_INVALID_REQUEST,
+    ERR_INTERNAL,
+    ERROR_NAMES,
+    COMPRESSION_MASK,
+    COMPRESSION_NONE,
+    ProtocolError,
+    pack_header,
+    pack_message,
+    pack_error,
+    pack_range_request,
+    pack_manifest,
+    pack_chunks,
+    unpack_header,
+    unpack_range_request,
+    unpack_manifest_request,
+    unpack_error,
+)
+from file_share.connection_pool import CONNECT_TIMEOUT
+from file_share.download_state import DownloadState
+from file_share.piece_cache import PIECE_CACHE, PieceCache, read_range
+from file_share.piece_scheduler import PieceScheduler
+from file_share.rate_limiter import UploadLimiter
+from file_share.send_recv_tcp import (
+    CONNECTION_POOL,
+    MAX_CONCURRENT_TRANSFERS,
+    SERVER_BACKLOG,
+    CLIENT_TIMEOUT,
+    SEND_BUFFER_SIZE,
+    MAX_REQUEST_SIZE,
+    MAX_PEER_FAILURES,
+    PIPELINE_DEPTH,
+    RECV_CHUNK_SIZE,
+    Download,
+    check_range_digest,
+    check_range_header,
+    get_server_addr_from_peer_addr,
+    locate_range,
+    store_piece,
+)
+from peer_discovery.discovery import MY_SERVER_PORT
+
+LOGGER = get_logger("transfer")
+
+# Errors after which a connection's stream can no longer be trusted
+CONNECTION_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+
+
+async def read_message(reader: asyncio.StreamReader, max_payload: int) -> tuple:
+    """Read one small message, as protocol.read_message does for blocking readers."""
+    msg_type, flags, request_id, length = unpack_header(
+        await reader.readexactly(HEADER_SIZE)
+    )
+    if length > max_payload:
+        raise ProtocolError(f"message of {length} bytes exceeds {max_payload}")
+    return msg_type, flags, request_id, await reader.readexactly(length)
+
+
+async def _throttle(limiter: UploadLimiter, peer_ip: str, amount: int) -> None:
+    delay = limiter.reserve(peer_ip, amount)
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def send_file(
+    cb: ControlBlock,
+    writer: asyncio.StreamWriter,
+    file_name,
+    start,
+    end,
+    request_id,
+    peer_ip: str = "",
+    compression: int = COMPRESSION_NONE,
+    limiter: UploadLimiter = None,
+    cache: PieceCache = PIECE_CACHE,
+) -> bool:
+    """
+    Send one range of a file, as send_recv_tcp.send_file does.
+
+    The file and its manifest are looked up in the default executor (see
+    send_recv_tcp.locate_range). Whole pieces with a manifest hash go out
+    with loop.sendfile (zero-copy where the platform allows). Ranges sent
+    compressed, and other ranges while `cache` is enabled, are read,
+    compressed or hashed in the default executor, or served from `cache`
+    (see piece_cache.read_range). Anything else is read and hashed chunk by
+    chunk, waiting for the socket to drain before reading the next chunk.
+    With a `limiter` that has limits set, data goes out in quanta that each
+    wait for their turn. Returns False if the connection can no longer be used.
+    """
+    loop = asyncio.get_running_loop()
+    throttled = limiter is not None and limiter.is_limited
+    chunk_size = limiter.quantum if throttled else SEND_BUFFER_SIZE
+    streaming = False
+    try:
+        error, file_path, segment_hash = await loop.run_in_executor(
+            None, locate_range, cb, file_name, start, end
+        )
+        if error is not None:
+            writer.write(pack_error(request_id, error))
+            await writer.drain()
+            return True
+
+        with open(file_path, "rb") as file:
+            in_memory = None
+            if compression != COMPRESSION_NONE or segment_hash is None:
+                in_memory = await loop.run_in_executor(
+                    None,
+                    read_range,
+                    cache,
+                    file_path,
+                    file,
+                    start,
+                    end - start,
+                    compression,
+                    segment_hash,
+                )
+
+            streaming = True
+            ACTIVE_TRANSFERS.inc(1, ("upload",))
+            if in_memory is not None:
+                codec, payload, digest = in_memory
+                writer.write(
+                    pack_header(MSG_RANGE_DATA, request_id, len(payload), codec)
+                )
+                view = memoryview(payload)
+                for offset in range(0, len(view), chunk_size):
+                    chunk = view[offset : offset + chunk_size]
+                    if throttled:
+                        await _throttle(limiter, peer_ip, len(chunk))
+                    writer.write(chunk)
+                    await writer.drain()
+
+            elif segment_hash is not None:
+                writer.write(pack_header(MSG_RANGE_DATA, request_id, end - start))
+                if throttled:
+                    for offset in range(start, end, chunk_size):
+                        count = min(chunk_size, end - offset)
+                        await _throttle(limiter, peer_ip, count)
+                        await loop.sendfile(writer.transport, file, offset, count)
+                else:
+                    await loop.sendfile(writer.transport, file, start, end - start)
+                digest = bytes.fromhex(segment_hash)
+            else:
+                writer.write(pack_header(MSG_RANGE_DATA, request_id, end - start))
+                hasher = hashlib.sha256()
+                file.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    chunk = file.read(min(chunk_size, remaining))
+                    if not chunk:
+                        raise EOFError("file shrank while sending")
+                    if throttled:
+                        await _throttle(limiter, peer_ip, len(chunk))
+                    hasher.update(chunk)
+                    writer.write(chunk)
+                    remaining -= len(chunk)
+                    await writer.drain()
+                digest = hasher.digest()
+
+        writer.write(pack_message(MSG_RANGE_DIGEST, request_id, digest))
+        await writer.drain()
+        BYTES_SENT.inc(end - start, (peer_ip,))
+        return True
+
+    except Exception as e:
+        LOGGER.warning("Error sending file: %s", e)
+        ERRORS.inc(1, ("send",))
+        if streaming:
+            return False  # The client cannot tell where the segment stopped
+        try:
+            writer.write(pack_error(request_id, ERR_INTERNAL))
+            await writer.drain()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    finally:
+        if streaming:
+            ACTIVE_TRANSFERS.dec(1, ("upload",))
+
+
+async def send_manifest(
+    cb: ControlBlock,
+    writer: asyncio.StreamWriter,
+    file_name,
+    request_id,
+    chunks: bool = False,
+) -> bool:
+    loop = asyncio.get_running_loop()
+    try:
+        # Manifests may be read from the share index, so keep it off the loop.
+        manifest = await loop.run_in_executor(None, cb.get_manifest, file_name, True)
+        if manifest is None or (chunks and manifest.chunks is None):
+            response = pack_error(request_id, ERR_NOT_FOUND)
+        elif chunks:
+            response = pack_chunks(request_id, manifest.chunks)
+        else:
+            response = pack_manifest(
+                request_id, manifest.piece_size, manifest.piece_hashes
+            )
+    except Exception as e:
+        LOGGER.warning("Error building manifest of %s: %s", file_name, e)
+        response = pack_error(request_id, ERR_INTERNAL)
+
+    try:
+        writer.write(response)
+        await writer.drain()
+        return True
+    except CONNECTION_ERRORS:
+        return False
+
+
+class AsyncFileServer:
+    """
+    Serves range, manifest and chunk list requests on the running event loop.
+
+    At most `max_transfers` responses are streamed at once; further requests
+    wait for a slot, and while they wait their connection is not read from,
+    so TCP flow control pushes back on the clients. Idle keep-alive
+    connections hold no slot.
+
+    Attributes:
+        cb (ControlBlock): Source of the shared files.
+        port (int): Port to listen on.
+        limiter (UploadLimiter): Upload rate limits, or None for none.
+    """
+
+    def __init__(
+        self,
+        cb: ControlBlock,
+        port: int = MY_SERVER_PORT,
+        max_transfers: int = MAX_CONCURRENT_TRANSFERS,
+        backlog: int = SERVER_BACKLOG,
+        limiter: UploadLimiter = None,
+    ) -> None:
+        self.cb = cb
+        self.port = port
+        self.backlog = backlog
+        self.limiter = limiter
+        self._slots = asyncio.Semaphore(max_transfers)
+        self._server = None
+        self._closing = False
+        self._connections = {}  # Handler task -> (writer, whether mid-response)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self._handle_client,
+            port=self.port,
+            backlog=self.backlog,
+            reuse_address=True,
+            reuse_port=True,
+        )
+        LOGGER.debug("Async file server listening on port %s", self.port)
+
+    def is_serving(self) -> bool:
+        return self._server is not None and self._server.is_serving()
+
+    async def close(self) -> None:
+        """Stop accepting, drop idle connections and let in-flight responses finish."""
+        self._closing = True
+        self._server.close()
+        for writer, busy in list(self._connections.values()):
+            if not busy:
+                writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        LOGGER.debug("Async file server stopped")
+
+    async def _handle_client(self, reader, writer) -> None:
+        task = asyncio.current_task()
+        client_address = writer.get_extra_info("peername")
+        request_id = 0
+        try:
+            while not self._closing:
+                self._connections[task] = (writer, False)
+                try:
+                    msg_type, flags, request_id, payload = await asyncio.wait_for(
+                        read_message(reader, MAX_REQUEST_SIZE), CLIENT_TIMEOUT
+                    )
+                    if msg_type == MSG_RANGE_REQUEST:
+                        start, end, file_name = unpack_range_request(payload)
+                    elif msg_type in (MSG_MANIFEST_REQUEST, MSG_CHUNKS_REQUEST):
+                        file_name = unpack_manifest_request(payload)
+                    else:
+                        raise ProtocolError(f"unexpected message type {msg_type}")
+                except ProtocolError as e:
+                    LOGGER.debug("Invalid request from %s: %s", client_address, e)
+                    ERRORS.inc(1, ("protocol",))
+                    writer.write(pack_error(request_id, ERR_INVALID_REQUEST))
+                    await writer.drain()
+                    break
+
+                self._connections[task] = (writer, True)
+                async with self._slots:
+                    if msg_type in (MSG_MANIFEST_REQUEST, MSG_CHUNKS_REQUEST):
+                        keep_alive = await send_manifest(
+                            self.cb,
+                            writer,
+                            file_name,
+                            request_id,
+                            chunks=msg_type == MSG_CHUNKS_REQUEST,
+                        )
+                    else:
+                        keep_alive = await send_file(
+                            self.cb,
+                            writer,
+                            file_name,
+                            start,
+                            end,
+                            request_id,
+                            peer_ip=client_address[0],
+                            compression=flags & COMPRESSION_MASK,
+                            limiter=self.limiter,
+                        )
+                if not keep_alive:
+                    break
+
+        except CONNECTION_ERRORS:
+            pass  # Closed by the client, timed out or dropped on shutdown
+        except Exception as e:
+            LOGGER.warning("Error handling request from %s: %s", client_address, e)
+
+        finally:
+            LOGGER.debug("Closing connection from %s", client_address)
+            self._connections.pop(task, None)
+            writer.close()
+
+
+async def read_range_response(
+    reader: asyncio.StreamReader,
+    buffer: memoryview,
+    request_id: int,
+    expected_digest: bytes = None,
+) -> bool:
+    """Read and verify the response to a range request, as in send_recv_tcp."""
+    msg_type, codec, length = check_range_header(
+        await reader.readexactly(HEADER_SIZE), request_id, len(buffer)
+    )
+    if msg_type == MSG_ERROR:
+        code = unpack_error(await reader.readexactly(length))
+        LOGGER.debug("Peer answered %s", ERROR_NAMES.get(code, code))
+        return False
+
+    hasher = hashlib.sha256()
+    hash_time = 0.0
+    if codec != COMPRESSION_NONE:
+        payload = await reader.readexactly(length)
+        decoded = await asyncio.get_running_loop().run_in_executor(
+            None, decompress_into, codec, payload, buffer
+        )
+        if decoded:
+            hash_start = time.perf_counter()
+            hasher.update(buffer)
+            hash_time = time.perf_counter() - hash_start
+    else:
+        decoded = True
+        received = 0
+        while received < len(buffer):
+            chunk = await reader.readexactly(
+                min(RECV_CHUNK_SIZE, len(buffer) - received)
+            )
+            hash_start = time.perf_counter()
+            hasher.update(chunk)
+            hash_time += time.perf_counter() - hash_start
+            buffer[received : received + len(chunk)] = chunk
+            received += len(chunk)
+
+    HASH_TIME.observe(hash_time, ("download",))
+    return check_range_digest(
+        await read_message(reader, DIGEST_SIZE),
+        request_id,
+        hasher.digest() if decoded else None,
+        expected_digest,
+    )
+
+
+async def _notify(changed: asyncio.Condition) -> None:
+    async with changed:
+        changed.notify_all()
+
+
+async def _download_pieces_from_peer(
+    peer: tuple,
+    file_name: str,
+    output_fd: int,
+    scheduler: PieceScheduler,
+    changed: asyncio.Condition,
+    state: DownloadState = None,
+    compression: int = COMPRESSION_NONE,
+):
+    """
+    Coroutine counterpart of send_recv_tcp._download_pieces_from_peer.
+
+    The scheduler is only ever asked for work without blocking; a worker with
+    nothing to do waits on `changed`, which is notified whenever a piece
+    completes or fails.
+    """
+    address = get_server_addr_from_peer_addr(peer[0], peer[1])
+    buffer = memoryview(bytearray(scheduler.piece_size))
+    requested = deque()  # Pieces requested on the connection, in order
+    requested_at = {}  # Piece index -> time its request was written
+    reader = writer = None
+    failures = 0
+
+    ACTIVE_TRANSFERS.inc(1, ("download",))
+    try:
+        while failures < MAX_PEER_FAILURES:
+            try:
+                while len(requested) < PIPELINE_DEPTH:
+                    index = scheduler.next_piece(wait=False, exclude=requested)
+                    if index is None:
+                        break
+                    requested.append(index)
+                    if writer is None:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(*address), CONNECT_TIMEOUT
+                        )
+                    start, end = scheduler.get_piece_range(index)
+                    writer.write(
+                        pack_range_request(index, file_name, start, end, compression)
+                    )
+                    requested_at[index] = time.monotonic()
+
+                if not requested:
+                    if not scheduler.has_pieces_in_flight():
+                        return
+                    async with changed:
+                        await changed.wait()  # End game: wait for other workers
+                    continue
+
+                await writer.drain()
+                start, end = scheduler.get_piece_range(requested[0])
+                piece = buffer[: end - start]
+                expected = state.get_piece_digest(requested[0]) if state else None
+                verified = await asyncio.wait_for(
+                    read_range_response(reader, piece, requested[0], expected),
+                    CLIENT_TIMEOUT,
+                )
+                index = requested.popleft()
+
+            except CONNECTION_ERRORS as e:
+                LOGGER.warning("Error receiving %s from %s: %r", file_name, peer, e)
+                ERRORS.inc(1, ("receive",))
+                while requested:
+                    scheduler.fail_piece(requested.popleft())
+                if writer is not None:
+                    writer.close()
+                    reader = writer = None
+                failures += 1
+                await _notify(changed)
+                continue
+
+            # A single pwrite into the page cache; cheap enough for the loop.
+            stored = store_piece(
+                peer,
+                file_name,
+                output_fd,
+                scheduler,
+                state,
+                index,
+                piece,
+                verified,
+                requested_at.pop(index),
+            )
+            await _notify(changed)
+            if stored is None:
+                return
+            failures = 0 if stored else failures + 1
+
+        LOGGER.warning(
+            "Giving up on %s after %s failed segments.", peer, MAX_PEER_FAILURES
+        )
+
+    finally:
+        ACTIVE_TRANSFERS.dec(1, ("download",))
+        while requested:
+            scheduler.fail_piece(requested.popleft())
+        if writer is not None:
+            writer.close()
+        await _notify(changed)
+
+
+async def receive_file_from_peers(
+    peers: list,
+    file_name: str,
+    piece_size: int = PIECE_SIZE,
+    resume: bool = False,
+    compression: int = COMPRESSION_NONE,
+    root_hash: Optional[str] = None,
+    chunk_store: Optional[ChunkStore] = None,
+) -> bool:
+    """
+    Download a file from several peers on the running event loop.
+
+    Behaves like send_recv_tcp.receive_file_from_peers, with one coroutine
+    instead of one thread per peer.
+    """
+    # Fetching piece hashes and chunk lists and re-hashing pieces on disk block.
+    loop = asyncio.get_running_loop()
+    download = await loop.run_in_executor(
+        None,
+        Download.prepare,
+        peers,
+        file_name,
+        piece_size,
+        CONNECTION_POOL,
+        resume,
+        root_hash,
+        chunk_store,
+    )
+    if download is None:
+        return False
+
+    try:
+        changed = asyncio.Condition()
+        await asyncio.gather(
+            *(
+                _download_pieces_from_peer(
+                    peer,
+                    download.request_name,
+                    download.output_fd,
+                    download.scheduler,
+                    changed,
+                    download.state,
+                    compression,
+                )
+                for peer, *_ in peers
+            )
+        )
+    finally:
+        complete = await loop.run_in_executor(None, download.finish)
+    return complete
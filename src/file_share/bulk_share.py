@@ -0,0 +1,213 @@
+"""
+Sharing whole directory trees.
+
+A share job walks the tree with os.scandir and adds files to the ControlBlock
+in batches as it finds them. The files can be searched for and served right
+away. Their manifests are hashed afterwards in worker processes, so hashing
+a large tree keeps neither the CLI nor discovery waiting.
+
+A revalidation job does the same for files loaded from the share index at
+startup, hashing only those that changed while the node was down.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Iterator, List, Optional
+import multiprocessing
+import os
+import threading
+import time
+from common.control_block import ControlBlock
+from common.manifest import MANIFEST_CACHE_DIR, PIECE_SIZE, load_manifest
+from common.debug_print import get_logger
+
+LOGGER = get_logger("share")
+
+INDEX_BATCH_SIZE = 512  # Files added to the ControlBlock per lock acquisition
+PENDING_PER_WORKER = 4  # Hash jobs queued per worker process
+PROGRESS_INTERVAL = 5.0  # Seconds between progress log lines
+
+
+def scan_files(root: str) -> Iterator[tuple]:
+    """
+    Yield (path, os.stat_result) for every regular file under `root`.
+
+    Symbolic links are skipped so the walk cannot leave the tree or loop, and
+    directories that cannot be read are logged and skipped.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.path, entry.stat(follow_symlinks=False)
+                    except OSError as e:
+                        LOGGER.warning("Skipping '%s': %s", entry.path, e)
+        except OSError as e:
+            LOGGER.warning("Skipping directory '%s': %s", directory, e)
+
+
+class ShareJob:
+    """
+    Shares every file under a directory, indexing first and hashing in the background.
+
+    Attributes:
+        root (str): Absolute path of the shared directory.
+        workers (int): Number of hashing processes.
+        indexed (int): Files added to the ControlBlock so far.
+        hashed (int): Files whose manifests have been built.
+        failed (int): Files that could not be hashed.
+        scan_done (bool): Whether the walk has finished and `indexed` is final.
+    """
+
+    def __init__(
+        self,
+        control_blk: ControlBlock,
+        root: str,
+        workers: Optional[int] = None,
+        piece_size: int = PIECE_SIZE,
+        cache_dir: str = MANIFEST_CACHE_DIR,
+        batch_size: int = INDEX_BATCH_SIZE,
+    ) -> None:
+        self.root = os.path.abspath(root)
+        self.workers = workers or os.cpu_count() or 1
+        self.indexed = 0
+        self.hashed = 0
+        self.failed = 0
+        self.scan_done = False
+        self._control_blk = control_blk
+        self._piece_size = piece_size
+        self._cache_dir = cache_dir
+        self._batch_size = batch_size
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+        self._started_at = 0.0
+        self._finished_at: Optional[float] = None
+        self._last_report = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._started_at = self._last_report = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, name=f"share-{os.path.basename(self.root)}", daemon=True
+        )
+        self._thread.start()
+
+    def cancel(self) -> None:
+        """Stop after the files currently being hashed; the index keeps what was added."""
+        self._cancelled.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    @property
+    def is_done(self) -> bool:
+        return self._finished.is_set()
+
+    def get_progress(self) -> str:
+        total = str(self.indexed) if self.scan_done else f"{self.indexed}+"
+        status = (
+            "done" if self.is_done else "scanning" if not self.scan_done else "hashing"
+        )
+        elapsed = (self._finished_at or time.monotonic()) - self._started_at
+        line = f"'{self.root}': {self.hashed}/{total} files hashed"
+        if self.failed:
+            line += f", {self.failed} failed"
+        return f"{line} ({status}, {elapsed:.1f}s)"
+
+    def _run(self) -> None:
+        try:
+            paths = self._index()
+            self.scan_done = True
+            if paths and not self._cancelled.is_set():
+                self._hash(paths)
+        except Exception as e:
+            LOGGER.warning("Sharing '%s' failed: %s", self.root, e)
+        finally:
+            self.scan_done = True
+            self._finished_at = time.monotonic()
+            self._finished.set()
+        LOGGER.info("Shared %s", self.get_progress())
+
+    def _index(self) -> List[str]:
+        """Add every file to the ControlBlock and return their paths."""
+        paths = []
+        batch = []
+        for item in scan_files(self.root):
+            batch.append(item)
+            if len(batch) >= self._batch_size:
+                paths.extend(self._add_batch(batch))
+                batch = []
+                if self._cancelled.is_set():
+                    return paths
+        if batch:
+            paths.extend(self._add_batch(batch))
+        LOGGER.info("Indexed %d files under '%s'", self.indexed, self.root)
+        return paths
+
+    def _add_batch(self, batch: List[tuple]) -> List[str]:
+        self._control_blk.add_files(batch)
+        self.indexed += len(batch)
+        return [path for path, _ in batch]
+
+    def _hash(self, paths: List[str]) -> None:
+        # Spawned rather than forked: the parent has discovery and server threads
+        # that may hold locks at the moment of a fork.
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.workers, mp_context=context) as executor:
+            pending = {}  # future -> path
+            for path in paths:
+                if self._cancelled.is_set():
+                    break
+                if len(pending) >= self.workers * PENDING_PER_WORKER:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done, pending)
+                future = executor.submit(
+                    load_manifest, path, self._piece_size, self._cache_dir
+                )
+                pending[future] = path
+            if self._cancelled.is_set():
+                for future in pending:
+                    future.cancel()
+            self._collect(wait(pending).done, pending)
+
+    def _collect(self, futures, pending: dict) -> None:
+        for future in futures:
+            path = pending.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                manifest = future.result()
+            except Exception as e:
+                self.failed += 1
+                LOGGER.warning("Could not hash '%s': %s", path, e)
+                continue
+            self._control_blk.set_manifest(manifest)
+            self.hashed += 1
+
+        now = time.monotonic()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            LOGGER.info("Sharing %s", self.get_progress())
+
+
+class RevalidateJob(ShareJob):
+    """
+    Checks files loaded from the share index against the disk and rehashes changed ones.
+
+    Unchanged files are served from the index as they are, so `indexed` here
+    counts only the files that need hashing.
+    """
+
+    def __init__(self, control_blk: ControlBlock, **kwargs) -> None:
+        super().__init__(control_blk, control_blk.share_index.path, **kwargs)
+
+    def _index(self) -> List[str]:
+        paths = self._control_blk.revalidate_files()
+        self.indexed = len(paths)
+        LOGGER.info("%d shared files need hashing since the last run", self.indexed)
+        return paths
@@ -0,0 +1,87 @@
+from typing import Dict, List
+import socket
+import threading
+import time
+
+CONNECT_TIMEOUT = 30  # Seconds to wait for connects and reads on pooled sockets
+MAX_IDLE_PER_PEER = 4  # Idle connections kept open to each peer
+IDLE_TIMEOUT = 20  # Seconds an idle connection is kept (below the server's 30 s)
+
+
+class PeerConnection:
+    """
+    A keep-alive TCP connection to a peer's file server.
+
+    Attributes:
+        address (tuple): (ip, port) of the peer's file server.
+        sock (socket.socket): The connected socket, used for sending requests.
+        reader (io.BufferedReader): Buffered reader over `sock` for parsing responses.
+        last_used (float): time.monotonic() when the connection was last released.
+    """
+
+    def __init__(self, address: tuple, sock: socket.socket) -> None:
+        self.address = address
+        self.sock = sock
+        self.reader = sock.makefile("rb")
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """
+    Reusable connections to peers' file servers, keyed by server address.
+
+    Callers acquire a connection, run any number of (pipelined) requests on
+    it and release it when the stream is back at a request boundary. A
+    connection whose stream may be out of sync must be closed instead.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_peer: int = MAX_IDLE_PER_PEER,
+        idle_timeout: float = IDLE_TIMEOUT,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ) -> None:
+        self.max_idle_per_peer = max_idle_per_peer
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._idle: Dict[tuple, List[PeerConnection]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, address: tuple) -> PeerConnection:
+        """Return an idle connection to `address`, or open a new one."""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = self._idle.get(address, [])
+            while idle:
+                connection = idle.pop()
+                if connection.last_used >= cutoff:
+                    return connection
+                connection.close()  # The server may already have dropped it
+
+        sock = socket.create_connection(address, timeout=self.connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return PeerConnection(address, sock)
+
+    def release(self, connection: PeerConnection) -> None:
+        """Return a connection whose last response was fully read."""
+        connection.last_used = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(connection.address, [])
+            if len(idle) < self.max_idle_per_peer:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
@@ -0,0 +1,153 @@
+from typing import List, Optional
+import hashlib
+import json
+import os
+
+STATE_SUFFIX = ".state"  # Appended to the output path for the sidecar file
+VERIFY_READ_SIZE = 1024 * 1024  # Read size while re-verifying pieces
+
+
+class DownloadState:
+    """
+    Progress of a resumable download, persisted in a sidecar file next to the output.
+
+    The sidecar holds one line of JSON metadata (file size, piece size, piece
+    hashes and the source's root hash) followed by one byte per piece, set to
+    1 once the piece has been written. Completing a piece only rewrites its
+    byte, so progress is saved cheaply after every piece.
+
+    Attributes:
+        path (str): Path of the sidecar file.
+        file_name (str): Name of the file being downloaded.
+        file_size (int): Size of the file being downloaded.
+        piece_size (int): Bytes per piece, as in the source's manifest.
+        piece_hashes (List[str]): Hex SHA-256 of each piece, from the source's manifest.
+        root_hash (str): Root hash of the source's manifest.
+        have (bytearray): One byte per piece, non-zero once the piece is on disk.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        file_name: str,
+        file_size: int,
+        piece_size: int,
+        piece_hashes: List[str],
+        root_hash: str,
+        have: Optional[bytearray] = None,
+    ) -> None:
+        self.path = path
+        self.file_name = file_name
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.piece_hashes = piece_hashes
+        self.root_hash = root_hash
+        self.have = have if have is not None else bytearray(len(piece_hashes))
+        self._bitmap_offset = 0
+        self._fd = None
+
+    def matches(self, file_size: int, piece_size: int, root_hash: str) -> bool:
+        """Check that the state belongs to the same version of the source file."""
+        return (
+            self.file_size == file_size
+            and self.piece_size == piece_size
+            and self.root_hash == root_hash
+        )
+
+    def get_piece_digest(self, index: int) -> bytes:
+        return bytes.fromhex(self.piece_hashes[index])
+
+    def save(self) -> None:
+        """Write the whole sidecar file and keep it open for piece updates."""
+        self.close()
+        metadata = {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "piece_size": self.piece_size,
+            "root_hash": self.root_hash,
+            "piece_hashes": self.piece_hashes,
+        }
+        header = json.dumps(metadata).encode() + b"\n"
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(header)
+            file.write(self.have)
+        os.replace(tmp_path, self.path)
+
+        self._bitmap_offset = len(header)
+        self._fd = os.open(self.path, os.O_WRONLY)
+
+    def mark_piece(self, index: int) -> None:
+        """Record that a piece has been written to the output file."""
+        self.have[index] = 1
+        if self._fd is not None:
+            os.pwrite(self._fd, b"\x01", self._bitmap_offset + index)
+
+    def verify_pieces(self, output_file: str) -> List[int]:
+        """
+        Re-hash the pieces recorded as written and return those that are intact.
+
+        Pieces that no longer match their hash (e.g. the write was cut short)
+        are cleared, so they get downloaded again.
+        """
+        verified = []
+        buffer = memoryview(bytearray(min(VERIFY_READ_SIZE, self.piece_size)))
+        with open(output_file, "rb") as file:
+            for index, have in enumerate(self.have):
+                if not have:
+                    continue
+                start = index * self.piece_size
+                remaining = min(self.piece_size, self.file_size - start)
+                file.seek(start)
+                hasher = hashlib.sha256()
+                while remaining > 0:
+                    read = file.readinto(buffer[: min(len(buffer), remaining)])
+                    if not read:
+                        break
+                    hasher.update(buffer[:read])
+                    remaining -= read
+
+                if remaining == 0 and hasher.hexdigest() == self.piece_hashes[index]:
+                    verified.append(index)
+                else:
+                    self.have[index] = 0
+        return verified
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def remove(self) -> None:
+        """Delete the sidecar once the download is complete."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def load(cls, path: str) -> Optional["DownloadState"]:
+        """Read a sidecar file, returning None if it is missing or damaged."""
+        try:
+            with open(path, "rb") as file:
+                metadata = json.loads(file.readline())
+                have = bytearray(file.read())
+            state = cls(
+                path,
+                metadata["file_name"],
+                metadata["file_size"],
+                metadata["piece_size"],
+                metadata["piece_hashes"],
+                metadata["root_hash"],
+                have,
+            )
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(state.have) != len(state.piece_hashes):
+            return None
+        return state
+
+
+def get_state_path(output_file: str) -> str:
+    return output_file + STATE_SUFFIX
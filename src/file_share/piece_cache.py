@@ -0,0 +1,155 @@
+"""
+In-memory cache of recently served ranges, shared by every server connection.
+
+When many peers fetch a new file at once, they all ask for the same pieces
+within seconds of each other. Pieces the server can send with sendfile come
+straight from the kernel page cache and need no help. This cache is for the
+ranges that have to be read into memory, so their work is done once for
+every peer that asks:
+
+- ranges sent compressed, which are read and compressed;
+- ranges of files that have not been hashed yet, which are read and hashed.
+
+Entries are keyed by the file's path, size and modification time and by the
+range, so a file that changes is never served from stale entries, and the
+old entries are dropped the next time the file is looked up.
+"""
+
+from typing import Dict, Optional
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+from common.compression import MAX_RANGE_SIZE, compress_range, should_compress
+from common.metrics import PIECE_CACHE_LOOKUPS
+from common.protocol import COMPRESSION_NONE
+
+PIECE_CACHE_SIZE = 64 * 1024 * 1024  # Default bytes of payloads kept in memory
+MAX_CACHED_FRACTION = 8  # Largest entry is this fraction of the cache size
+
+
+class PieceCache:
+    """
+    A size-bounded LRU map from served ranges to (codec, payload, digest).
+
+    Attributes:
+        capacity (int): Bytes of payloads kept before the least recently used
+            entries are dropped (0 disables the cache).
+        size (int): Bytes of payloads currently held.
+    """
+
+    def __init__(self, capacity: int = PIECE_CACHE_SIZE) -> None:
+        self.capacity = capacity
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        # Path -> ((size, mtime_ns) cached, keys of its entries)
+        self._files: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        """Return the entry for (path, size, mtime_ns, start, end, codec), if cached."""
+        with self._lock:
+            self._drop_stale(key)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        PIECE_CACHE_LOOKUPS.inc(1, ("hit" if entry is not None else "miss",))
+        return entry
+
+    def put(self, key: tuple, entry: tuple) -> None:
+        payload_size = len(entry[1])
+        with self._lock:
+            if payload_size > self.capacity // MAX_CACHED_FRACTION:
+                return
+            self._drop_stale(key)
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self._files.setdefault(key[0], (key[1:3], set()))[1].add(key)
+            self.size += payload_size
+            self._evict(self.capacity)
+
+    def resize(self, capacity: int) -> None:
+        with self._lock:
+            self.capacity = capacity
+            self._evict(capacity)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def _drop_stale(self, key: tuple) -> None:
+        # Caller must hold _lock.
+        version, keys = self._files.get(key[0], (key[1:3], ()))
+        if version == key[1:3]:
+            return
+        for stale in keys:
+            self.size -= len(self._entries.pop(stale)[1])
+        del self._files[key[0]]
+
+    def _evict(self, capacity: int) -> None:
+        # Caller must hold _lock.
+        while self.size > capacity:
+            key, (_, payload, _) = self._entries.popitem(last=False)
+            self.size -= len(payload)
+            keys = self._files[key[0]][1]
+            keys.discard(key)
+            if not keys:
+                del self._files[key[0]]
+
+
+# Ranges served by this process, shared by the threaded and asyncio servers
+PIECE_CACHE = PieceCache()
+
+
+def read_range(
+    cache: PieceCache,
+    path: str,
+    file,
+    start: int,
+    count: int,
+    codec: int,
+    segment_hash: Optional[str],
+) -> Optional[tuple]:
+    """
+    Return (codec used, payload, digest) of a range that has to be sent from memory.
+
+    That is a range to send with `codec` (see common.compression), or, while
+    `cache` is enabled, one without a `segment_hash` from the manifest, which
+    must be hashed. Either is served from `cache` when possible. Returns None
+    for ranges that are best streamed from the file: whole pieces sent
+    uncompressed, and ranges of more than MAX_RANGE_SIZE bytes.
+    """
+    compressed = should_compress(path, count, codec)
+    if not compressed and (segment_hash is not None or not cache.capacity):
+        return None
+    if count > MAX_RANGE_SIZE:
+        return None
+
+    stat = os.fstat(file.fileno())
+    key = (
+        path,
+        stat.st_size,
+        stat.st_mtime_ns,
+        start,
+        start + count,
+        codec if compressed else COMPRESSION_NONE,
+    )
+    entry = cache.get(key) if cache.capacity else None
+    if entry is not None:
+        return entry
+
+    if compressed:
+        used_codec, data, payload = compress_range(file, start, count, codec)
+    else:
+        used_codec = COMPRESSION_NONE
+        data = payload = os.pread(file.fileno(), count, start)
+        if len(data) != count:
+            raise EOFError("file shrank while sending")
+    if segment_hash is not None:
+        digest = bytes.fromhex(segment_hash)
+    else:
+        digest = hashlib.sha256(data).digest()
+    entry = (used_codec, payload, digest)
+    cache.put(key, entry)
+    return entry
@@ -0,0 +1,115 @@
+from typing import Dict, Iterable, Optional
+from collections import deque
+import threading
+
+MAX_DUPLICATES = 2  # Workers allowed on one piece during the end game
+
+
+class PieceScheduler:
+    """
+    Hands out the pieces of a download to per-peer workers.
+
+    Workers pull the next missing piece as soon as they finish one, so faster
+    peers end up fetching more of the file. Pieces that fail go back to the
+    front of the queue for another worker. Once the queue is empty, idle workers
+    duplicate pieces still in flight (the "end game"), so a slow or stalled
+    peer cannot hold up the last few pieces.
+
+    Attributes:
+        file_size (int): Size of the file being downloaded.
+        piece_size (int): Bytes per piece (the last piece may be shorter).
+        piece_count (int): Number of pieces in the file.
+    """
+
+    def __init__(
+        self, file_size: int, piece_size: int, done: Iterable[int] = ()
+    ) -> None:
+        self.file_size = file_size
+        self.piece_size = piece_size
+        self.piece_count = (file_size + piece_size - 1) // piece_size
+        self._done = set(done)  # Pieces already on disk, e.g. from a resumed download
+        self._queue = deque(i for i in range(self.piece_count) if i not in self._done)
+        self._in_flight: Dict[int, int] = {}  # Piece index -> workers fetching it
+        self._condition = threading.Condition()
+
+    def get_piece_range(self, index: int) -> tuple:
+        start = index * self.piece_size
+        return start, min(start + self.piece_size, self.file_size)
+
+    def next_piece(self, wait: bool = True, exclude=()) -> Optional[int]:
+        """
+        Return the index of a piece to fetch, or None once there is nothing left.
+
+        In the end game this blocks until an in-flight piece completes or
+        fails, unless `wait` is False, in which case it returns None. Pieces in
+        `exclude` (those the caller already has in flight) are never duplicated.
+        """
+        with self._condition:
+            while True:
+                if self._queue:
+                    index = self._queue.popleft()
+                    self._in_flight[index] = self._in_flight.get(index, 0) + 1
+                    return index
+
+                if not self._in_flight:
+                    return None
+
+                # End game: help with the piece that has the fewest workers.
+                candidates = [i for i in self._in_flight if i not in exclude]
+                if candidates:
+                    index = min(candidates, key=self._in_flight.get)
+                    if self._in_flight[index] < MAX_DUPLICATES:
+                        self._in_flight[index] += 1
+                        return index
+
+                if not wait:
+                    return None
+                self._condition.wait()
+
+    def _release(self, index: int) -> None:
+        # Caller must hold _condition.
+        workers = self._in_flight.get(index, 0) - 1
+        if workers > 0:
+            self._in_flight[index] = workers
+        else:
+            self._in_flight.pop(index, None)
+
+    def complete_piece(self, index: int) -> bool:
+        """Mark a piece verified. Returns False if another worker already finished it."""
+        with self._condition:
+            self._release(index)
+            first = index not in self._done
+            self._done.add(index)
+            # Duplicates of a finished piece are no longer worth waiting for.
+            self._in_flight.pop(index, None)
+            self._condition.notify_all()
+            return first
+
+    def fail_piece(self, index: int) -> None:
+        """Return a piece that could not be fetched to the queue."""
+        with self._condition:
+            self._release(index)
+            if (
+                index not in self._done
+                and index not in self._in_flight
+                and index not in self._queue
+            ):
+                self._queue.appendleft(index)
+            self._condition.notify_all()
+
+    def is_piece_done(self, index: int) -> bool:
+        with self._condition:
+            return index in self._done
+
+    def has_pieces_in_flight(self) -> bool:
+        """Check whether a piece that is not queued may still come back or complete."""
+        with self._condition:
+            return bool(self._in_flight)
+
+    def is_complete(self) -> bool:
+        with self._condition:
+            return len(self._done) == self.piece_count
+
+    def get_missing_count(self) -> int:
+        with self._condition:
+            return self.piece_count - len(self._done)
@@ -0,0 +1,140 @@
+from typing import Dict, Optional
+import threading
+import time
+from common.metrics import UPLOAD_THROTTLED
+
+SEND_QUANTUM = 64 * 1024  # Bytes sent per reservation while a limit is set
+BURST_SECONDS = 0.25  # Bucket capacity, in seconds' worth of the rate
+MAX_IDLE_BUCKETS = 256  # Per-peer buckets kept before refilled ones are dropped
+
+_SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+class TokenBucket:
+    """
+    Bytes-per-second budget that can be reserved ahead of time.
+
+    Reserving more than is available leaves the bucket in debt and returns the
+    time at which the debt is paid off, so reservations made one after another
+    are granted one after another, in the order they were made.
+
+    Attributes:
+        rate (float): Bytes added per second.
+        burst (float): Most bytes that can be saved up while idle.
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def reserve(self, amount: int, now: float) -> float:
+        """Take `amount` bytes and return the time they may be sent."""
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= amount
+        if self._tokens >= 0:
+            return now
+        return now - self._tokens / self.rate
+
+    def is_full(self, now: float) -> bool:
+        return self._tokens + (now - self._updated) * self.rate >= self.burst
+
+
+class UploadLimiter:
+    """
+    Global and per-peer upload rate limits for the file server.
+
+    Senders reserve at most SEND_QUANTUM bytes at a time and reserve their
+    next quantum only after sending the previous one. Under a limit, concurrent
+    ranges therefore take turns a quantum at a time instead of the first one
+    running to completion, and every downloader makes steady progress.
+
+    Attributes:
+        global_rate (Optional[float]): Total upload limit in bytes per second, or None.
+        peer_rate (Optional[float]): Upload limit per peer IP in bytes per second, or None.
+        quantum (int): Bytes sent per reservation.
+        burst_seconds (float): Seconds' worth of each rate that may be sent at
+            once after an idle period (at least one quantum).
+    """
+
+    def __init__(
+        self,
+        global_rate: Optional[float] = None,
+        peer_rate: Optional[float] = None,
+        quantum: int = SEND_QUANTUM,
+        burst_seconds: float = BURST_SECONDS,
+    ) -> None:
+        self.quantum = quantum
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self._global: Optional[TokenBucket] = None
+        self._peers: Dict[str, TokenBucket] = {}
+        self.set_limits(global_rate, peer_rate)
+
+    def set_limits(
+        self, global_rate: Optional[float], peer_rate: Optional[float]
+    ) -> None:
+        """Change the limits; None or 0 means unlimited."""
+        with self._lock:
+            self.global_rate = global_rate or None
+            self.peer_rate = peer_rate or None
+            self._global = self._make_bucket(self.global_rate)
+            self._peers.clear()
+
+    @property
+    def is_limited(self) -> bool:
+        return self.global_rate is not None or self.peer_rate is not None
+
+    def _make_bucket(self, rate: Optional[float]) -> Optional[TokenBucket]:
+        if rate is None:
+            return None
+        return TokenBucket(rate, max(self.quantum, rate * self.burst_seconds))
+
+    def _get_peer_bucket(self, peer: str, now: float) -> Optional[TokenBucket]:
+        if self.peer_rate is None:
+            return None
+        bucket = self._peers.get(peer)
+        if bucket is None:
+            if len(self._peers) >= MAX_IDLE_BUCKETS:
+                # A refilled bucket is the same as a new one, so it can go.
+                for idle in [p for p, b in self._peers.items() if b.is_full(now)]:
+                    del self._peers[idle]
+            bucket = self._peers[peer] = self._make_bucket(self.peer_rate)
+        return bucket
+
+    def reserve(self, peer: str, amount: int) -> float:
+        """Reserve `amount` bytes for `peer` and return how many seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            send_at = now
+            peer_bucket = self._get_peer_bucket(peer, now)
+            for bucket in (self._global, peer_bucket):
+                if bucket is not None:
+                    send_at = max(send_at, bucket.reserve(amount, now))
+        if send_at > now:
+            UPLOAD_THROTTLED.inc(send_at - now)
+        return send_at - now
+
+    def acquire(self, peer: str, amount: int) -> float:
+        """Block until `amount` bytes may be sent to `peer`; return the seconds waited."""
+        delay = self.reserve(peer, amount)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+def parse_rate(text: str) -> int:
+    """Parse a rate in bytes per second such as "500K" or "10M" (binary units)."""
+    number = text.strip().upper().removesuffix("B")
+    multiplier = 1
+    if number and number[-1] in _SIZE_SUFFIXES:
+        number, multiplier = number[:-1], _SIZE_SUFFIXES[number[-1]]
+    try:
+        value = float(number) * multiplier
+    except ValueError:
+        value = -1
+    if not 0 <= value < float("inf"):  # Also rejects NaN
+        raise ValueError(f"invalid rate '{text}'")
+    return int(value)
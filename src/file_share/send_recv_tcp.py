@@ -1,199 +1,1283 @@
+from typing import List, Optional
 import socket
 import os
 import hashlib
-from common.debug_print import debug_print, regular_print
+import errno
+import select
+import time
+from common.debug_print import get_logger
 from common.control_block import ControlBlock
-from peer_discovery.discovery import MY_SERVER_PORT
+from common.compression import decompress_into
+from common.chunk_store import ChunkStore
+from common.chunking import MIN_CHUNKED_FILE_SIZE
+from common.manifest import PIECE_SIZE, get_root_hash
+from common.metrics import (
+    ACTIVE_TRANSFERS,
+    BYTES_RECEIVED,
+    BYTES_SENT,
+    ERRORS,
+    HASH_TIME,
+    PIECE_LATENCY,
+)
+from common.protocol import (
+    HEADER_SIZE,
+    DIGEST_SIZE,
+    MSG_RANGE_REQUEST,
+    MSG_RANGE_DATA,
+    MSG_RANGE_DIGEST,
+    MSG_ERROR,
+    MSG_MANIFEST_REQUEST,
+    MSG_MANIFEST,
+    MSG_CHUNKS_REQUEST,
+    MSG_CHUNKS,
+    ERR_NOT_FOUND,
+    ERR_INVALID_RANGE,
+    ERR_INVALID_REQUEST,
+    ERR_INTERNAL,
+    ERROR_NAMES,
+    COMPRESSION_MASK,
+    COMPRESSION_NONE,
+    ProtocolError,
+    make_content_name,
+    pack_header,
+    pack_message,
+    pack_error,
+    pack_range_request,
+    pack_manifest_request,
+    pack_manifest,
+    pack_chunks_request,
+    pack_chunks,
+    unpack_header,
+    unpack_range_request,
+    unpack_manifest_request,
+    unpack_manifest,
+    unpack_chunk_list,
+    unpack_error,
+    read_exact,
+    read_message,
+)
+from file_share.piece_scheduler import PieceScheduler
+from file_share.connection_pool import ConnectionPool, PeerConnection
+from file_share.download_state import DownloadState, get_state_path
+from file_share.piece_cache import PIECE_CACHE, PieceCache, read_range
+from file_share.rate_limiter import UploadLimiter
+from peer_discovery.discovery import (
+    MY_SERVER_PORT,
+    close_socket,
+    search_file_from_peer,
+)
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = get_logger("transfer")
 
 FILE_PORT = 60000  # Port for file transfer
-BUFFER_SIZE = 1024  # Chunk size for file transfer
+MAX_CONCURRENT_TRANSFERS = 32  # Range requests served in parallel
+SERVER_BACKLOG = 128  # Pending connections queued by the kernel
+ACCEPT_POLL_INTERVAL = 1  # Seconds between shutdown checks in the accept loop
+CLIENT_TIMEOUT = 30  # Seconds before a stalled client connection is dropped
+SEND_BUFFER_SIZE = 1024 * 1024  # Read size when sendfile is unavailable
+MAX_PEER_FAILURES = 3  # Consecutive failed pieces before a peer is dropped
+PIPELINE_DEPTH = 4  # Range requests kept outstanding per peer connection
+RECV_CHUNK_SIZE = 256 * 1024  # Bytes received and hashed at a time
+MAX_REQUEST_SIZE = 4096  # Largest request or error payload accepted
+MAX_MANIFEST_SIZE = 64 * 1024 * 1024  # Largest manifest accepted (2M pieces)
 
+# Keep-alive connections to other peers' file servers, shared by all downloads
+CONNECTION_POOL = ConnectionPool()
 
-def get_hash_of_file(file_name: str):
-    hasher = hashlib.sha256()
-    with open(file_name, "rb") as file:
-        while chunk := file.read(8192):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+# os.sendfile errors meaning "not supported for this fd", rather than a real failure.
+SENDFILE_UNSUPPORTED_ERRNOS = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.EOPNOTSUPP,
+}
 
 
-def send_file(cb, client_socket, file_name, start, end):
-    """Send only the requested segment of a file."""
-    try:
-        file_path = cb.get_file_path(file_name)
-        if not os.path.exists(file_path):
-            client_socket.send("FILE_NOT_FOUND".encode())
-            return
+def _sendfile_range(client_socket, file, offset: int, count: int):
+    """
+    Zero-copy send with os.sendfile.
+
+    Returns the number of bytes sent, or None if sendfile is not supported for
+    this socket/file pair and nothing was sent.
+    """
+    socket_fd = client_socket.fileno()
+    file_fd = file.fileno()
+    timeout = client_socket.gettimeout()
+    total_sent = 0
+
+    while total_sent < count:
+        try:
+            sent = os.sendfile(
+                socket_fd, file_fd, offset + total_sent, count - total_sent
+            )
+        except BlockingIOError:
+            # Sockets with a timeout are non-blocking underneath, so wait for
+            # room in the send buffer ourselves.
+            _, writable, _ = select.select([], [client_socket], [], timeout)
+            if not writable:
+                raise socket.timeout("timed out sending file segment")
+            continue
+        except OSError as e:
+            if e.errno in SENDFILE_UNSUPPORTED_ERRNOS and total_sent == 0:
+                LOGGER.debug("sendfile unavailable (%s), falling back to copy", e)
+                return None
+            raise
+
+        if sent == 0:  # Reached EOF before `count` bytes
+            break
+        total_sent += sent
+
+    return total_sent
+
+
+def send_file_range(
+    client_socket,
+    file,
+    offset: int,
+    count: int,
+    hasher=None,
+    limiter: UploadLimiter = None,
+    peer_ip: str = "",
+):
+    """
+    Send `count` bytes of `file` starting at `offset`, feeding them to `hasher` if given.
 
-        file_size = os.path.getsize(file_path)
-        if start >= file_size or end > file_size or start >= end:
-            client_socket.send("INVALID_RANGE".encode())
-            return
+    Uses os.sendfile so the kernel copies straight from the page cache into the
+    socket. When hashing, each chunk is also read into a reusable buffer for the
+    digest right before it is sent. Falls back to a large-buffer readinto/sendall
+    loop on platforms or files where sendfile is not supported. With a
+    `limiter` that has limits set, chunks shrink to its quantum and each one
+    waits for its turn.
+    """
+    if count <= 0:
+        return
+
+    buffer = memoryview(bytearray(min(SEND_BUFFER_SIZE, count)))
+    zero_copy = hasattr(os, "sendfile")
+    throttled = limiter is not None and limiter.is_limited
+
+    while count > 0:
+        chunk = min(len(buffer), count)
+        if throttled:
+            chunk = min(chunk, limiter.quantum)
+            limiter.acquire(peer_ip, chunk)
+
+        filled = hasher is not None or not zero_copy
+        if filled:
+            file.seek(offset)
+            chunk = file.readinto(buffer[:chunk])
+            if not chunk:
+                break
+            if hasher is not None:
+                hasher.update(buffer[:chunk])
+
+        if zero_copy:
+            sent = _sendfile_range(client_socket, file, offset, chunk)
+            if sent is not None:
+                if sent < chunk:  # File shrank underneath us
+                    break
+                offset += chunk
+                count -= chunk
+                continue
+
+            zero_copy = False
+            if not filled:
+                continue
+
+        client_socket.sendall(buffer[:chunk])
+        offset += chunk
+        count -= chunk
+
+
+def send_buffer(client_socket, data, limiter: UploadLimiter = None, peer_ip=""):
+    """sendall() that honours the upload limits of `limiter`, if any."""
+    if limiter is None or not limiter.is_limited:
+        client_socket.sendall(data)
+        return
+    data = memoryview(data)
+    for offset in range(0, len(data), limiter.quantum):
+        chunk = data[offset : offset + limiter.quantum]
+        limiter.acquire(peer_ip, len(chunk))
+        client_socket.sendall(chunk)
 
-        client_socket.send("FILE_FOUND".encode())
 
-        # Send hash of the segment (optional)
-        segment_hash = get_hash_of_file(file_path)
-        client_socket.send(segment_hash.encode())
+def locate_range(cb: ControlBlock, file_name: str, start: int, end: int) -> tuple:
+    """
+    Look up the file and manifest hash that answer a range request.
+
+    Returns (error code or None, file path, hash of the range from the
+    file's manifest or None). Stats the file and may read its manifest from
+    the share index, so it blocks.
+    """
+    file_path = cb.get_file_path(file_name)
+    if not os.path.exists(file_path):
+        return ERR_NOT_FOUND, None, None
+
+    file_size = os.path.getsize(file_path)
+    if start >= file_size or end > file_size or start >= end:
+        return ERR_INVALID_RANGE, None, None
+
+    # Whole-piece requests can be served with the hash from the manifest,
+    # leaving the data path entirely zero-copy.
+    manifest = cb.get_manifest(file_name)
+    segment_hash = manifest.get_hash_for_range(start, end) if manifest else None
+    return None, file_path, segment_hash
+
+
+def send_file(
+    cb,
+    client_socket,
+    file_name,
+    start,
+    end,
+    request_id=0,
+    peer_ip="",
+    compression=COMPRESSION_NONE,
+    limiter: UploadLimiter = None,
+    cache: PieceCache = PIECE_CACHE,
+) -> bool:
+    """
+    Send only the requested segment of a file.
+
+    The response is a RANGE_DATA message carrying the segment, followed by a
+    RANGE_DIGEST message with the SHA-256 of exactly the bytes in [start, end),
+    taken from the file's manifest when the range is a single piece and
+    computed otherwise. If the client accepts `compression` and the file
+    compresses, the segment is sent compressed instead (see
+    common.compression). Segments that are compressed or hashed are kept in
+    `cache` for the next peer asking for them (see read_range). The data is
+    paced by `limiter`, if given. Failures are answered with an ERROR message
+    instead. Returns False if the connection can no longer be used for
+    further requests.
+    """
+    streaming = False
+    try:
+        error, file_path, segment_hash = locate_range(cb, file_name, start, end)
+        if error is not None:
+            client_socket.sendall(pack_error(request_id, error))
+            return True
 
-        # Send the requested segment
         with open(file_path, "rb") as file:
-            file.seek(start)
-            remaining = end - start
-            while remaining > 0:
-                data = file.read(min(BUFFER_SIZE, remaining))
-                if not data:
+            in_memory = read_range(
+                cache, file_path, file, start, end - start, compression, segment_hash
+            )
+
+            streaming = True
+            ACTIVE_TRANSFERS.inc(1, ("upload",))
+            if in_memory is not None:
+                # Compressed or hashed already, whether or not it was cached
+                codec, payload, digest = in_memory
+                client_socket.sendall(
+                    pack_header(MSG_RANGE_DATA, request_id, len(payload), codec)
+                )
+                send_buffer(client_socket, payload, limiter, peer_ip)
+            else:
+                client_socket.sendall(
+                    pack_header(MSG_RANGE_DATA, request_id, end - start)
+                )
+
+                # Send the requested segment, then its hash
+                hasher = None if segment_hash is not None else hashlib.sha256()
+                send_file_range(
+                    client_socket,
+                    file,
+                    start,
+                    end - start,
+                    hasher,
+                    limiter,
+                    peer_ip,
+                )
+                if hasher is None:
+                    digest = bytes.fromhex(segment_hash)
+                else:
+                    digest = hasher.digest()
+        client_socket.sendall(pack_message(MSG_RANGE_DIGEST, request_id, digest))
+        BYTES_SENT.inc(end - start, (peer_ip,))
+        return True
+
+    except Exception as e:
+        LOGGER.warning("Error sending file: %s", e)
+        ERRORS.inc(1, ("send",))
+        if streaming:
+            return False  # The client cannot tell where the segment stopped
+        try:
+            client_socket.sendall(pack_error(request_id, ERR_INTERNAL))
+            return True
+        except OSError:
+            return False
+
+    finally:
+        if streaming:
+            ACTIVE_TRANSFERS.dec(1, ("upload",))
+
+
+def send_manifest(cb, client_socket, file_name, request_id=0, chunks=False) -> bool:
+    """
+    Send the piece size and piece hashes of a shared file.
+
+    With `chunks`, send its content-defined chunks instead, or ERR_NOT_FOUND
+    if the file is too small to be chunked. A file without a current
+    manifest is answered with ERR_NOT_FOUND while one is built in the
+    background. Returns False if the connection can no longer be used.
+    """
+    try:
+        manifest = cb.get_manifest(file_name, build=True)
+        if manifest is None or (chunks and manifest.chunks is None):
+            response = pack_error(request_id, ERR_NOT_FOUND)
+        elif chunks:
+            response = pack_chunks(request_id, manifest.chunks)
+        else:
+            response = pack_manifest(
+                request_id, manifest.piece_size, manifest.piece_hashes
+            )
+    except Exception as e:
+        LOGGER.warning("Error building manifest of %s: %s", file_name, e)
+        response = pack_error(request_id, ERR_INTERNAL)
+
+    try:
+        client_socket.sendall(response)
+        return True
+    except OSError:
+        return False
+
+
+def _read_request(client_socket, pending: bytearray, threading_event):
+    """
+    Return the next request as (type, flags, request ID, payload), or None
+    once the connection should be closed.
+
+    `pending` holds bytes received past the previous request, i.e. pipelined
+    requests. Gives up when the client closes the connection, stays idle for
+    CLIENT_TIMEOUT seconds or the server is shutting down. Raises
+    ProtocolError for a malformed header or an oversized request.
+    """
+    idle_deadline = time.monotonic() + CLIENT_TIMEOUT
+    while True:
+        if len(pending) >= HEADER_SIZE:
+            msg_type, flags, request_id, length = unpack_header(pending)
+            if length > MAX_REQUEST_SIZE:
+                raise ProtocolError(f"request of {length} bytes is too large")
+            request_end = HEADER_SIZE + length
+            if len(pending) >= request_end:
+                payload = bytes(pending[HEADER_SIZE:request_end])
+                del pending[:request_end]
+                return msg_type, flags, request_id, payload
+
+        if threading_event is not None and threading_event.is_set():
+            return None
+        remaining = idle_deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+
+        ready_sockets, _, _ = select.select(
+            [client_socket], [], [], min(remaining, ACCEPT_POLL_INTERVAL)
+        )
+        if ready_sockets:
+            data = client_socket.recv(MAX_REQUEST_SIZE)
+            if not data:
+                return None
+            pending += data
+
+
+def handle_client(
+    cb: ControlBlock,
+    client_socket,
+    client_address,
+    threading_event: threading.Event = None,
+    limiter: UploadLimiter = None,
+):
+    """
+    Serve range requests from a keep-alive connection.
+
+    Requests are RANGE_REQUEST, MANIFEST_REQUEST or CHUNKS_REQUEST messages,
+    answered in order and tagged with the request's ID, so a client may
+    pipeline several before reading the responses. The connection is closed
+    when the client closes it, sends a malformed request, stays idle for
+    CLIENT_TIMEOUT seconds or `threading_event` is set.
+    """
+    pending = bytearray()
+    request_id = 0
+    try:
+        while True:
+            try:
+                request = _read_request(client_socket, pending, threading_event)
+                if request is None:
                     break
-                client_socket.send(data)
-                remaining -= len(data)
+                msg_type, flags, request_id, payload = request
+                if msg_type == MSG_RANGE_REQUEST:
+                    start, end, file_name = unpack_range_request(payload)
+                elif msg_type in (MSG_MANIFEST_REQUEST, MSG_CHUNKS_REQUEST):
+                    file_name = unpack_manifest_request(payload)
+                else:
+                    raise ProtocolError(f"unexpected message type {msg_type}")
+            except ProtocolError as e:
+                LOGGER.debug("Invalid request from %s: %s", client_address, e)
+                ERRORS.inc(1, ("protocol",))
+                client_socket.sendall(pack_error(request_id, ERR_INVALID_REQUEST))
+                break
+
+            if msg_type in (MSG_MANIFEST_REQUEST, MSG_CHUNKS_REQUEST):
+                keep_alive = send_manifest(
+                    cb,
+                    client_socket,
+                    file_name,
+                    request_id,
+                    chunks=msg_type == MSG_CHUNKS_REQUEST,
+                )
+            else:
+                keep_alive = send_file(
+                    cb,
+                    client_socket,
+                    file_name,
+                    start,
+                    end,
+                    request_id,
+                    peer_ip=client_address[0],
+                    compression=flags & COMPRESSION_MASK,
+                    limiter=limiter,
+                )
+            if not keep_alive:
+                break
 
     except Exception as e:
-        print(f"Error sending file: {e}")
-        client_socket.send("ERROR".encode())
+        LOGGER.warning("Error handling request from %s: %s", client_address, e)
+
+    finally:
+        LOGGER.debug("Closing connection from %s", client_address)
+        close_socket(client_socket)
+
 
+def _serve_client(cb, client_socket, client_address, slots, threading_event, limiter):
+    try:
+        handle_client(cb, client_socket, client_address, threading_event, limiter)
     finally:
-        client_socket.close()
+        slots.release()
 
 
-def start_file_server(cb: ControlBlock):
+def start_file_server(
+    cb: ControlBlock,
+    threading_event: threading.Event = None,
+    max_transfers: int = MAX_CONCURRENT_TRANSFERS,
+    backlog: int = SERVER_BACKLOG,
+    port: int = MY_SERVER_PORT,
+    limiter: UploadLimiter = None,
+):
+    """
+    Serve range requests with a bounded pool of worker threads.
+
+    Each worker serves one keep-alive connection at a time. At most
+    `max_transfers` connections are served at once; further clients wait in
+    the kernel accept queue (sized by `backlog`) until a worker frees up.
+    Uploads are paced by `limiter`, if given (see UploadLimiter).
+    Setting `threading_event` stops accepting new connections, lets in-flight
+    transfers finish and closes idle connections before returning.
+    """
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    server_socket.bind(("", MY_SERVER_PORT))
-    server_socket.listen(5)  # Allow up to 5 connections
+    server_socket.bind(("", port))
+    server_socket.listen(backlog)
+    server_socket.settimeout(ACCEPT_POLL_INTERVAL)
 
-    debug_print("File server listening on port", MY_SERVER_PORT)
+    LOGGER.debug("File server listening on port %s", port)
 
-    while True:
-        client_socket, client_address = server_socket.accept()
-        debug_print(f"Connection established with {client_address}")
+    slots = threading.BoundedSemaphore(max_transfers)
+    executor = ThreadPoolExecutor(
+        max_workers=max_transfers, thread_name_prefix="file-server"
+    )
 
-        request_message = client_socket.recv(BUFFER_SIZE).decode()
-        parts = request_message.split(":")
-        if len(parts) != 3:
-            client_socket.send("INVALID_REQUEST".encode())
-            continue
+    try:
+        while threading_event is None or not threading_event.is_set():
+            # Only accept once a worker is free, so that excess clients queue in
+            # the backlog instead of piling up inside the executor.
+            if not slots.acquire(timeout=ACCEPT_POLL_INTERVAL):
+                continue
 
-        file_name, start, end = parts[0], int(parts[1]), int(parts[2])
-        send_file(cb, client_socket, file_name, start, end)
+            try:
+                client_socket, client_address = server_socket.accept()
+            except socket.timeout:
+                slots.release()
+                continue
 
+            client_socket.settimeout(CLIENT_TIMEOUT)
+            LOGGER.debug("Connection established with %s", client_address)
+            executor.submit(
+                _serve_client,
+                cb,
+                client_socket,
+                client_address,
+                slots,
+                threading_event,
+                limiter,
+            )
 
-BUFFER_SIZE = 1024  # Chunk size for file transfer
+    finally:
+        LOGGER.debug("Shutting down file server...")
+        close_socket(server_socket)
+        executor.shutdown(wait=True)
 
 
 def get_server_addr_from_peer_addr(peer_ip: str, port: int):
     return (peer_ip, port + 10000)
 
 
-def receive_segment_from_peer(
-    peer_ip: tuple, file_name: str, start, end, output_file, lock
+def send_range_request(
+    connection: PeerConnection,
+    file_name: str,
+    start,
+    end,
+    request_id: int = 0,
+    compression: int = COMPRESSION_NONE,
 ):
-    """Download a specific segment of a file from a peer."""
-    address = get_server_addr_from_peer_addr(peer_ip[0], peer_ip[1])
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    connection.sock.sendall(
+        pack_range_request(request_id, file_name, start, end, compression)
+    )
+
+
+def check_range_header(header: bytes, request_id: int, size: int) -> tuple:
+    """
+    Validate the header of the response to a request for `size` bytes.
+
+    Returns (message type, codec, payload length). An ERROR message is
+    returned as is, for the caller to read its code. Raises ProtocolError if
+    the response is to another request or cannot be the requested range.
+    """
+    msg_type, flags, response_id, length = unpack_header(header)
+    if response_id != request_id:
+        raise ProtocolError(f"response to request {response_id}, not {request_id}")
+    if msg_type == MSG_ERROR and length <= MAX_REQUEST_SIZE:
+        return msg_type, COMPRESSION_NONE, length
+    codec = flags & COMPRESSION_MASK
+    # A compressed range is only ever sent if it is smaller than the original.
+    if msg_type != MSG_RANGE_DATA or not (
+        length == size if codec == COMPRESSION_NONE else length < size
+    ):
+        raise ProtocolError(f"unexpected response type {msg_type} of {length} bytes")
+    return msg_type, codec, length
+
+
+def check_range_digest(
+    message: tuple,
+    request_id: int,
+    computed: Optional[bytes],
+    expected_digest: bytes = None,
+) -> bool:
+    """
+    Check the RANGE_DIGEST message that ends a range response.
+
+    `computed` is the digest of the received range, or None if it did not
+    decompress. Returns whether the range matches the peer's digest and, if
+    given, `expected_digest`. Raises ProtocolError if `message` is not the
+    digest of the request.
+    """
+    msg_type, _, response_id, digest = message
+    if msg_type != MSG_RANGE_DIGEST or response_id != request_id:
+        raise ProtocolError(f"expected segment digest, got message type {msg_type}")
+    if computed is None:
+        LOGGER.debug("Range of request %s does not decompress", request_id)
+        return False
+    return digest == computed and expected_digest in (None, computed)
+
+
+def read_range_response(
+    connection: PeerConnection,
+    buffer: memoryview,
+    request_id: int = 0,
+    expected_digest: bytes = None,
+) -> bool:
+    """
+    Read the response to a range request into `buffer` and verify its hash.
 
+    `buffer` must be exactly as long as the requested range. The data may
+    arrive compressed if the request asked for it. Once decompressed, it must
+    match the digest sent by the peer and, if given, `expected_digest`.
+    Returns False if the peer does not have the range or the data is corrupt,
+    in which case the connection can still be reused. Raises ConnectionError
+    if the stream broke off mid-response or is out of sync with our requests.
+    """
+    msg_type, codec, length = check_range_header(
+        read_exact(connection.reader, HEADER_SIZE), request_id, len(buffer)
+    )
+    if msg_type == MSG_ERROR:
+        code = unpack_error(read_exact(connection.reader, length))
+        LOGGER.debug("%s answered %s", connection.address, ERROR_NAMES.get(code, code))
+        return False
+
+    hasher = hashlib.sha256()
+    hash_time = 0.0
+    if codec != COMPRESSION_NONE:
+        payload = read_exact(connection.reader, length)
+        decoded = decompress_into(codec, payload, buffer)
+        if decoded:
+            hash_start = time.perf_counter()
+            hasher.update(buffer)
+            hash_time = time.perf_counter() - hash_start
+    else:
+        # Hash each chunk as it arrives, while it is still in cache.
+        decoded = True
+        received = 0
+        while received < len(buffer):
+            chunk = buffer[received : received + RECV_CHUNK_SIZE]
+            read = connection.reader.readinto(chunk)
+            if not read:
+                raise ConnectionError("connection closed mid-segment")
+            hash_start = time.perf_counter()
+            hasher.update(chunk[:read])
+            hash_time += time.perf_counter() - hash_start
+            received += read
+
+    HASH_TIME.observe(hash_time, ("download",))
+    return check_range_digest(
+        read_message(connection.reader, DIGEST_SIZE),
+        request_id,
+        hasher.digest() if decoded else None,
+        expected_digest,
+    )
+
+
+def request_manifest(
+    peer: tuple,
+    file_name: str,
+    file_size: int,
+    pool: ConnectionPool = CONNECTION_POOL,
+):
+    """
+    Fetch the piece size and piece hashes of a file from a peer.
+
+    Returns (piece_size, piece_hashes), or None if the peer cannot provide a
+    manifest matching `file_size`.
+    """
+    address = get_server_addr_from_peer_addr(peer[0], peer[1])
+    connection = None
     try:
-        client_socket.connect(address)
-        request_message = f"{file_name}:{start}:{end}"
-        client_socket.send(request_message.encode())
-
-        response = client_socket.recv(BUFFER_SIZE).decode()
-        if response != "FILE_FOUND":
-            print(f"Segment {start}-{end} not found on {peer_ip}.")
-            return
-
-        hash_of_segment = client_socket.recv(BUFFER_SIZE).decode()
-        print(f"Receiving segment {start}-{end} of {file_name} from {peer_ip}...")
-
-        with open(output_file, "r+b") as file:
-            file.seek(start)  # Move to the correct position
-            remaining = end - start
-            while remaining > 0:
-                data = client_socket.recv(min(BUFFER_SIZE, remaining))
-                if not data:
-                    break
-                with lock:
-                    file.write(data)
-                remaining -= len(data)
+        connection = pool.acquire(address)
+        connection.sock.sendall(pack_manifest_request(0, file_name))
+        msg_type, _, response_id, payload = read_message(
+            connection.reader, MAX_MANIFEST_SIZE
+        )
+        if response_id != 0:
+            raise ProtocolError(f"response to request {response_id}, not 0")
+        pool.release(connection)
+        connection = None
+        if msg_type != MSG_MANIFEST:
+            LOGGER.debug("%s has no manifest for %s", peer, file_name)
+            return None
 
-        if hash_of_segment == get_hash_of_file(output_file):
-            print(f"Segment {start}-{end} verified.")
-        else:
-            print(f"Segment {start}-{end} corrupted.")
+        piece_size, piece_hashes = unpack_manifest(payload)
+        if piece_size <= 0 or len(piece_hashes) != -(-file_size // piece_size):
+            LOGGER.debug(
+                "Manifest of %s from %s does not match its size", file_name, peer
+            )
+            return None
+        return piece_size, piece_hashes
 
     except Exception as e:
-        print(f"Error receiving segment {start}-{end} from {peer_ip}: {e}")
+        LOGGER.warning(
+            "Error requesting manifest of %s from %s: %s", file_name, peer, e
+        )
+        if connection is not None:
+            connection.close()
+        return None
 
-    finally:
-        client_socket.close()
 
+def request_chunk_list(
+    peer: tuple,
+    file_name: str,
+    file_size: int,
+    pool: ConnectionPool = CONNECTION_POOL,
+) -> Optional[List[tuple]]:
+    """
+    Fetch the content-defined chunks of a file from a peer.
 
-def receive_file_from_peers(peers: list, file_name: str):
-    # Ensure all peers have the same file size
-    file_sizes = {peer[1] for peer in peers}
-    if len(file_sizes) != 1:
-        print("Peer list is not consistent. Cannot download file.")
-        return
+    Returns (length, hex hash) chunks, or None if the peer has no chunk list
+    covering exactly `file_size` bytes.
+    """
+    address = get_server_addr_from_peer_addr(peer[0], peer[1])
+    connection = None
+    try:
+        connection = pool.acquire(address)
+        connection.sock.sendall(pack_chunks_request(0, file_name))
+        msg_type, _, response_id, payload = read_message(
+            connection.reader, MAX_MANIFEST_SIZE
+        )
+        if response_id != 0:
+            raise ProtocolError(f"response to request {response_id}, not 0")
+        pool.release(connection)
+        connection = None
+        if msg_type != MSG_CHUNKS:
+            LOGGER.debug("%s has no chunk list for %s", peer, file_name)
+            return None
 
-    file_size = file_sizes.pop()
-    num_peers = len(peers)
-    segment_size = file_size // num_peers
-    output_file = f"downloaded_{file_name}"
-    with open(output_file, "wb") as f:
-        f.truncate(file_size)
+        chunks = unpack_chunk_list(payload)
+        if sum(length for length, _ in chunks) != file_size:
+            LOGGER.debug(
+                "Chunk list of %s from %s does not match its size", file_name, peer
+            )
+            return None
+        return chunks
 
-    lock = threading.Lock()
+    except Exception as e:
+        LOGGER.warning(
+            "Error requesting chunk list of %s from %s: %s", file_name, peer, e
+        )
+        if connection is not None:
+            connection.close()
+        return None
+
+
+def receive_segment_from_peer(
+    peer_ip: tuple,
+    file_name: str,
+    start,
+    end,
+    buffer: memoryview,
+    pool: ConnectionPool = CONNECTION_POOL,
+) -> bool:
+    """
+    Download a specific segment of a file from a peer into `buffer` and verify its hash.
 
-    threads = []
-    for i, (peer, _) in enumerate(peers):
-        start = i * segment_size
-        end = file_size if i == num_peers - 1 else (i + 1) * segment_size
+    `buffer` must be exactly end - start bytes long.
+    """
+    address = get_server_addr_from_peer_addr(peer_ip[0], peer_ip[1])
+    connection = None
+    try:
+        connection = pool.acquire(address)
+        send_range_request(connection, file_name, start, end)
+        verified = read_range_response(connection, buffer)
+        pool.release(connection)
+        if not verified:
+            LOGGER.warning(
+                "Segment %s-%s from %s not found or corrupted.", start, end, peer_ip
+            )
+        return verified
 
-        thread = threading.Thread(
-            target=receive_segment_from_peer,
-            args=(peer, file_name, start, end, output_file, lock),
+    except Exception as e:
+        LOGGER.warning(
+            "Error receiving segment %s-%s from %s: %s", start, end, peer_ip, e
         )
-        thread.start()
-        threads.append(thread)
+        if connection is not None:
+            connection.close()
+        return False
 
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
 
-    print(f"File {file_name} successfully downloaded from peers.")
+def write_piece(output_fd: int, piece: memoryview, offset: int) -> None:
+    """Write a whole piece at an absolute offset, independent of other writers."""
+    written = 0
+    while written < len(piece):
+        written += os.pwrite(output_fd, piece[written:], offset + written)
 
 
-def receive_file_from_peer(peer_ip: tuple, file_name: str):
-    address = get_server_addr_from_peer_addr(peer_ip[0], peer_ip[1])
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(address)
+def store_piece(
+    peer: tuple,
+    file_name: str,
+    output_fd: int,
+    scheduler: PieceScheduler,
+    state: Optional[DownloadState],
+    index: int,
+    piece: memoryview,
+    verified: bool,
+    sent_at: float,
+) -> Optional[bool]:
+    """
+    Settle a piece received from `peer`, writing it to `output_fd` if verified.
 
-    # Send the file name to the peer
-    client_socket.send(file_name.encode())
+    Returns True once the piece is written, False if it failed verification,
+    or None if it could not be written, after which the worker should stop.
+    """
+    start, end = scheduler.get_piece_range(index)
+    if not verified:
+        LOGGER.warning(
+            "Segment %s-%s from %s not found or corrupted.", start, end, peer
+        )
+        ERRORS.inc(1, ("bad_piece",))
+        scheduler.fail_piece(index)
+        return False
+    PIECE_LATENCY.observe(time.monotonic() - sent_at)
+    BYTES_RECEIVED.inc(end - start, (peer[0],))
 
-    # Wait for response (whether file exists or not)
-    response = client_socket.recv(BUFFER_SIZE).decode()
+    try:
+        # An end-game duplicate may have lost the race to another peer.
+        # If both write, they write the same verified bytes.
+        if not scheduler.is_piece_done(index):
+            write_piece(output_fd, piece, start)
+            if state is not None:
+                state.mark_piece(index)
+    except OSError as e:
+        LOGGER.warning(
+            "Error writing segment %s-%s of %s: %s", start, end, file_name, e
+        )
+        ERRORS.inc(1, ("write",))
+        scheduler.fail_piece(index)
+        return None
+    scheduler.complete_piece(index)
+    return True
 
-    if response == "FILE_FOUND":
-        hash_of_file = client_socket.recv(BUFFER_SIZE).decode()
-        regular_print(f"Receiving file {file_name} from {peer_ip}...")
 
-        with open(f"downloaded_{file_name}", "wb") as file:
-            while True:
-                # Receive the file in chunks
-                data = client_socket.recv(BUFFER_SIZE)
-                if not data:
-                    break
-                file.write(data)
+def _download_pieces_from_peer(
+    peer: tuple,
+    file_name: str,
+    output_fd: int,
+    scheduler: PieceScheduler,
+    pool: ConnectionPool,
+    state: DownloadState = None,
+    compression: int = COMPRESSION_NONE,
+):
+    """
+    Fetch pieces from one peer until none are left or the peer keeps failing.
 
-        # Check if the file is valid
-        print(hash_of_file, get_hash_of_file(f"downloaded_{file_name}"))
-        if hash_of_file == get_hash_of_file(f"downloaded_{file_name}"):
-            regular_print(f"File {file_name} downloaded successfully.")
-        else:
-            regular_print(f"File {file_name} checksum incorrect.")
+    Up to PIPELINE_DEPTH range requests are kept outstanding on a keep-alive
+    connection, so the peer never sits idle waiting for our next request.
+    Each piece is received into this worker's reusable buffer and, once
+    verified, written with pwrite at its offset in `output_fd`, so workers
+    never wait on each other and corrupt data never reaches the file. With a
+    `state`, pieces are also checked against its piece hashes and recorded in
+    it once written. Every piece is requested with `compression`, which the
+    peer may or may not apply.
+    """
+    address = get_server_addr_from_peer_addr(peer[0], peer[1])
+    buffer = memoryview(bytearray(scheduler.piece_size))
+    requested = deque()  # Pieces requested on `connection`, in order
+    requested_at = {}  # Piece index -> time its request was sent
+    connection = None
+    failures = 0
+
+    ACTIVE_TRANSFERS.inc(1, ("download",))
+    try:
+        while failures < MAX_PEER_FAILURES:
+            try:
+                # Top up the pipeline; only block for work when it is empty.
+                while len(requested) < PIPELINE_DEPTH:
+                    index = scheduler.next_piece(wait=not requested, exclude=requested)
+                    if index is None:
+                        break
+                    requested.append(index)
+                    if connection is None:
+                        connection = pool.acquire(address)
+                    start, end = scheduler.get_piece_range(index)
+                    send_range_request(
+                        connection, file_name, start, end, index, compression
+                    )
+                    requested_at[index] = time.monotonic()
+
+                if not requested:
+                    return
+
+                start, end = scheduler.get_piece_range(requested[0])
+                piece = buffer[: end - start]
+                expected = state.get_piece_digest(requested[0]) if state else None
+                verified = read_range_response(
+                    connection, piece, requested[0], expected
+                )
+                index = requested.popleft()
+
+            except OSError as e:
+                LOGGER.warning("Error receiving %s from %s: %s", file_name, peer, e)
+                ERRORS.inc(1, ("receive",))
+                # The stream is out of sync, so every outstanding request is lost.
+                while requested:
+                    scheduler.fail_piece(requested.popleft())
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                failures += 1
+                continue
+
+            stored = store_piece(
+                peer,
+                file_name,
+                output_fd,
+                scheduler,
+                state,
+                index,
+                piece,
+                verified,
+                requested_at.pop(index),
+            )
+            if stored is None:
+                return
+            failures = 0 if stored else failures + 1
+
+        LOGGER.warning(
+            "Giving up on %s after %s failed segments.", peer, MAX_PEER_FAILURES
+        )
+
+    finally:
+        ACTIVE_TRANSFERS.dec(1, ("download",))
+        # Outstanding requests leave the stream mid-response, so it cannot be reused.
+        if requested and connection is not None:
+            connection.close()
+            connection = None
+        while requested:
+            scheduler.fail_piece(requested.popleft())
+        if connection is not None:
+            pool.release(connection)
+
+
+def prepare_resume(
+    peers: list,
+    file_name: str,
+    file_size: int,
+    output_file: str,
+    pool,
+    root_hash: Optional[str] = None,
+) -> tuple:
+    """
+    Load or create the sidecar state of a resumable download.
+
+    Returns (state, pieces already on disk). The state is None if no peer
+    can provide the piece hashes needed to verify a resumed download. With
+    `root_hash`, only piece hashes that add up to that root are accepted.
+    """
+    for peer, *_ in peers:
+        manifest = request_manifest(peer, file_name, file_size, pool)
+        if manifest is None:
+            continue
+        if root_hash is None or get_root_hash(manifest[1]) == root_hash:
+            break
+        LOGGER.warning(
+            "%s sent piece hashes for other content than %s", peer, file_name
+        )
+    else:
+        LOGGER.warning(
+            "No peer sent piece hashes for %s; it cannot be resumed.", file_name
+        )
+        return None, []
+
+    piece_size, piece_hashes = manifest
+    root_hash = get_root_hash(piece_hashes)
+    state_path = get_state_path(output_file)
+
+    verified = []
+    state = DownloadState.load(state_path)
+    if (
+        state is not None
+        and state.matches(file_size, piece_size, root_hash)
+        and os.path.exists(output_file)
+    ):
+        verified = state.verify_pieces(output_file)
+        LOGGER.info(
+            "Resuming %s: %s of %s pieces already downloaded.",
+            file_name,
+            len(verified),
+            len(piece_hashes),
+        )
     else:
-        regular_print(f"File {file_name} not found on {peer_ip}.")
+        state = DownloadState(
+            state_path, file_name, file_size, piece_size, piece_hashes, root_hash
+        )
+    state.save()
+    return state, verified
+
+
+def set_aside_output(
+    output_file: str, chunk_store: ChunkStore, resuming: bool = False
+) -> Optional[str]:
+    """
+    Move an earlier download out of the way of a new one, keeping its chunks readable.
+
+    An earlier download that an unfinished attempt already set aside stays
+    where it is, and so does the output of a download being resumed.
+    Returns the path of the earlier download, for the caller to delete once
+    the new download completes, or None if there is none.
+    """
+    previous = output_file + ".previous"
+    if os.path.exists(previous):
+        return previous
+    if resuming or not os.path.exists(output_file):
+        return None
+    os.replace(output_file, previous)
+    chunk_store.move_file(os.path.abspath(output_file), os.path.abspath(previous))
+    return previous
+
+
+def reuse_local_chunks(
+    peers: list,
+    file_name: str,
+    output_fd: int,
+    state: DownloadState,
+    done: List[int],
+    pool,
+    chunk_store: ChunkStore,
+) -> tuple:
+    """
+    Fill pieces of a download from chunks of local files instead of the network.
+
+    The file's chunk list is fetched from the first peer that has one, and
+    every chunk found in `chunk_store` is copied to its offset in
+    `output_fd`. Pieces entirely covered by such chunks are then checked
+    against the piece hashes of `state` and recorded in it, so only the
+    others need fetching. Pieces in `done` are left alone.
+
+    Returns (chunk list, or None if no peer sent one; indices of the pieces
+    filled).
+    """
+    for peer, *_ in peers:
+        chunks = request_chunk_list(peer, file_name, state.file_size, pool)
+        if chunks is not None:
+            break
+    else:
+        return None, []
+
+    piece_size = state.piece_size
+    done = set(done)
+    covered = {}  # Piece index -> bytes of it copied from local chunks
+    offset = 0
+    for length, chunk_hash in chunks:
+        start, end = offset, offset + length
+        offset = end
+        pieces = range(start // piece_size, (end - 1) // piece_size + 1)
+        if done.issuperset(pieces):
+            continue
+        data = chunk_store.read_chunk(chunk_hash, length)
+        if data is None:
+            continue
+        write_piece(output_fd, memoryview(data), start)
+        for index in pieces:
+            piece_start = index * piece_size
+            piece_end = min(piece_start + piece_size, state.file_size)
+            overlap = min(end, piece_end) - max(start, piece_start)
+            covered[index] = covered.get(index, 0) + overlap
+
+    reused = []
+    for index, count in sorted(covered.items()):
+        piece_start = index * piece_size
+        piece_length = min(piece_size, state.file_size - piece_start)
+        if index in done or count != piece_length:
+            continue
+        piece = os.pread(output_fd, piece_length, piece_start)
+        if hashlib.sha256(piece).digest() != state.get_piece_digest(index):
+            continue
+        state.mark_piece(index)
+        reused.append(index)
+
+    LOGGER.info(
+        "Reused %s of %s pieces of %s from local files.",
+        len(reused),
+        len(state.piece_hashes),
+        file_name,
+    )
+    return chunks, reused
+
+
+class Download:
+    """
+    The output file of a multi-peer download, its resume state and its pieces.
+
+    Shared by the threaded and asyncio downloaders, which only differ in how
+    they run the per-peer workers between prepare() and finish().
+
+    Attributes:
+        file_name (str): Name of the file being downloaded.
+        request_name (str): Name its pieces are requested under.
+        output_fd (int): Descriptor of the pre-sized output file.
+        scheduler (PieceScheduler): Hands out the pieces still missing.
+        state (Optional[DownloadState]): Resume state, if piece hashes are known.
+    """
+
+    def __init__(
+        self,
+        file_name: str,
+        request_name: str,
+        output_file: str,
+        output_fd: int,
+        scheduler: PieceScheduler,
+        state: Optional[DownloadState],
+        chunks: Optional[List[tuple]],
+        previous: Optional[str],
+        chunk_store: Optional[ChunkStore],
+    ) -> None:
+        self.file_name = file_name
+        self.request_name = request_name
+        self.output_file = output_file
+        self.output_fd = output_fd
+        self.scheduler = scheduler
+        self.state = state
+        self.chunks = chunks
+        self.previous = previous
+        self.chunk_store = chunk_store
+
+    @classmethod
+    def prepare(
+        cls,
+        peers: list,
+        file_name: str,
+        piece_size: int,
+        pool,
+        resume: bool,
+        root_hash: Optional[str],
+        chunk_store: Optional[ChunkStore],
+    ) -> Optional["Download"]:
+        """
+        Open the output file of a download, filling what is already available locally.
+
+        See receive_file_from_peers for the arguments. Returns None if the
+        download cannot start. Fetches piece hashes and chunk lists and
+        verifies pieces on disk, so it blocks.
+        """
+        # Ensure all peers have the same file size
+        file_sizes = {peer[1] for peer in peers}
+        if len(file_sizes) != 1:
+            LOGGER.warning("Peer list is not consistent. Cannot download file.")
+            return None
+
+        file_size = file_sizes.pop()
+        output_file = f"downloaded_{file_name}"
+        request_name = make_content_name(root_hash) if root_hash else file_name
+        reuse = chunk_store is not None and file_size >= MIN_CHUNKED_FILE_SIZE
+
+        state, done = None, []
+        if resume or root_hash or reuse:
+            state, done = prepare_resume(
+                peers, request_name, file_size, output_file, pool, root_hash
+            )
+            if state is not None:
+                piece_size = state.piece_size
+            elif root_hash:
+                return None
+        reuse = reuse and state is not None
+        previous = (
+            set_aside_output(output_file, chunk_store, bool(done)) if reuse else None
+        )
+
+        # Pre-size the output once; workers then write their pieces in place.
+        flags = os.O_RDWR | os.O_CREAT | (0 if done else os.O_TRUNC)
+        output_fd = os.open(output_file, flags, 0o644)
+        chunks = None
+        try:
+            os.ftruncate(output_fd, file_size)
+            if reuse:
+                chunks, reused = reuse_local_chunks(
+                    peers, request_name, output_fd, state, done, pool, chunk_store
+                )
+                done = done + reused
+        except BaseException:
+            os.close(output_fd)
+            raise
+        scheduler = PieceScheduler(file_size, piece_size, done)
+        return cls(
+            file_name,
+            request_name,
+            output_file,
+            output_fd,
+            scheduler,
+            state,
+            chunks,
+            previous,
+            chunk_store,
+        )
+
+    def finish(self) -> bool:
+        """
+        Close the output file and settle the resume state.
+
+        Returns True if every piece verified.
+        """
+        os.close(self.output_fd)
+        scheduler = self.scheduler
+        if not scheduler.is_complete():
+            LOGGER.warning(
+                "Download of %s incomplete: %s of %s pieces missing.",
+                self.file_name,
+                scheduler.get_missing_count(),
+                scheduler.piece_count,
+            )
+            if self.state is not None:
+                self.state.close()
+                LOGGER.info("Download it again to resume from where it stopped.")
+            # The earlier download stays readable for the next attempt.
+            return False
+
+        if self.previous is not None:
+            os.remove(self.previous)
+            self.chunk_store.remove_file(os.path.abspath(self.previous))
+        if self.state is not None:
+            self.state.remove()
+        if self.chunks is not None:
+            self.chunk_store.add_file(os.path.abspath(self.output_file), self.chunks)
+        LOGGER.info("File %s successfully downloaded from peers.", self.file_name)
+        return True
+
+
+def receive_file_from_peers(
+    peers: list,
+    file_name: str,
+    piece_size: int = PIECE_SIZE,
+    pool: ConnectionPool = CONNECTION_POOL,
+    resume: bool = False,
+    compression: int = COMPRESSION_NONE,
+    root_hash: Optional[str] = None,
+    chunk_store: Optional[ChunkStore] = None,
+) -> bool:
+    """
+    Download a file from several peers at once. Returns True if every piece verified.
+
+    The file is split into fixed-size pieces and each peer's worker pulls the
+    next missing piece as soon as it finishes one, so throughput follows the
+    combined bandwidth of the peers rather than the slowest one. Pieces from
+    peers that fail or stall are reassigned (see PieceScheduler). Requests are
+    pipelined over keep-alive connections taken from `pool`.
+
+    With `resume`, the source's piece hashes are fetched first and progress is
+    saved in a sidecar file next to the output (see DownloadState). If an
+    earlier download of the same file was interrupted, the pieces it wrote are
+    verified and only the missing ones are fetched.
+
+    `compression` is the codec (see common.compression) to ask peers for.
+
+    With `root_hash` (see discovery.FileSource), the content is requested by
+    hash, so holders may share it under any name, and a different file that
+    happens to have the same name is never mixed in. Its piece hashes are
+    fetched and checked against `root_hash` as for a resume, and every piece
+    is verified against them.
+
+    With a `chunk_store`, pieces of files of at least MIN_CHUNKED_FILE_SIZE
+    bytes that can be assembled from chunks of local files are not fetched
+    (see reuse_local_chunks), and the finished file's chunks are added to the
+    store. An earlier download to the same output file is kept until the
+    download completes, so a new revision of a file can reuse the old one,
+    even across failed attempts.
+    """
+    download = Download.prepare(
+        peers, file_name, piece_size, pool, resume, root_hash, chunk_store
+    )
+    if download is None:
+        return False
+
+    try:
+        threads = []
+        for peer, *_ in peers:
+            thread = threading.Thread(
+                target=_download_pieces_from_peer,
+                args=(
+                    peer,
+                    download.request_name,
+                    download.output_fd,
+                    download.scheduler,
+                    pool,
+                    download.state,
+                    compression,
+                ),
+            )
+            thread.start()
+            threads.append(thread)
+
+        # Wait for all threads to complete
+        for thread in threads:
+            thread.join()
+    finally:
+        complete = download.finish()
+    return complete
+
+
+def receive_file_from_peer(peer_ip: tuple, file_name: str) -> bool:
+    """Download a whole file from a single peer."""
+    file_size = search_file_from_peer(peer_ip, file_name)
+    if file_size is False:
+        LOGGER.info("File %s not found on %s.", file_name, peer_ip)
+        return False
 
-    client_socket.close()
+    LOGGER.info("Receiving file %s from %s...", file_name, peer_ip)
+    return receive_file_from_peers([(peer_ip, file_size)], file_name)
@@ -1,8 +1,11 @@
+from typing import Optional
 import socket
 import time
 import os
 from common.control_block import ControlBlock
+from common.manifest import load_manifest
 from common.debug_print import debug_print, regular_print
+from file_share.bulk_share import ShareJob
 
 
 # filename should be provided in absolute paths.
@@ -10,8 +13,8 @@ def upload_file(control_blk: ControlBlock, filename: str):
     try:
         # Try to open the file in read mode to check if it exists
         with open(filename, "rb") as file:
-            # If the file opens successfully, add it to the file list
-            control_blk.file_list.append(filename)
+            # If the file opens successfully, hash its pieces and add it to the file list
+            control_blk.add_file(filename, load_manifest(filename))
             regular_print(f"File '{filename}' uploaded successfully.")
     except FileNotFoundError:
         # If the file is not found, debug_print an error message
@@ -21,3 +24,24 @@ def upload_file(control_blk: ControlBlock, filename: str):
         regular_print(
             f"Error: An unexpected error occurred while uploading '{filename}': {e}"
         )
+
+
+def remove_file(control_blk: ControlBlock, filename: str):
+    if control_blk.remove_file(filename):
+        regular_print(f"File '{filename}' is no longer shared.")
+    else:
+        regular_print(f"Error: The file '{filename}' is not being shared.")
+
+
+def share_directory(control_blk: ControlBlock, directory: str) -> Optional[ShareJob]:
+    """Start sharing every file under `directory`; hashing continues in the background."""
+    if not os.path.isdir(directory):
+        regular_print(f"Error: '{directory}' is not a directory.")
+        return None
+    job = ShareJob(control_blk, directory)
+    job.start()
+    regular_print(
+        f"Sharing files under '{job.root}'. They can be found right away; "
+        "type 'progress' to follow the hashing."
+    )
+    return job
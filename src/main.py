@@ -1,32 +1,58 @@
+from typing import List, Optional
 import sys
+import argparse
+import functools
 import threading
 from common.control_block import ControlBlock
-from file_share.upload import upload_file
+from file_share.upload import upload_file, remove_file, share_directory
+from file_share.bulk_share import RevalidateJob, ShareJob
+from file_share.piece_cache import PIECE_CACHE, PIECE_CACHE_SIZE
 
 from file_share.send_recv_tcp import (
+    CONNECTION_POOL,
     receive_file_from_peer,
     start_file_server,
     receive_file_from_peers,
 )
 from peer_discovery.discovery import (
+    FileSource,
     listen_for_broadcast_and_handle_requests,
     send_broadcast,
-    search_for_file_within_peers,
+    find_file_sources,
 )
+from async_node import AsyncNode
+from file_share.rate_limiter import UploadLimiter, parse_rate
+from common.metrics import format_stats, start_metrics_server
+from common.chunk_store import CHUNK_STORE_PATH, ChunkStore
+from common.protocol import COMPRESSION_NAMES
+from common.share_index import SHARE_INDEX_PATH, ShareIndex
 from common.debug_print import (
-    debug_print,
     regular_print,
     debug_print_on,
     debug_print_off,
+    configure_log_levels,
+    flush_logs,
 )
 
 
-def handle_user_input(control_blk: ControlBlock) -> None:
+def handle_user_input(
+    control_blk: ControlBlock,
+    download_file=receive_file_from_peers,
+    limiter: UploadLimiter = None,
+    share_jobs: List[ShareJob] = None,
+) -> None:
     """
     Main thread function to process user commands.
+
+    `download_file` fetches a file from the peers found for it, with the
+    signature of receive_file_from_peers. `limiter` holds the upload limits
+    the `limit` command changes. `share_jobs` are background share jobs
+    already running, whose progress the `progress` command reports.
     """
+    share_jobs = list(share_jobs or [])
     while True:
-        # Get user input in the main thread
+        # Get user input in the main thread, after any queued output
+        flush_logs()
         command = (
             input("\nEnter a command (help, upload, download, exit): ").strip().lower()
         )
@@ -35,28 +61,69 @@ def handle_user_input(control_blk: ControlBlock) -> None:
             regular_print("Available commands:")
             regular_print("  - help: Display this help message.")
             regular_print("  - upload: Upload a file.")
+            regular_print("  - share: Share every file in a directory.")
+            regular_print("  - progress: Show the progress of directory shares.")
+            regular_print("  - remove: Stop sharing an uploaded file.")
             regular_print("  - download: Download a file from a peer.")
+            regular_print("  - stats: Show transfer, search and error statistics.")
+            regular_print("  - limit: Set the upload rate limits.")
             regular_print("  - exit: Exit the program.")
 
         elif command == "upload":
             filename = input("Enter the absolute path of the file you want to upload: ")
             upload_file(control_blk, filename)  # Upload the file to ControlBlock
 
+        elif command == "share":
+            directory = input("Enter the absolute path of the directory to share: ")
+            job = share_directory(control_blk, directory)
+            if job is not None:
+                share_jobs.append(job)
+
+        elif command == "progress":
+            if not share_jobs:
+                regular_print("No directories are being shared.")
+            for job in share_jobs:
+                regular_print(job.get_progress())
+
+        elif command == "remove":
+            filename = input("Enter the name of the file you want to stop sharing: ")
+            remove_file(control_blk, filename)
+
         elif command == "download":
             filename = input("Enter the name of the file you want to download: ")
-            peers = search_for_file_within_peers(control_blk, filename)
-            if not peers:
-                regular_print(f"File '{filename}' not found within peers currently.")
+            sources = find_file_sources(control_blk, filename, broadcast=True)
+            source = choose_file_source(filename, sources)
+            if source is not None:
+                download_file(
+                    source.peers, filename, resume=True, root_hash=source.root_hash
+                )
+
+        elif command == "stats":
+            regular_print(format_stats())
+
+        elif command == "limit" and limiter is not None:
+            try:
+                global_rate = parse_rate(
+                    input("Total upload limit in bytes/s (e.g. 10M, 0 for none): ")
+                )
+                peer_rate = parse_rate(
+                    input("Upload limit per peer in bytes/s (e.g. 2M, 0 for none): ")
+                )
+            except ValueError as e:
+                regular_print(f"Error: {e}")
             else:
-                receive_file_from_peers(peers, filename)
+                limiter.set_limits(global_rate, peer_rate)
+                regular_print("Upload limits updated.")
 
         elif command == "exit":
             regular_print("Exiting the program.")
+            for job in share_jobs:
+                job.cancel()
             break
 
         elif command == "debug":
             regular_print("Debugging Information:")
-            regular_print(f"Peer List: {control_blk.peer_list}")
+            regular_print(f"Peer List: {list(control_blk.peers.values())}")
             regular_print(f"Peer to File Mapping: {control_blk.peer_to_file}")
             regular_print(f"Local File List: {control_blk.file_list}")
         elif command == "debugprinton":
@@ -70,12 +137,159 @@ def handle_user_input(control_blk: ControlBlock) -> None:
             )
 
 
+def choose_file_source(
+    filename: str, sources: List[FileSource]
+) -> Optional[FileSource]:
+    """Pick which version of a file to download, asking if peers hold several."""
+    if not sources:
+        regular_print(f"File '{filename}' not found within peers currently.")
+        return None
+    if len(sources) == 1:
+        return sources[0]
+
+    regular_print(f"Peers hold {len(sources)} different files named '{filename}':")
+    for number, source in enumerate(sources, 1):
+        root = source.root_hash or "not hashed yet"
+        regular_print(
+            f"  {number}. {source.size} bytes, {len(source.holders)} peers, {root}"
+        )
+    choice = input("Enter the number of the one to download: ").strip()
+    if not choice.isdigit() or not 1 <= int(choice) <= len(sources):
+        regular_print("Download cancelled.")
+        return None
+    return sources[int(choice) - 1]
+
+
 def main():
-    # Create the ControlBlock instance
-    control_blk = ControlBlock()
+    parser = argparse.ArgumentParser(description="LAN peer-to-peer file sharing")
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run discovery, the file server and downloads on one asyncio event loop",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics",
+    )
+    parser.add_argument(
+        "--log-level",
+        default="info",
+        help="log levels, e.g. 'debug' or 'info,transfer=debug,discovery=warning'",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSION_NAMES,
+        default="none",
+        help="ask peers to compress downloaded pieces that compress well",
+    )
+    parser.add_argument(
+        "--upload-limit",
+        type=parse_rate,
+        default=0,
+        help="total upload rate in bytes/s, e.g. 10M (default: unlimited)",
+    )
+    parser.add_argument(
+        "--peer-upload-limit",
+        type=parse_rate,
+        default=0,
+        help="upload rate to each peer in bytes/s, e.g. 2M (default: unlimited)",
+    )
+    parser.add_argument(
+        "--piece-cache-size",
+        type=parse_rate,
+        default=PIECE_CACHE_SIZE,
+        help="memory for compressed and hashed pieces kept to serve other peers, "
+        f"e.g. 256M (default: {PIECE_CACHE_SIZE // 1024 // 1024}M; 0 for none)",
+    )
+    parser.add_argument(
+        "--share-index",
+        default=SHARE_INDEX_PATH,
+        help=f"file the shared files are remembered in across restarts "
+        f"(default: {SHARE_INDEX_PATH}; '' to forget them on exit)",
+    )
+    parser.add_argument(
+        "--chunk-store",
+        default=CHUNK_STORE_PATH,
+        help=f"file indexing the chunks of local files, so downloads reuse them "
+        f"(default: {CHUNK_STORE_PATH}; '' to always download whole files)",
+    )
+    args = parser.parse_args()
+    try:
+        configure_log_levels(args.log_level)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Create the ControlBlock instance, with the files shared in earlier runs
+    share_index = ShareIndex(args.share_index) if args.share_index else None
+    chunk_store = ChunkStore(args.chunk_store) if args.chunk_store else None
+    control_blk = ControlBlock(share_index, chunk_store)
+    share_jobs = []
+    if control_blk.file_list:
+        regular_print(f"Sharing {len(control_blk.file_list)} files from earlier runs.")
+        job = RevalidateJob(control_blk)
+        job.start()
+        share_jobs.append(job)
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = start_metrics_server(args.metrics_port)
+        regular_print(f"Serving metrics on port {args.metrics_port}")
+
+    compression = COMPRESSION_NAMES[args.compression]
+    PIECE_CACHE.resize(args.piece_cache_size)
+    limiter = UploadLimiter(args.upload_limit, args.peer_upload_limit)
+    try:
+        if args.asyncio:
+            run_async_node(control_blk, compression, limiter, share_jobs)
+        else:
+            run_threaded_node(control_blk, compression, limiter, share_jobs)
+    finally:
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+
+
+def run_async_node(
+    control_blk: ControlBlock,
+    compression: int,
+    limiter: UploadLimiter,
+    share_jobs: List[ShareJob],
+) -> None:
+    node = AsyncNode(control_blk, limiter=limiter)
+    node.start()
+    try:
+        handle_user_input(
+            control_blk,
+            functools.partial(
+                node.download,
+                compression=compression,
+                chunk_store=control_blk.chunk_store,
+            ),
+            limiter,
+            share_jobs,
+        )
+    finally:
+        node.stop()
+        CONNECTION_POOL.close_all()
+
+
+def run_threaded_node(
+    control_blk: ControlBlock,
+    compression: int,
+    limiter: UploadLimiter,
+    share_jobs: List[ShareJob],
+) -> None:
     thread_var = threading.Event()
 
-    server_thread = threading.Thread(target=start_file_server, args=(control_blk,))
+    server_thread = threading.Thread(
+        target=start_file_server,
+        args=(
+            control_blk,
+            thread_var,
+        ),
+        kwargs={"limiter": limiter},
+    )
     server_thread.daemon = True
     server_thread.start()
 
@@ -89,12 +303,32 @@ def main():
     peer_discovery_thread.daemon = True
     peer_discovery_thread.start()
 
-    broadcast_thread = threading.Thread(target=send_broadcast, args=(thread_var,))
+    broadcast_thread = threading.Thread(
+        target=send_broadcast,
+        args=(
+            thread_var,
+            control_blk,
+        ),
+    )
     broadcast_thread.daemon = True
     broadcast_thread.start()
 
     # Main thread handles user input
-    handle_user_input(control_blk)
+    handle_user_input(
+        control_blk,
+        functools.partial(
+            receive_file_from_peers,
+            compression=compression,
+            chunk_store=control_blk.chunk_store,
+        ),
+        limiter,
+        share_jobs,
+    )
+
+    # Stop accepting new transfers and let in-flight ones finish.
+    thread_var.set()
+    server_thread.join()
+    CONNECTION_POOL.close_all()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+"""
+Peer discovery on an asyncio event loop.
+
+The broadcast and file request sockets become datagram endpoints whose
+datagrams go through the same handlers as the threaded listener, and beacons
+are sent by a task instead of a thread.
+"""
+
+import asyncio
+import socket
+from common.control_block import ControlBlock
+from common.debug_print import get_logger
+from common.protocol import pack_hello
+from peer_discovery.discovery import (
+    BROADCAST_IP,
+    BROADCAST_PORT,
+    BEACON_INTERVAL,
+    PEER_TIMEOUT,
+    MY_FILE_REQUEST_PORT,
+    open_discovery_sockets,
+    handle_datagram,
+)
+
+LOGGER = get_logger("discovery")
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """
+    Hands every datagram on a discovery socket to discovery.handle_datagram.
+
+    Attributes:
+        control_blk (ControlBlock): Peer and file state to answer from and update.
+        from_broadcast (bool): Whether this is the broadcast listening socket.
+        catalog_chunks (dict): Partially received catalogs, shared by both sockets.
+        reply_transport (asyncio.DatagramTransport): Transport replies are sent from.
+    """
+
+    def __init__(
+        self,
+        control_blk: ControlBlock,
+        from_broadcast: bool,
+        catalog_chunks: dict,
+        reply_transport: asyncio.DatagramTransport = None,
+    ) -> None:
+        self.control_blk = control_blk
+        self.from_broadcast = from_broadcast
+        self.catalog_chunks = catalog_chunks
+        self.reply_transport = reply_transport
+
+    def connection_made(self, transport) -> None:
+        if self.reply_transport is None:
+            self.reply_transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        # A DatagramTransport has the same sendto(data, addr) as a socket.
+        handle_datagram(
+            self.control_blk,
+            data,
+            addr,
+            self.from_broadcast,
+            self.reply_transport,
+            self.catalog_chunks,
+        )
+
+    def error_received(self, exc: Exception) -> None:
+        LOGGER.debug("Discovery socket error: %s", exc)
+
+
+async def open_discovery_endpoints(control_blk: ControlBlock) -> tuple:
+    """
+    Bind the discovery sockets as datagram endpoints on the running loop.
+
+    Returns the (beacon, broadcast, file request) transports.
+    """
+    loop = asyncio.get_running_loop()
+    broadcast_sock, file_request_sock = open_discovery_sockets()
+    beacon_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    beacon_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    # Partially received catalogs, keyed by (peer, version, since, total)
+    catalog_chunks = {}
+
+    file_request_transport, _ = await loop.create_datagram_endpoint(
+        lambda: DiscoveryProtocol(control_blk, False, catalog_chunks),
+        sock=file_request_sock,
+    )
+    broadcast_transport, _ = await loop.create_datagram_endpoint(
+        lambda: DiscoveryProtocol(
+            control_blk, True, catalog_chunks, file_request_transport
+        ),
+        sock=broadcast_sock,
+    )
+    beacon_transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, sock=beacon_sock
+    )
+    return beacon_transport, broadcast_transport, file_request_transport
+
+
+async def run_discovery(
+    control_blk: ControlBlock, stop: asyncio.Event, transports: tuple = None
+) -> None:
+    """
+    Answer discovery traffic, send beacons and expire silent peers until `stop` is set.
+
+    `transports` are endpoints from open_discovery_endpoints, opened here if
+    not given. They are closed on return.
+    """
+    if transports is None:
+        transports = await open_discovery_endpoints(control_blk)
+    beacon_transport = transports[0]
+
+    try:
+        while not stop.is_set():
+            for peer in control_blk.expire_peers(PEER_TIMEOUT):
+                LOGGER.debug("Removing peer %s after missed beacons", peer)
+
+            catalog_version = control_blk.catalog_version
+            beacon_transport.sendto(
+                pack_hello(MY_FILE_REQUEST_PORT, catalog_version),
+                (BROADCAST_IP, BROADCAST_PORT),
+            )
+            LOGGER.debug(
+                "Broadcasting HELLO from port %s, catalog version %s",
+                MY_FILE_REQUEST_PORT,
+                catalog_version,
+            )
+
+            try:
+                await asyncio.wait_for(stop.wait(), BEACON_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    finally:
+        LOGGER.info("Finishing broadcasting...")
+        for transport in transports:
+            transport.close()
@@ -3,14 +3,46 @@ import time
 import os
 import threading
 import select
-from typing import List
+import json
+from typing import Dict, List, Optional
 from common.control_block import ControlBlock
-from common.debug_print import debug_print, regular_print
+from common.debug_print import get_logger
+from common.metrics import ERRORS, SEARCH_RTT
+from common.protocol import (
+    MSG_HELLO,
+    MSG_FILE_QUERY,
+    MSG_FILE_AVAILABLE,
+    MSG_FILE_NOT_AVAILABLE,
+    MSG_CATALOG_REQUEST,
+    MSG_CATALOG,
+    ProtocolError,
+    parse_datagram,
+    pack_hello,
+    unpack_hello,
+    pack_file_query,
+    unpack_file_query,
+    pack_file_available,
+    unpack_file_available,
+    pack_message,
+    pack_catalog_request,
+    unpack_catalog_request,
+    pack_catalog,
+    unpack_catalog,
+)
+
+LOGGER = get_logger("discovery")
 
 BROADCAST_IP = "255.255.255.255"  # Limited broadcast address, sending to this address broadcasts to all devices within LAN.
 BROADCAST_PORT = 50000  # Port to broadcast to
-MESSAGE = b"HELLO_PEER"  # Message to broadcast
-FILE_REQUEST_MESSAGE = b"REQUEST_FILE"
+BEACON_INTERVAL = 5  # Seconds between HELLO beacons
+PEER_TIMEOUT = 3 * BEACON_INTERVAL  # Peers silent for this long are expired
+SEARCH_TIMEOUT = 5  # Seconds to wait for all peers to answer a file search
+BROADCAST_SEARCH_TIMEOUT = 1  # Seconds to collect replies to a broadcast search
+CATALOG_PAYLOAD_SIZE = 8192  # Max bytes of catalog items per datagram
+MAX_DATAGRAM_SIZE = 65535  # Receive size on sockets that may get catalog datagrams
+CATALOG_RECEIVE_BUFFER_SIZE = 1024 * 1024  # Requested SO_RCVBUF for catalog bursts
+MAX_PARTIAL_CATALOGS = 4  # Incomplete catalogs kept per peer
+PARTIAL_CATALOG_TIMEOUT = PEER_TIMEOUT  # Seconds an incomplete catalog is kept
 
 """Listen for UDP broadcasts and handle file requests on a specific port."""
 MY_FILE_REQUEST_PORT = 50001 + (os.getpid() % 10)  # Each process gets a unique port
@@ -18,11 +50,11 @@ MY_SERVER_PORT = MY_FILE_REQUEST_PORT + 10000
 
 
 def close_socket(sock):
-    debug_print("Closing socket...")
+    LOGGER.debug("Closing socket...")
     try:
         sock.close()
     except Exception as e:
-        debug_print(f"Error closing socket: {e}")
+        LOGGER.debug("Error closing socket: %s", e)
 
 
 # TODO: Consider debug mode (filtering out the correct local ip will make local threads communication fail)
@@ -45,7 +77,7 @@ def get_local_ip():
 """Broadcasts a message periodically to all devices in the local network with UDP."""
 
 
-def send_broadcast(threading_event: threading.Event):
+def send_broadcast(threading_event: threading.Event, control_blk: ControlBlock = None):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 
     # Enable broadcasting
@@ -53,42 +85,170 @@ def send_broadcast(threading_event: threading.Event):
 
     try:
         while not threading_event.is_set():
-            # Include file request port in broadcast message
-            message = f"{MESSAGE.decode()} {MY_FILE_REQUEST_PORT}".encode()
+            # Include file request port and catalog version in broadcast message,
+            # so peers know when to pull our catalog.
+            catalog_version = control_blk.catalog_version if control_blk else 0
+            message = pack_hello(MY_FILE_REQUEST_PORT, catalog_version)
             sock.sendto(message, (BROADCAST_IP, BROADCAST_PORT))
-            debug_print(f"Broadcasting message: {message.decode()}")
+            LOGGER.debug(
+                "Broadcasting HELLO from port %s, catalog version %s",
+                MY_FILE_REQUEST_PORT,
+                catalog_version,
+            )
 
-            time.sleep(5)  # Broadcast every 5 seconds
+            time.sleep(BEACON_INTERVAL)
     finally:
-        print("Finishing broadcasting...")
+        LOGGER.info("Finishing broadcasting...")
         close_socket(sock)
 
 
 BUFFER_SIZE = 1024  # Buffer size for receiving messages
 
 
-def handle_file_request(control_blk, sock, data, addr):
-    debug_print(f"Received message: {data.decode()} from {addr}")
-    requested_file = data.decode()[len(FILE_REQUEST_MESSAGE.decode()) :].strip()
-    debug_print(f"Received file request for {requested_file} from {addr}")
+def handle_file_request(control_blk, sock, request_id: int, payload, addr):
+    requested_file = unpack_file_query(payload)
+    LOGGER.debug("Received file request for %s from %s", requested_file, addr)
 
-    # Check if the file exists
-    if control_blk.check_file_available(requested_file):
-        # Respond with FILE_AVAILABLE if the file exists
-        response = b"FILE_AVAILABLE"
-        sock.sendto(response, addr)
-        sock.sendto(control_blk.get_file_size(requested_file).to_bytes(4, "big"), addr)
-        debug_print(f"Sent file availability response to {addr}")
+    # Answer in a single datagram echoing the request ID, so that a client
+    # querying many peers from one socket can match replies to its query.
+    entry = control_blk.get_shared_file(requested_file)
+    if entry is not None:
+        response = pack_file_available(request_id, entry.size, entry.root_hash)
     else:
-        # Respond with a message indicating the file is not available
-        response = b"FILE_NOT_AVAILABLE"
-        sock.sendto(response, addr)
-        debug_print(f"Sent file not available response to {addr}")
+        response = pack_message(MSG_FILE_NOT_AVAILABLE, request_id)
+    sock.sendto(response, addr)
+    LOGGER.debug("Sent file availability response to %s", addr)
 
 
-def listen_for_broadcast_and_handle_requests(
-    threading_event: threading.Event, control_blk: ControlBlock
+def request_catalog(
+    control_blk: ControlBlock, sock, peer: tuple, version: int, catalog_chunks
 ):
+    """
+    Ask a peer for the catalog changes since the version we last applied.
+
+    If an earlier reply for the advertised `version` arrived only in part (UDP
+    may drop datagrams), only the missing datagrams are requested again.
+    """
+    since = control_blk.peer_catalog_versions.get(peer, -1)
+    missing = []
+    for key in list(catalog_chunks):
+        if key[0] != peer:
+            continue
+        if key[1] == version:
+            since, total = key[2], key[3]
+            missing = sorted(set(range(total)) - catalog_chunks[key][1].keys())
+        else:
+            del catalog_chunks[key]  # Superseded by a newer version
+
+    sock.sendto(pack_catalog_request(since, missing), peer)
+    LOGGER.debug("Requested catalog of %s since version %s", peer, since)
+
+
+def handle_catalog_request(control_blk: ControlBlock, sock, payload, addr):
+    """
+    Send our catalog changes since the requested version.
+
+    A CATALOG_REQUEST carries the version the peer holds and optionally the
+    numbers of the only reply datagrams it still needs. Replies are split into
+    CATALOG datagrams carrying a JSON list of items each, with a since version
+    of -1 for a full snapshot.
+    """
+    requested_since, requested_seqs = unpack_catalog_request(payload)
+    version, full, items = control_blk.get_catalog_changes(requested_since)
+    since = -1 if full else requested_since
+
+    chunks, chunk, chunk_size = [], [], 0
+    for item in items:
+        encoded = json.dumps(item)
+        if chunk and chunk_size + len(encoded) > CATALOG_PAYLOAD_SIZE:
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0
+        chunk.append(encoded)
+        chunk_size += len(encoded) + 1
+    chunks.append(chunk)
+
+    seqs = range(len(chunks))
+    if requested_seqs:
+        seqs = [seq for seq in requested_seqs if seq < len(chunks)]
+
+    for seq in seqs:
+        items_json = f"[{','.join(chunks[seq])}]".encode()
+        sock.sendto(pack_catalog(version, since, seq, len(chunks), items_json), addr)
+    LOGGER.debug("Sent %s of %s catalog datagrams to %s", len(seqs), len(chunks), addr)
+
+
+def handle_catalog_response(control_blk: ControlBlock, payload, addr, catalog_chunks):
+    """
+    Collect catalog datagrams from a peer and apply them once all have arrived.
+
+    Raises ProtocolError for a datagram whose items are not catalog items.
+    """
+    version, since, seq, total, items_json = unpack_catalog(payload)
+    items = _parse_catalog_items(items_json)
+
+    key = (addr, version, since, total)
+    if key not in catalog_chunks:
+        _prune_partial_catalogs(catalog_chunks, addr)
+        catalog_chunks[key] = (time.monotonic(), {})
+    received = catalog_chunks[key][1]
+    received[seq] = items
+    if len(received) < total:
+        return
+
+    del catalog_chunks[key]
+    items = [item for seq in range(total) for item in received[seq]]
+    if control_blk.update_peer_catalog(
+        addr, version, items, None if since == -1 else since
+    ):
+        LOGGER.debug("Catalog of %s updated to version %s", addr, version)
+
+
+def _parse_catalog_items(items_json: bytes) -> List[list]:
+    items = json.loads(items_json)
+    if not isinstance(items, list) or not all(map(_is_catalog_item, items)):
+        raise ProtocolError("malformed catalog items")
+    return items
+
+
+def _is_catalog_item(item) -> bool:
+    """Whether `item` is a [name, size or None, root hash or None] list."""
+    if not isinstance(item, list) or len(item) != 3:
+        return False
+    name, size, root_hash = item
+    return (
+        isinstance(name, str)
+        and (size is None or type(size) is int and size >= 0)
+        and (root_hash is None or isinstance(root_hash, str))
+    )
+
+
+def _prune_partial_catalogs(catalog_chunks, addr) -> None:
+    """Make room for a new incomplete catalog from `addr`."""
+    cutoff = time.monotonic() - PARTIAL_CATALOG_TIMEOUT
+    for key, (started, _) in list(catalog_chunks.items()):
+        if started < cutoff:
+            del catalog_chunks[key]
+    from_peer = sorted(
+        (started, key) for key, (started, _) in catalog_chunks.items() if key[0] == addr
+    )
+    for _, key in from_peer[: max(0, len(from_peer) - MAX_PARTIAL_CATALOGS + 1)]:
+        del catalog_chunks[key]
+
+
+def _handle_hello(control_blk: ControlBlock, sock, payload, addr, catalog_chunks):
+    peer_port, catalog_version = unpack_hello(payload)
+    peer = (addr[0], peer_port)
+
+    if control_blk.touch_peer(peer):
+        LOGGER.debug("Adding peer %s with file request port %s", addr[0], peer_port)
+
+    # Pull the peer's catalog only when it has changed
+    if catalog_version != control_blk.peer_catalog_versions.get(peer):
+        request_catalog(control_blk, sock, peer, catalog_version, catalog_chunks)
+
+
+def open_discovery_sockets(file_request_port: int = MY_FILE_REQUEST_PORT) -> tuple:
+    """Bind the broadcast listening socket and this peer's file request socket."""
     broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
@@ -97,88 +257,371 @@ def listen_for_broadcast_and_handle_requests(
 
     file_request_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     file_request_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    file_request_sock.bind(("0.0.0.0", MY_FILE_REQUEST_PORT))
+    file_request_sock.bind(("0.0.0.0", file_request_port))
+    # Catalog replies arrive in bursts, so leave room to queue them.
+    file_request_sock.setsockopt(
+        socket.SOL_SOCKET, socket.SO_RCVBUF, CATALOG_RECEIVE_BUFFER_SIZE
+    )
 
-    debug_print(
-        f"Listening on {BROADCAST_PORT} for broadcasts and {MY_FILE_REQUEST_PORT} for file requests."
+    LOGGER.debug(
+        "Listening on %s for broadcasts and %s for file requests.",
+        BROADCAST_PORT,
+        file_request_port,
     )
+    return broadcast_sock, file_request_sock
+
+
+def handle_datagram(
+    control_blk: ControlBlock,
+    data: bytes,
+    addr,
+    from_broadcast: bool,
+    reply_sock,
+    catalog_chunks,
+):
+    """
+    Dispatch one discovery datagram to its handler.
+
+    Replies and catalog requests go out through `reply_sock`, the file request
+    socket (or anything with the same sendto()), so their source address
+    identifies us even when the datagram arrived on the broadcast socket.
+    """
+    # Dispatch on the message type from the fixed header; only the handler
+    # for that type looks at the payload.
+    try:
+        msg_type, _, request_id, payload = parse_datagram(data)
+
+        if msg_type == MSG_FILE_QUERY:
+            handle_file_request(control_blk, reply_sock, request_id, payload, addr)
+        elif from_broadcast:
+            if msg_type == MSG_HELLO:
+                _handle_hello(control_blk, reply_sock, payload, addr, catalog_chunks)
+        elif msg_type == MSG_CATALOG_REQUEST:
+            handle_catalog_request(control_blk, reply_sock, payload, addr)
+        elif msg_type == MSG_CATALOG:
+            handle_catalog_response(control_blk, payload, addr, catalog_chunks)
+
+    except (ProtocolError, ValueError, TypeError, KeyError) as e:
+        LOGGER.debug("Ignoring malformed datagram from %s: %s", addr, e)
+
+
+def listen_for_broadcast_and_handle_requests(
+    threading_event: threading.Event,
+    control_blk: ControlBlock,
+    file_request_port: int = MY_FILE_REQUEST_PORT,
+):
+    broadcast_sock, file_request_sock = open_discovery_sockets(file_request_port)
+
+    # Partially received catalogs, keyed by (peer, version, since, total), as
+    # (time.monotonic() of the first datagram, items by datagram number)
+    catalog_chunks = {}
 
     try:
         while not threading_event.is_set():
+            for peer in control_blk.expire_peers(PEER_TIMEOUT):
+                LOGGER.debug("Removing peer %s after missed beacons", peer)
+
             ready_sockets, _, _ = select.select(
                 [broadcast_sock, file_request_sock], [], [], 5
             )
 
             for sock in ready_sockets:
-                data, addr = sock.recvfrom(BUFFER_SIZE)
-
-                if sock == broadcast_sock:
-                    message = data.decode().strip().split()
-                    if len(message) == 2 and message[0] == "HELLO_PEER":
-                        peer_ip, peer_port = addr[0], int(message[1])
-
-                        # Avoid adding self to the peer list
-                        if (peer_ip, peer_port) not in control_blk.peer_list:
-                            debug_print(
-                                f"Adding peer {peer_ip} with file request port {peer_port}"
-                            )
-                            control_blk.peer_list.append((peer_ip, peer_port))
-
-                elif sock == file_request_sock:
-                    if data.decode().startswith(FILE_REQUEST_MESSAGE.decode()):
-                        handle_file_request(control_blk, file_request_sock, data, addr)
+                data, addr = sock.recvfrom(MAX_DATAGRAM_SIZE)
+                handle_datagram(
+                    control_blk,
+                    data,
+                    addr,
+                    sock == broadcast_sock,
+                    file_request_sock,
+                    catalog_chunks,
+                )
 
     finally:
         close_socket(broadcast_sock)
         close_socket(file_request_sock)
 
 
-"""Request a file from a peer and return whether the file is available."""
+def parse_file_response(data: bytes, request_id: int):
+    """
+    Parse a reply to a file request.
 
+    Returns (size, root hash or None) if the peer has the file, None if it
+    does not, and False if the datagram is not a reply to `request_id`.
+    """
+    try:
+        msg_type, _, response_id, payload = parse_datagram(data)
+        if response_id != request_id:
+            return False
+        if msg_type == MSG_FILE_AVAILABLE:
+            return unpack_file_available(payload)
+    except ProtocolError:
+        return False
+    if msg_type == MSG_FILE_NOT_AVAILABLE:
+        return None
+    return False
+
+
+def _collect_file_responses(
+    sock,
+    request_id: int,
+    filename: str,
+    sent_at: float,
+    deadline: float,
+    max_results: int = None,
+    pending: set = None,
+    control_blk: ControlBlock = None,
+) -> List[tuple]:
+    """
+    Gather replies to `request_id` until `deadline`, as (peer, size, root hash).
+
+    With `pending`, only replies from those peers count and the wait ends as
+    soon as all of them have answered. Without it (a broadcast query) every
+    responder counts once and the wait lasts until the deadline. If
+    `control_blk` is given, responders' RTTs are recorded in its peer table
+    and peers still pending at the deadline are counted as failed.
+    """
+    peers_with_file = []
+    responded = set()
+    timed_out = False
+    while pending is None or pending:
+        remaining = deadline - time.monotonic()
+        ready_sockets = []
+        if remaining > 0:
+            ready_sockets, _, _ = select.select([sock], [], [], remaining)
+        if not ready_sockets:
+            timed_out = True
+            break
 
-def search_file_from_peer(peer_address: tuple, filename: str) -> bool:
-    # Create a UDP socket to send the request
+        try:
+            data, addr = sock.recvfrom(BUFFER_SIZE)
+        except OSError as e:  # e.g. ICMP port unreachable from a dead peer
+            LOGGER.debug("Error receiving file response: %s", e)
+            continue
+
+        response = parse_file_response(data, request_id)
+        if response is False or addr in responded:
+            continue
+        if pending is not None:
+            if addr not in pending:
+                continue
+            pending.discard(addr)
+        responded.add(addr)
+        rtt = time.monotonic() - sent_at
+        SEARCH_RTT.observe(rtt)
+        if control_blk is not None:
+            control_blk.record_peer_rtt(addr, rtt)
+
+        if response is None:
+            LOGGER.debug("Peer %s responded with no file.", addr)
+            continue
+        size, root_hash = response
+        LOGGER.info(
+            "File '%s' is available from %s. Size: %s bytes", filename, addr, size
+        )
+        peers_with_file.append((addr, size, root_hash))
+        if max_results is not None and len(peers_with_file) >= max_results:
+            break
+
+    for peer in pending or ():
+        LOGGER.debug("Request timed out for %s from %s.", filename, peer)
+        if timed_out:
+            ERRORS.inc(1, ("search_timeout",))
+            if control_blk is not None:
+                control_blk.record_peer_failure(peer)
+    return peers_with_file
+
+
+def _make_file_request(filename: str):
+    request_id = int.from_bytes(os.urandom(4), "big")
+    return request_id, pack_file_query(request_id, filename)
+
+
+def query_peers_for_file(
+    peers: List[tuple],
+    filename: str,
+    timeout: float = SEARCH_TIMEOUT,
+    max_results: int = None,
+    control_blk: ControlBlock = None,
+) -> List[tuple]:
+    """
+    Ask all `peers` for `filename` at once and collect the ones that have it.
+
+    Requests go out back to back from a single socket and replies are matched
+    by request ID, so the search takes one round trip to the slowest live peer
+    rather than a timeout per dead one. Returns when every peer has answered,
+    `timeout` seconds have passed, or `max_results` peers have the file.
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    request_id, request_message = _make_file_request(filename)
 
     try:
-        # Construct the request message
-        request_message = f"{FILE_REQUEST_MESSAGE.decode()} {filename}".encode()
+        pending = set()
+        sent_at = time.monotonic()
+        for peer in peers:
+            try:
+                sock.sendto(request_message, peer)
+                pending.add(peer)
+                LOGGER.debug("Check if '%s' is in %s", filename, peer)
+            except OSError as e:
+                LOGGER.debug("Could not send file request to %s: %s", peer, e)
+
+        deadline = time.monotonic() + timeout
+        return _collect_file_responses(
+            sock,
+            request_id,
+            filename,
+            sent_at,
+            deadline,
+            max_results,
+            pending,
+            control_blk,
+        )
 
-        # Send the request to the peer's address
-        sock.sendto(request_message, peer_address)
-        debug_print(f"Check if '{filename}' is in {peer_address}")
+    finally:
+        close_socket(sock)
 
-        # Set a timeout to receive the response (in case the file is not available)
-        sock.settimeout(5)  # Wait for 5 seconds for a response
 
-        try:
-            # Wait for the peer's response (whether file is available or not)
-            data, _ = sock.recvfrom(BUFFER_SIZE)
-            if data.decode() == "FILE_AVAILABLE":
-                size, _ = sock.recvfrom(4)
-                size = int.from_bytes(size, "big")
-                print(
-                    f"File '{filename}' is available from {peer_address}. Size: {size} bytes"
-                )
-                return size
-            else:
-                debug_print(f"Peer {peer_address} responded with no file.")
-                return False
-        except socket.timeout:
-            debug_print(f"Request timed out for {filename} from {peer_address}.")
-            return False
+def broadcast_query_for_file(
+    filename: str,
+    timeout: float = BROADCAST_SEARCH_TIMEOUT,
+    max_results: int = None,
+    control_blk: ControlBlock = None,
+) -> List[tuple]:
+    """
+    Ask every node on the LAN for `filename` with a single broadcast request.
+
+    Holders reply directly to us, so this finds peers we have not heard a
+    beacon from yet. Since the number of responders is unknown, it waits the
+    full `timeout` unless `max_results` holders answer first.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    request_id, request_message = _make_file_request(filename)
+
+    try:
+        sent_at = time.monotonic()
+        sock.sendto(request_message, (BROADCAST_IP, BROADCAST_PORT))
+        LOGGER.debug("Broadcast request for '%s'", filename)
+
+        deadline = sent_at + timeout
+        return _collect_file_responses(
+            sock,
+            request_id,
+            filename,
+            sent_at,
+            deadline,
+            max_results,
+            control_blk=control_blk,
+        )
 
     finally:
         close_socket(sock)
 
 
-def search_for_file_within_peers(cb: ControlBlock, filename: str) -> List[tuple]:
-    peer_list = cb.peer_list.copy()  # TODO: Fix this
-    peers_with_file = []
-    for peer in peer_list:
-        addr = (peer[0], BROADCAST_PORT)
-        if size := search_file_from_peer(peer, filename):
-            peers_with_file.append((peer, size))
-    cb.peer_list = peer_list
-    return peers_with_file
+"""Request a file from a peer and return its size if the file is available."""
+
+
+def search_file_from_peer(peer_address: tuple, filename: str):
+    peers_with_file = query_peers_for_file([peer_address], filename)
+    return peers_with_file[0][1] if peers_with_file else False
+
+
+def search_for_file_within_peers(
+    cb: ControlBlock,
+    filename: str,
+    timeout: float = None,
+    max_results: int = None,
+    broadcast: bool = False,
+    use_catalog: bool = True,
+) -> List[tuple]:
+    """
+    Find peers sharing `filename`, returning (peer, size, root hash) tuples,
+    fastest first. The root hash is None for holders that have not hashed the
+    file yet.
+
+    If gossiped catalogs list holders of the file, only those peers are asked
+    to confirm. Otherwise, or if none confirm, the peers in `cb.peer_list` are
+    queried. With `broadcast`, one broadcast query is sent instead and any
+    responders not yet in the peer list are added to it. Reply times and
+    timeouts update the peer table, so dead or slow peers drop out of
+    `cb.peer_list` or move to its end.
+    """
+    candidates = []
+    if use_catalog:
+        candidates = [peer for peer, _ in cb.find_peers_with_file(filename)]
+    if candidates:
+        peers_with_file = query_peers_for_file(
+            candidates, filename, timeout or SEARCH_TIMEOUT, max_results, cb
+        )
+        if peers_with_file:
+            return peers_with_file
+
+    if not broadcast:
+        if timeout is None:
+            timeout = SEARCH_TIMEOUT
+        return query_peers_for_file(cb.peer_list, filename, timeout, max_results, cb)
+
+    if timeout is None:
+        timeout = BROADCAST_SEARCH_TIMEOUT
+    return broadcast_query_for_file(filename, timeout, max_results, cb)
+
+
+class FileSource:
+    """
+    One version of a file found on the network, and the peers holding it.
+
+    Attributes:
+        root_hash (Optional[str]): Root hash of the content, None if the
+            holders have not hashed it (such holders cannot be told apart).
+        size (int): File size in bytes.
+        holders (List[tuple]): Peers holding this content, fastest first.
+    """
+
+    def __init__(self, root_hash: Optional[str], size: int) -> None:
+        self.root_hash = root_hash
+        self.size = size
+        self.holders: List[tuple] = []
+
+    @property
+    def peers(self) -> List[tuple]:
+        """The holders as (peer, size) pairs, as downloads take them."""
+        return [(holder, self.size) for holder in self.holders]
+
+    def __repr__(self) -> str:
+        root = self.root_hash[:16] if self.root_hash else "unhashed"
+        return f"FileSource({root}, {self.size} bytes, {len(self.holders)} holders)"
+
+
+def group_file_sources(peers_with_file: List[tuple]) -> List[FileSource]:
+    """Group search results by content, the version with the most holders first."""
+    sources: Dict[tuple, FileSource] = {}
+    for peer, size, root_hash in peers_with_file:
+        source = sources.setdefault((root_hash, size), FileSource(root_hash, size))
+        source.holders.append(peer)
+    return sorted(sources.values(), key=lambda source: -len(source.holders))
+
+
+def find_file_sources(
+    cb: ControlBlock,
+    filename: str,
+    timeout: float = None,
+    broadcast: bool = False,
+) -> List[FileSource]:
+    """
+    Search for `filename` and group the answers into the distinct contents found.
+
+    Peers sharing the same content under another name, according to their
+    gossiped catalogs, are added to its holders, since content is downloaded
+    by root hash rather than by name.
+    """
+    peers_with_file = search_for_file_within_peers(
+        cb, filename, timeout, broadcast=broadcast
+    )
+    sources = group_file_sources(peers_with_file)
+    for source in sources:
+        if source.root_hash is None:
+            continue
+        for peer, size in cb.find_peers_with_content(source.root_hash):
+            if size == source.size and peer not in source.holders:
+                source.holders.append(peer)
+    return sources
@@ -0,0 +1,92 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.async_node import AsyncNode
+from src.common.chunk_store import ChunkStore
+from src.common.chunking import chunk_file
+from src.common.control_block import ControlBlock
+from src.common.manifest import load_manifest
+from src.file_share import send_recv_tcp
+from src.peer_discovery.discovery import search_file_from_peer
+
+MY_FILE_REQUEST_PORT = 50001 + (os.getpid() % 10)
+
+
+class TestAsyncNode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "async_shared.bin")
+        self.content = os.urandom(64 * 1024 * 5 + 77)
+        with open(self.file_path, "wb") as file:
+            file.write(self.content)
+
+        self.control_blk = ControlBlock()
+        self.control_blk.file_list = [self.file_path]
+        self.node = AsyncNode(self.control_blk)
+        self.node.start()
+
+    def tearDown(self):
+        self.node.stop()
+        self.tmp_dir.cleanup()
+        if os.path.exists("downloaded_async_shared.bin"):
+            os.remove("downloaded_async_shared.bin")
+
+    def test_answers_file_queries(self):
+        peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        self.assertEqual(
+            search_file_from_peer(peer, "async_shared.bin"), len(self.content)
+        )
+        self.assertFalse(search_file_from_peer(peer, "missing.bin"))
+
+    def test_download_on_event_loop(self):
+        """Pieces should all come from the live peer when the other one is dead."""
+        live_peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        dead_peer = ("127.0.0.1", 40000)
+
+        success = self.node.download(
+            [(live_peer, len(self.content)), (dead_peer, len(self.content))],
+            "async_shared.bin",
+            piece_size=64 * 1024,
+        )
+        self.assertTrue(success)
+        with open("downloaded_async_shared.bin", "rb") as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_download_reuses_local_chunks(self):
+        """Pieces a local file already holds should not be fetched."""
+        local_copy = os.urandom(5 * 1024 * 1024)
+        local_path = os.path.join(self.tmp_dir.name, "local_copy.bin")
+        with open(local_path, "wb") as file:
+            file.write(local_copy)
+        content = local_copy + os.urandom(300 * 1024)
+        with open(self.file_path, "wb") as file:
+            file.write(content)
+        self.control_blk.add_file(
+            self.file_path, load_manifest(self.file_path, 64 * 1024, self.tmp_dir.name)
+        )
+        chunk_store = ChunkStore(":memory:")
+        chunk_store.add_file(local_path, chunk_file(local_path))
+
+        peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],))
+        success = self.node.download(
+            [(peer, len(content))], "async_shared.bin", chunk_store=chunk_store
+        )
+        self.assertTrue(success)
+        with open("downloaded_async_shared.bin", "rb") as file:
+            self.assertEqual(file.read(), content)
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],)) - received
+        self.assertLess(received, 2 * 1024 * 1024)
+        chunk_store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
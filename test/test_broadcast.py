@@ -11,9 +11,12 @@ sys.path.insert(
 )
 
 from src.common.control_block import ControlBlock
+from src.common.protocol import pack_catalog
 from src.peer_discovery.discovery import (
+    MAX_PARTIAL_CATALOGS,
     send_broadcast,
     listen_for_broadcast_and_handle_requests,
+    handle_datagram,
 )
 from src.common.debug_print import debug_print, regular_print
 
@@ -72,9 +75,77 @@ class TestPeerDiscovery(unittest.TestCase):
         listener_thread.join(timeout=5)
         broadcaster_thread.join(timeout=5)
 
+    def test_catalog_gossip(self):
+        """Peers should pull each other's file catalog after hearing a beacon."""
+        control_blk = ControlBlock()
+        control_blk.file_list = [os.path.join(os.path.dirname(__file__), "test.txt")]
+
+        listener_thread = threading.Thread(
+            target=listen_for_broadcast_and_handle_requests,
+            args=(
+                self.threading_event,
+                control_blk,
+            ),
+        )
+        listener_thread.daemon = True
+        listener_thread.start()
+        time.sleep(1)
+
+        broadcaster_thread = threading.Thread(
+            target=send_broadcast, args=(self.threading_event, control_blk)
+        )
+        broadcaster_thread.daemon = True
+        broadcaster_thread.start()
+        time.sleep(2)
+
+        self.assertGreater(len(control_blk.find_peers_with_file("test.txt")), 0)
+
+        self.threading_event.set()
+        listener_thread.join(timeout=10)
+        broadcaster_thread.join(timeout=10)
+
     def test_timeout_peer(self):
-        # TODO: Implement test_timeout_peer
-        return
+        """Peers that stop sending beacons should be expired from the peer list."""
+        control_blk = ControlBlock()
+        control_blk.peer_list = [("10.0.0.250", 50001)]
+        time.sleep(0.5)
+        control_blk.touch_peer(("10.0.0.251", 50001))
+
+        expired = control_blk.expire_peers(0.25)
+
+        self.assertEqual(expired, [("10.0.0.250", 50001)])
+        self.assertEqual(control_blk.peer_list, [("10.0.0.251", 50001)])
+
+    def test_malformed_catalogs_are_ignored(self):
+        """Bad catalog datagrams should be dropped without stopping discovery."""
+        control_blk = ControlBlock()
+        peer = ("10.0.0.252", 50001)
+        catalog_chunks = {}
+
+        def receive(seq: int, total: int, items: bytes, version: int = 7):
+            datagram = pack_catalog(version, -1, seq, total, items)
+            handle_datagram(control_blk, datagram, peer, False, None, catalog_chunks)
+
+        receive(5, 1, b"[]")
+        receive(0, 0, b"[]")
+        receive(0, 1, b"{}")
+        receive(0, 1, b"[5]")
+        receive(0, 1, b"[[[1], 2, null]]")
+        receive(0, 1, b'[["a.txt", true, null]]')
+        receive(0, 1, b"[")
+        self.assertEqual(control_blk.peer_to_file, {})
+        self.assertEqual(catalog_chunks, {})
+
+        # Incomplete catalogs are capped per peer, oldest dropped first.
+        for version in range(10):
+            receive(0, 2, b"[]", version)
+        self.assertEqual(len(catalog_chunks), MAX_PARTIAL_CATALOGS)
+        self.assertEqual(
+            min(key[1] for key in catalog_chunks), 10 - MAX_PARTIAL_CATALOGS
+        )
+
+        receive(0, 1, b'[["a.txt", 3, null]]')
+        self.assertEqual(control_blk.find_peers_with_file("a.txt"), [(peer, 3)])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,65 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.control_block import ControlBlock
+from src.common.manifest import hash_pieces
+from src.file_share.bulk_share import ShareJob, scan_files
+
+
+class TestBulkShare(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "shared")
+        self.paths = []
+        for i in range(30):
+            directory = os.path.join(self.root, f"dir{i % 3}", f"sub{i % 2}")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"file{i}.bin")
+            with open(path, "wb") as file:
+                file.write(os.urandom(1000 + i * 300))
+            self.paths.append(path)
+        # Links are not followed, so they can neither loop nor leave the tree.
+        os.symlink(self.root, os.path.join(self.root, "dir0", "loop"))
+        os.symlink(self.paths[0], os.path.join(self.root, "link.bin"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_files(self):
+        found = {path: stat.st_size for path, stat in scan_files(self.root)}
+        self.assertEqual(found, {path: os.path.getsize(path) for path in self.paths})
+
+    def test_share_directory(self):
+        control_blk = ControlBlock()
+        job = ShareJob(
+            control_blk,
+            self.root,
+            workers=2,
+            piece_size=1024,
+            cache_dir=os.path.join(self.tmp.name, "cache"),
+            batch_size=8,
+        )
+        job.start()
+        self.assertTrue(job.wait(60))
+
+        self.assertEqual((job.indexed, job.hashed, job.failed), (30, 30, 0))
+        self.assertIn("30/30 files hashed (done", job.get_progress())
+        self.assertEqual(sorted(control_blk.file_list), sorted(self.paths))
+        for path in self.paths:
+            name = os.path.basename(path)
+            self.assertEqual(control_blk.get_file_size(name), os.path.getsize(path))
+            manifest = control_blk.get_manifest(name, build=False)
+            self.assertIsNotNone(manifest)
+            self.assertEqual(manifest.piece_hashes, hash_pieces(path, 1024))
+
+
+if __name__ == "__main__":
+    unittest.main()
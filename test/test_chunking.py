@@ -0,0 +1,72 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.chunk_store import ChunkStore
+from src.common.chunking import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, chunk_file
+
+
+class TestChunking(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_file(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "wb") as file:
+            file.write(content)
+        return path
+
+    def test_chunks_survive_insertions(self):
+        content = os.urandom(8 * 1024 * 1024)
+        edited = content[:1000000] + b"x" * 777 + content[1000000:]
+        chunks = chunk_file(self.write_file("old.bin", content))
+        edited_chunks = chunk_file(self.write_file("new.bin", edited))
+
+        self.assertEqual(sum(length for length, _ in chunks), len(content))
+        for length, _ in chunks[:-1]:
+            self.assertTrue(MIN_CHUNK_SIZE <= length <= MAX_CHUNK_SIZE)
+        # Only the chunks around the insertion differ.
+        shared = set(chunks) & set(edited_chunks)
+        self.assertGreaterEqual(len(shared), len(chunks) - 3)
+
+    def test_runs_of_one_byte_are_cut_at_min_size(self):
+        chunks = chunk_file(self.write_file("zeros.bin", bytes(3 * MAX_CHUNK_SIZE)))
+        count = 3 * MAX_CHUNK_SIZE // MIN_CHUNK_SIZE
+        self.assertEqual(chunks, [chunks[0]] * count)
+        self.assertEqual(chunks[0][0], MIN_CHUNK_SIZE)
+
+    def test_store_drops_changed_files(self):
+        content = os.urandom(2 * 1024 * 1024)
+        path = self.write_file("shared.bin", content)
+        chunks = chunk_file(path)
+        store = ChunkStore(":memory:")
+        store.add_file(path, chunks)
+
+        length, chunk_hash = chunks[1]
+        self.assertEqual(
+            store.read_chunk(chunk_hash, length),
+            content[chunks[0][0] : chunks[0][0] + length],
+        )
+        self.assertIsNone(store.read_chunk("00" * 32, length))
+
+        # Overwritten in place: the recorded chunks no longer verify.
+        with open(path, "r+b") as file:
+            file.write(os.urandom(len(content)))
+        self.assertIsNone(store.read_chunk(chunk_hash, length))
+        self.write_file("shared.bin", content)
+        self.assertIsNone(store.read_chunk(chunk_hash, length))
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.compression import (
+    compress,
+    compress_range,
+    decompress_into,
+    is_compressible,
+)
+from src.common.protocol import COMPRESSION_NONE, COMPRESSION_ZLIB, COMPRESSION_LZMA
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, name: str, content: bytes) -> str:
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as file:
+            file.write(content)
+        return path
+
+    def test_round_trip_and_corruption(self):
+        data = b"timestamp,peer,bytes\n" * 5000
+        for codec in (COMPRESSION_ZLIB, COMPRESSION_LZMA):
+            payload = compress(codec, data)
+            self.assertLess(len(payload), len(data) // 3)
+
+            buffer = memoryview(bytearray(len(data)))
+            self.assertTrue(decompress_into(codec, payload, buffer))
+            self.assertEqual(bytes(buffer), data)
+
+            # Truncated, corrupted or wrongly sized payloads are rejected.
+            self.assertFalse(decompress_into(codec, payload[:-8], buffer))
+            self.assertFalse(decompress_into(codec, b"\x00" + payload[1:], buffer))
+            self.assertFalse(
+                decompress_into(codec, payload, memoryview(bytearray(len(data) - 1)))
+            )
+
+    def test_incompressible_content_is_sent_raw(self):
+        random_path = self.write_file("random.bin", os.urandom(256 * 1024))
+        text_path = self.write_file("text.csv", b"1,2,3,4,5\n" * 30000)
+        self.assertFalse(is_compressible(random_path))
+        self.assertTrue(is_compressible(text_path))
+
+        with open(random_path, "rb") as file:
+            codec, data, payload = compress_range(file, 1000, 5000, COMPRESSION_ZLIB)
+        self.assertEqual(codec, COMPRESSION_NONE)
+        self.assertIs(payload, data)
+        self.assertEqual(len(data), 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
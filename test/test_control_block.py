@@ -0,0 +1,131 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.control_block import ControlBlock
+from src.common.manifest import load_manifest
+from src.common.protocol import make_content_name
+
+TEST_FILE = os.path.join(os.path.dirname(__file__), "test.txt")
+
+
+class TestControlBlock(unittest.TestCase):
+
+    def test_file_index(self):
+        control_blk = ControlBlock()
+        control_blk.add_file(TEST_FILE)
+
+        self.assertTrue(control_blk.check_file_available("test.txt"))
+        self.assertEqual(control_blk.get_file_path("test.txt"), TEST_FILE)
+        self.assertEqual(
+            control_blk.get_file_size("test.txt"), os.path.getsize(TEST_FILE)
+        )
+        self.assertEqual(control_blk.file_list, [TEST_FILE])
+
+        self.assertTrue(control_blk.remove_file("test.txt"))
+        self.assertFalse(control_blk.check_file_available("test.txt"))
+        self.assertEqual(control_blk.get_file_path("test.txt"), "")
+        self.assertEqual(control_blk.get_file_size("test.txt"), 0)
+        self.assertFalse(control_blk.remove_file("test.txt"))
+
+    def test_catalog_delta(self):
+        server = ControlBlock()
+        client = ControlBlock()
+        peer = ("127.0.0.1", 50001)
+
+        # A peer we have never synced with gets a full snapshot
+        server.add_file(TEST_FILE)
+        version, full, items = server.get_catalog_changes(-1)
+        self.assertTrue(full)
+        self.assertTrue(client.update_peer_catalog(peer, version, items, None))
+        self.assertEqual(
+            client.find_peers_with_file("test.txt"),
+            [(peer, os.path.getsize(TEST_FILE))],
+        )
+
+        # Later changes are sent as a delta against the synced version
+        server.remove_file("test.txt")
+        server.add_file("/nonexistent/other.txt")
+        new_version, full, items = server.get_catalog_changes(version)
+        self.assertFalse(full)
+        self.assertEqual(len(items), 2)
+        self.assertTrue(client.update_peer_catalog(peer, new_version, items, version))
+        self.assertEqual(client.find_peers_with_file("test.txt"), [])
+        self.assertEqual(client.find_peers_with_file("other.txt"), [(peer, 0)])
+
+        # A delta against a version we do not hold is rejected
+        self.assertFalse(client.update_peer_catalog(peer, new_version, [], version))
+
+    def test_content_index(self):
+        control_blk = ControlBlock()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy = os.path.join(tmp_dir, "copy.txt")
+            with open(TEST_FILE, "rb") as src, open(copy, "wb") as dst:
+                dst.write(src.read())
+            manifest = load_manifest(TEST_FILE, 1024, tmp_dir)
+            control_blk.add_file(TEST_FILE, manifest)
+            control_blk.add_file(copy, load_manifest(copy, 1024, tmp_dir))
+
+            content_name = make_content_name(manifest.root_hash)
+            self.assertIsNotNone(control_blk.get_shared_file(content_name))
+            self.assertIsNone(control_blk.get_shared_file(make_content_name("0" * 64)))
+
+            # The content stays available while any file with it is shared
+            control_blk.remove_file("test.txt")
+            self.assertEqual(control_blk.get_file_path(content_name), copy)
+            control_blk.remove_file("copy.txt")
+            self.assertFalse(control_blk.check_file_available(content_name))
+
+        client = ControlBlock()
+        peer = ("127.0.0.1", 50001)
+        items = [["other_name.txt", manifest.size, manifest.root_hash]]
+        client.update_peer_catalog(peer, 1, items, None)
+        self.assertEqual(
+            client.find_peers_with_content(manifest.root_hash), [(peer, manifest.size)]
+        )
+
+    def test_peer_priority(self):
+        control_blk = ControlBlock()
+        slow, fast, unmeasured, dead = [("10.0.0.1", 50000 + i) for i in range(4)]
+        for peer in (slow, fast, unmeasured, dead):
+            control_blk.touch_peer(peer)
+
+        control_blk.record_peer_rtt(slow, 0.2)
+        control_blk.record_peer_rtt(fast, 0.01)
+        for _ in range(3):
+            control_blk.record_peer_failure(dead)
+
+        # Failing peers are dropped and the rest are ordered by RTT
+        self.assertEqual(control_blk.peer_list, [fast, slow, unmeasured])
+
+        # A reply from a failing peer makes it eligible again
+        control_blk.record_peer_rtt(dead, 0.05)
+        self.assertEqual(control_blk.peer_list, [fast, dead, slow, unmeasured])
+
+    def test_beacons_recover_failed_peers(self):
+        control_blk = ControlBlock()
+        peer = ("10.0.0.1", 50000)
+        control_blk.touch_peer(peer)
+        for _ in range(5):
+            control_blk.record_peer_failure(peer)
+        self.assertEqual(control_blk.peer_list, [])
+
+        # Still beaconing: it is retried after the next beacon.
+        control_blk.touch_peer(peer)
+        self.assertEqual(control_blk.peer_list, [peer])
+
+        # Failing again hides it again until the next beacon.
+        control_blk.record_peer_failure(peer)
+        self.assertEqual(control_blk.peer_list, [])
+        control_blk.touch_peer(peer)
+        self.assertEqual(control_blk.peer_list, [peer])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import hashlib
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.manifest import get_root_hash
+from src.file_share.download_state import DownloadState, get_state_path
+
+PIECE_SIZE = 1024
+
+
+class TestDownloadState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self.tmp_dir.name, "downloaded_file.bin")
+        self.content = os.urandom(PIECE_SIZE * 3 + 10)
+        self.piece_hashes = [
+            hashlib.sha256(self.content[i : i + PIECE_SIZE]).hexdigest()
+            for i in range(0, len(self.content), PIECE_SIZE)
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_state(self):
+        return DownloadState(
+            get_state_path(self.output_file),
+            "file.bin",
+            len(self.content),
+            PIECE_SIZE,
+            self.piece_hashes,
+            get_root_hash(self.piece_hashes),
+        )
+
+    def test_marks_survive_reload(self):
+        state = self.make_state()
+        state.save()
+        state.mark_piece(1)
+        state.mark_piece(3)
+        state.close()
+
+        loaded = DownloadState.load(state.path)
+        self.assertEqual(list(loaded.have), [0, 1, 0, 1])
+        self.assertTrue(loaded.matches(len(self.content), PIECE_SIZE, state.root_hash))
+        self.assertFalse(loaded.matches(len(self.content), PIECE_SIZE, "0" * 64))
+
+        state.remove()
+        self.assertFalse(os.path.exists(state.path))
+        self.assertIsNone(DownloadState.load(state.path))
+
+    def test_verify_pieces_drops_corrupt_ones(self):
+        # Piece 2 was marked but its bytes never made it to disk.
+        partial = bytearray(self.content)
+        partial[PIECE_SIZE * 2 : PIECE_SIZE * 3] = bytes(PIECE_SIZE)
+        with open(self.output_file, "wb") as file:
+            file.write(partial)
+
+        state = self.make_state()
+        for index in (0, 2, 3):
+            state.mark_piece(index)
+
+        self.assertEqual(state.verify_pieces(self.output_file), [0, 3])
+        self.assertEqual(list(state.have), [1, 0, 0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,6 +17,7 @@ from src.peer_discovery.discovery import (
     send_broadcast,
     listen_for_broadcast_and_handle_requests,
     search_for_file_within_peers,
+    group_file_sources,
 )
 
 MY_FILE_REQUEST_PORT = 50001 + (os.getpid() % 10)
@@ -106,6 +107,75 @@ class TestFileFind(unittest.TestCase):
         broadcaster_thread.join(timeout=5)
         listener_thread.join(timeout=5)
 
+    def test_search_skips_dead_peers(self):
+        """A search over live and dead peers should not wait a timeout per dead peer."""
+        client_control_block = ControlBlock()
+        client_control_block.peer_list = [("127.0.0.1", MY_FILE_REQUEST_PORT)] + [
+            ("127.0.0.1", 40000 + i) for i in range(5)
+        ]
+        server_control_block = ControlBlock()
+        test_file = os.path.join(os.path.dirname(__file__), "test.txt")
+        server_control_block.file_list = [test_file]
+        server_thread = threading.Thread(
+            target=self.server_thread_send_file, args=(server_control_block,)
+        )
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(1)
+
+        start = time.monotonic()
+        peers_with_file = search_for_file_within_peers(
+            client_control_block, "test.txt", timeout=5, max_results=1
+        )
+        elapsed = time.monotonic() - start
+
+        self.threading_event.set()
+        server_thread.join(timeout=10)
+
+        self.assertEqual(len(peers_with_file), 1)
+        self.assertEqual(peers_with_file[0][1], os.path.getsize(test_file))
+        self.assertLess(elapsed, 1)
+
+    def test_broadcast_search(self):
+        """A broadcast query should find holders that are not in the peer list."""
+        client_control_block = ControlBlock()
+        server_control_block = ControlBlock()
+        test_file = os.path.join(os.path.dirname(__file__), "test.txt")
+        server_control_block.file_list = [test_file]
+        server_thread = threading.Thread(
+            target=self.server_thread_send_file, args=(server_control_block,)
+        )
+        server_thread.daemon = True
+        server_thread.start()
+        time.sleep(1)
+
+        peers_with_file = search_for_file_within_peers(
+            client_control_block, "test.txt", broadcast=True
+        )
+
+        self.threading_event.set()
+        server_thread.join(timeout=10)
+
+        self.assertEqual(len(peers_with_file), 1)
+        self.assertEqual(peers_with_file[0][0][1], MY_FILE_REQUEST_PORT)
+        self.assertIn(peers_with_file[0][0], client_control_block.peer_list)
+
+    def test_group_file_sources(self):
+        """Same-named files with different contents should never be mixed."""
+        a, b, c, d = [("10.0.0.1", 50000 + i) for i in range(4)]
+        results = [
+            (a, 100, "aa" * 32),
+            (b, 100, "bb" * 32),
+            (c, 100, "aa" * 32),
+            (d, 100, None),
+        ]
+        sources = group_file_sources(results)
+        self.assertEqual(
+            [(s.root_hash, s.size, s.holders) for s in sources],
+            [("aa" * 32, 100, [a, c]), ("bb" * 32, 100, [b]), (None, 100, [d])],
+        )
+        self.assertEqual(sources[0].peers, [(a, 100), (c, 100)])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import logging
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.debug_print import (
+    configure_log_levels,
+    flush_logs,
+    get_logger,
+    regular_print,
+    set_log_level,
+)
+
+
+class CountingStr:
+    """Counts how often it is formatted into a message."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self):
+        self.calls += 1
+        return "value"
+
+
+class TestLogging(unittest.TestCase):
+
+    def tearDown(self):
+        for subsystem in ("transfer", "discovery"):
+            set_log_level(logging.NOTSET, subsystem)
+        set_log_level("info")
+
+    def test_disabled_messages_are_not_formatted(self):
+        argument = CountingStr()
+        get_logger("transfer").debug("piece %s", argument)
+        flush_logs()
+        self.assertEqual(argument.calls, 0)
+
+        set_log_level("debug", "transfer")
+        with self.assertLogs("lanp2p.transfer", logging.DEBUG) as logs:
+            get_logger("transfer").debug("piece %s", argument)
+        self.assertEqual(logs.output, ["DEBUG:lanp2p.transfer:piece value"])
+
+    def test_per_subsystem_levels(self):
+        configure_log_levels("warning,discovery=debug")
+        self.assertTrue(get_logger("discovery").isEnabledFor(logging.DEBUG))
+        self.assertFalse(get_logger("transfer").isEnabledFor(logging.INFO))
+        self.assertTrue(get_logger("transfer").isEnabledFor(logging.WARNING))
+
+        with self.assertRaises(ValueError):
+            configure_log_levels("nosuchsubsystem=debug")
+        with self.assertRaises(ValueError):
+            configure_log_levels("transfer=loud")
+
+    def test_regular_print_joins_arguments(self):
+        with self.assertLogs("lanp2p.cli", logging.INFO) as logs:
+            regular_print("Serving", 3, "files")
+        self.assertEqual(logs.output, ["INFO:lanp2p.cli:Serving 3 files"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import tempfile
+import hashlib
+import time
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.control_block import ControlBlock
+from src.common.manifest import load_manifest, get_root_hash
+
+PIECE_SIZE = 1024
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.file_path = os.path.join(self.tmp_dir.name, "shared.bin")
+        self.content = os.urandom(PIECE_SIZE * 3 + 100)
+        with open(self.file_path, "wb") as file:
+            file.write(self.content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_piece_hashes(self):
+        manifest = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+
+        expected = [
+            hashlib.sha256(self.content[i : i + PIECE_SIZE]).hexdigest()
+            for i in range(0, len(self.content), PIECE_SIZE)
+        ]
+        self.assertEqual(manifest.piece_hashes, expected)
+        self.assertEqual(manifest.root_hash, get_root_hash(expected))
+        self.assertEqual(
+            manifest.get_piece_range(3), (PIECE_SIZE * 3, len(self.content))
+        )
+
+    def test_hash_for_range(self):
+        manifest = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+
+        self.assertEqual(
+            manifest.get_hash_for_range(PIECE_SIZE, PIECE_SIZE * 2),
+            manifest.piece_hashes[1],
+        )
+        self.assertEqual(
+            manifest.get_hash_for_range(PIECE_SIZE * 3, len(self.content)),
+            manifest.piece_hashes[3],
+        )
+        self.assertIsNone(manifest.get_hash_for_range(0, PIECE_SIZE * 2))
+        self.assertIsNone(manifest.get_hash_for_range(1, PIECE_SIZE + 1))
+
+    def test_cache_reused_until_file_changes(self):
+        manifest = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        cached = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+        self.assertEqual(cached.piece_hashes, manifest.piece_hashes)
+        self.assertTrue(cached.is_current())
+
+        with open(self.file_path, "ab") as file:
+            file.write(b"more data")
+        self.assertFalse(cached.is_current())
+
+        rebuilt = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+        self.assertNotEqual(rebuilt.root_hash, manifest.root_hash)
+        self.assertEqual(rebuilt.size, len(self.content) + len(b"more data"))
+
+    def test_empty_file(self):
+        empty_path = os.path.join(self.tmp_dir.name, "empty.bin")
+        open(empty_path, "wb").close()
+
+        manifest = load_manifest(empty_path, PIECE_SIZE, self.cache_dir)
+        self.assertEqual(manifest.piece_hashes, [])
+        self.assertEqual(manifest.root_hash, hashlib.sha256().hexdigest())
+
+    def test_changed_files_are_rehashed_in_background(self):
+        control_blk = ControlBlock(cache_dir=self.cache_dir)
+        old = load_manifest(self.file_path, PIECE_SIZE, self.cache_dir)
+        control_blk.add_file(self.file_path, old)
+        self.assertIs(control_blk.get_manifest("shared.bin"), old)
+
+        with open(self.file_path, "ab") as file:
+            file.write(b"more data")
+
+        # Served unhashed straight away, then rehashed off the serving path.
+        self.assertIsNone(control_blk.get_manifest("shared.bin"))
+        deadline = time.monotonic() + 5
+        while control_blk.get_manifest("shared.bin") is None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        manifest = control_blk.get_manifest("shared.bin")
+        self.assertNotEqual(manifest.root_hash, old.root_hash)
+        self.assertEqual(manifest.size, len(self.content) + len(b"more data"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import urllib.request
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.metrics import (
+    Counter,
+    Histogram,
+    REGISTRY,
+    format_stats,
+    render_prometheus,
+    start_metrics_server,
+)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = Counter("test_bytes_total", "Bytes.", ("peer",))
+        self.histogram = Histogram("test_latency_seconds", "Latency.", buckets=[0.1, 1])
+
+    def tearDown(self):
+        REGISTRY.remove(self.counter)
+        REGISTRY.remove(self.histogram)
+
+    def test_counter_and_histogram_rendering(self):
+        self.counter.inc(100, ("10.0.0.1",))
+        self.counter.inc(50, ("10.0.0.1",))
+        self.counter.inc(7, ('a"b',))
+        for value in (0.05, 0.5, 0.7, 3):
+            self.histogram.observe(value)
+
+        self.assertEqual(self.counter.get(("10.0.0.1",)), 150)
+        self.assertEqual(self.histogram.get_count(), 4)
+        self.assertEqual(self.histogram.get_quantile(0.5), 1)
+        self.assertEqual(self.histogram.get_quantile(0.99), float("inf"))
+
+        text = render_prometheus()
+        self.assertIn("# TYPE test_bytes_total counter", text)
+        self.assertIn('test_bytes_total{peer="10.0.0.1"} 150', text)
+        self.assertIn('test_bytes_total{peer="a\\"b"} 7', text)
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_latency_seconds_bucket{le="1"} 3', text)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("test_latency_seconds_count 4", text)
+        self.assertIn("test_latency_seconds: count=4 p50<=1000ms", format_stats())
+
+    def test_http_endpoint(self):
+        self.counter.inc(1, ("10.0.0.2",))
+        server = start_metrics_server(0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(response.status, 200)
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('test_bytes_total{peer="10.0.0.2"} 1', body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import tempfile
+import hashlib
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.protocol import COMPRESSION_NONE, COMPRESSION_ZLIB
+from src.file_share import piece_cache
+from src.file_share.piece_cache import PieceCache, read_range
+
+
+class TestPieceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "popular.log")
+        self.content = b"".join(f"line {i}\n".encode() for i in range(50000))
+        with open(self.path, "wb") as file:
+            file.write(self.content)
+        self.cache = PieceCache(1024 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def lookups(self) -> tuple:
+        counter = piece_cache.PIECE_CACHE_LOOKUPS
+        return counter.get(("hit",)), counter.get(("miss",))
+
+    def read(self, start: int, count: int, codec: int, segment_hash=None):
+        with open(self.path, "rb") as file:
+            return read_range(
+                self.cache, self.path, file, start, count, codec, segment_hash
+            )
+
+    def test_popular_ranges_are_read_once(self):
+        hits, misses = self.lookups()
+        first = self.read(0, 65536, COMPRESSION_ZLIB)
+        self.assertEqual(first[0], COMPRESSION_ZLIB)
+        self.assertEqual(first[2], hashlib.sha256(self.content[:65536]).digest())
+        for _ in range(3):
+            self.assertIs(self.read(0, 65536, COMPRESSION_ZLIB), first)
+        self.assertEqual(self.lookups(), (hits + 3, misses + 1))
+
+        # Unhashed ranges are cached too; hashed pieces stream from the file.
+        data = self.read(65536, 1000, COMPRESSION_NONE)
+        self.assertEqual(data[1], self.content[65536:66536])
+        self.assertIs(self.read(65536, 1000, COMPRESSION_NONE), data)
+        self.assertIsNone(self.read(0, 65536, COMPRESSION_NONE, "00" * 32))
+
+    def test_changed_files_are_not_served_from_cache(self):
+        self.read(0, 65536, COMPRESSION_ZLIB)
+        self.read(65536, 65536, COMPRESSION_ZLIB)
+        self.assertEqual(len(self.cache), 2)
+
+        with open(self.path, "r+b") as file:
+            file.write(b"LINE")
+        os.utime(self.path, ns=(0, 0))
+        entry = self.read(0, 65536, COMPRESSION_ZLIB)
+        self.assertEqual(
+            entry[2], hashlib.sha256(b"LINE" + self.content[4:65536]).digest()
+        )
+        self.assertEqual(len(self.cache), 1)  # The old revision's ranges are gone
+
+    def test_least_recently_used_ranges_are_evicted(self):
+        self.cache.resize(800)  # Room for 8 entries of the largest size, 100
+        for name in "abcdefghi":
+            self.cache.put((name, 1, 1, 0, 100, 0), (0, bytes(100), b""))
+            self.cache.get(("a", 1, 1, 0, 100, 0))
+        self.assertIsNotNone(self.cache.get(("a", 1, 1, 0, 100, 0)))
+        self.assertIsNone(self.cache.get(("b", 1, 1, 0, 100, 0)))
+        self.assertEqual((len(self.cache), self.cache.size), (8, 800))
+
+        self.cache.put(("big", 1, 1, 0, 101, 0), (0, bytes(101), b""))
+        self.assertIsNone(self.cache.get(("big", 1, 1, 0, 101, 0)))
+        self.cache.resize(0)
+        self.assertEqual((len(self.cache), self.cache.size), (0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import threading
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.file_share.piece_scheduler import PieceScheduler
+
+
+class TestPieceScheduler(unittest.TestCase):
+
+    def test_pieces_cover_file(self):
+        scheduler = PieceScheduler(2500, 1000)
+
+        self.assertEqual(scheduler.piece_count, 3)
+        self.assertEqual(
+            [scheduler.get_piece_range(i) for i in range(3)],
+            [(0, 1000), (1000, 2000), (2000, 2500)],
+        )
+
+    def test_failed_piece_is_reassigned_first(self):
+        scheduler = PieceScheduler(3000, 1000)
+
+        first = scheduler.next_piece()
+        scheduler.fail_piece(first)
+
+        self.assertEqual(scheduler.next_piece(), first)
+
+    def test_end_game_duplicates_in_flight_piece(self):
+        scheduler = PieceScheduler(2000, 1000)
+        slow_piece = scheduler.next_piece()
+        fast_piece = scheduler.next_piece()
+        self.assertTrue(scheduler.complete_piece(fast_piece))
+
+        # Queue is empty, so an idle worker helps with the slow piece
+        duplicate = scheduler.next_piece()
+        self.assertEqual(duplicate, slow_piece)
+
+        self.assertTrue(scheduler.complete_piece(duplicate))
+        self.assertFalse(scheduler.complete_piece(slow_piece))
+        self.assertTrue(scheduler.is_complete())
+        self.assertIsNone(scheduler.next_piece())
+
+    def test_end_game_waits_for_in_flight_pieces(self):
+        scheduler = PieceScheduler(1000, 1000)
+        piece = scheduler.next_piece()
+        self.assertEqual(scheduler.next_piece(), piece)  # Duplicate
+
+        # Both workers hold the piece, so a third must wait for the outcome
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(scheduler.next_piece()))
+        waiter.start()
+        waiter.join(timeout=0.2)
+        self.assertTrue(waiter.is_alive())
+
+        scheduler.fail_piece(piece)
+        waiter.join(timeout=5)
+        self.assertEqual(result, [piece])
+
+
+if __name__ == "__main__":
+    unittest.main()
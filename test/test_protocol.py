@@ -0,0 +1,78 @@
+import unittest
+import hashlib
+import io
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.protocol import (
+    HEADER_SIZE,
+    MSG_FILE_AVAILABLE,
+    MSG_RANGE_REQUEST,
+    ProtocolError,
+    parse_datagram,
+    pack_file_available,
+    unpack_file_available,
+    pack_catalog_request,
+    unpack_catalog_request,
+    pack_range_request,
+    unpack_range_request,
+    read_message,
+)
+
+
+class TestProtocol(unittest.TestCase):
+
+    def test_range_request_round_trip(self):
+        # Offsets beyond 32 bits must survive the trip.
+        start, end = 5 * 2**32, 5 * 2**32 + 1024
+        message = pack_range_request(7, "report:final.pdf", start, end)
+
+        msg_type, _, request_id, payload = read_message(
+            io.BytesIO(message), max_payload=4096
+        )
+        self.assertEqual((msg_type, request_id), (MSG_RANGE_REQUEST, 7))
+        self.assertEqual(
+            unpack_range_request(payload), (start, end, "report:final.pdf")
+        )
+
+    def test_file_available_carries_root_hash(self):
+        root_hash = hashlib.sha256(b"pieces").hexdigest()
+
+        msg_type, _, request_id, payload = parse_datagram(
+            pack_file_available(42, 3 * 2**33, root_hash)
+        )
+        self.assertEqual((msg_type, request_id), (MSG_FILE_AVAILABLE, 42))
+        self.assertEqual(unpack_file_available(payload), (3 * 2**33, root_hash))
+
+        _, _, _, payload = parse_datagram(pack_file_available(42, 10))
+        self.assertEqual(unpack_file_available(payload), (10, None))
+
+    def test_catalog_request_round_trip(self):
+        _, _, _, payload = parse_datagram(pack_catalog_request(-1))
+        self.assertEqual(unpack_catalog_request(payload), (-1, []))
+
+        _, _, _, payload = parse_datagram(pack_catalog_request(123, [0, 4, 9]))
+        self.assertEqual(unpack_catalog_request(payload), (123, [0, 4, 9]))
+
+    def test_malformed_messages_rejected(self):
+        message = pack_range_request(1, "file.txt", 0, 10)
+
+        with self.assertRaises(ProtocolError):
+            parse_datagram(message[: HEADER_SIZE - 1])
+        with self.assertRaises(ProtocolError):
+            parse_datagram(message[:-1])  # Shorter than the header says
+        with self.assertRaises(ProtocolError):
+            parse_datagram(b"\x02" + message[1:])  # Unknown protocol version
+        with self.assertRaises(ProtocolError):
+            read_message(io.BytesIO(message), max_payload=8)
+        with self.assertRaises(ProtocolError):
+            unpack_range_request(b"\x00" * 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
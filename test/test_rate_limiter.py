@@ -0,0 +1,92 @@
+import unittest
+import threading
+import tempfile
+import socket
+import time
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.file_share.rate_limiter import UploadLimiter, parse_rate
+from src.file_share.send_recv_tcp import send_file_range
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_global_and_per_peer_budgets(self):
+        quantum = 64 * 1024
+        limiter = UploadLimiter(peer_rate=1024 * 1024, quantum=quantum)
+
+        # The first quarter second's worth is a burst; after that each quantum
+        # has to wait for the bucket to refill.
+        delays = [limiter.reserve("10.0.0.1", quantum) for _ in range(6)]
+        self.assertEqual(delays[:4], [0, 0, 0, 0])
+        self.assertAlmostEqual(delays[4], 1 / 16, delta=0.01)
+        self.assertAlmostEqual(delays[5], 2 / 16, delta=0.01)
+        self.assertEqual(limiter.reserve("10.0.0.2", quantum), 0)
+
+        limiter.set_limits(1024 * 1024, None)
+        for peer in ("10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4"):
+            self.assertEqual(limiter.reserve(peer, quantum), 0)
+        self.assertAlmostEqual(limiter.reserve("10.0.0.5", quantum), 1 / 16, delta=0.01)
+
+        limiter.set_limits(0, None)
+        self.assertFalse(limiter.is_limited)
+        self.assertEqual(parse_rate("1.5M"), 1536 * 1024)
+        with self.assertRaises(ValueError):
+            parse_rate("fast")
+
+    def test_concurrent_ranges_share_the_limit(self):
+        """Two ranges sent at once should progress together, not one after the other."""
+        size = 512 * 1024
+        limiter = UploadLimiter(
+            global_rate=1024 * 1024, quantum=32 * 1024, burst_seconds=0
+        )
+        finished = {}
+        ready = threading.Barrier(2)
+
+        def send(name, file_path):
+            sender, receiver = socket.socketpair()
+            received = 0
+            buffer = bytearray(size)
+
+            def receive():
+                nonlocal received
+                while received < size:
+                    received += receiver.recv_into(memoryview(buffer)[received:])
+
+            receiving = threading.Thread(target=receive)
+            receiving.start()
+            ready.wait()
+            with open(file_path, "rb") as file:
+                send_file_range(sender, file, 0, size, limiter=limiter, peer_ip=name)
+            receiving.join()
+            finished[name] = time.monotonic() - started
+            sender.close()
+            receiver.close()
+
+        with tempfile.NamedTemporaryFile() as shared:
+            shared.write(os.urandom(size))
+            shared.flush()
+            started = time.monotonic()
+            senders = [
+                threading.Thread(target=send, args=(name, shared.name))
+                for name in ("a", "b")
+            ]
+            for thread in senders:
+                thread.start()
+            for thread in senders:
+                thread.join()
+
+        # 1 MiB at 1 MiB/s takes about a second in total. Sent one after the
+        # other, the first range would finish in half that.
+        self.assertGreater(min(finished.values()), 0.8)
+        self.assertLess(abs(finished["a"] - finished["b"]), 0.15)
+
+
+if __name__ == "__main__":
+    unittest.main()
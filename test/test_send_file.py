@@ -5,22 +5,35 @@ import socket
 import sys
 import os
 import hashlib
+import tempfile
 
 # Add the src directory to the Python module search path
 sys.path.insert(
     0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
 )
 
+from src.common.chunk_store import ChunkStore
+from src.common.chunking import chunk_file
 from src.common.control_block import ControlBlock
+from src.common.manifest import load_manifest
 from src.common.debug_print import debug_print, regular_print
+from src.common.protocol import COMPRESSION_ZLIB, COMPRESSION_LZMA
 from src.peer_discovery.discovery import (
     send_broadcast,
     listen_for_broadcast_and_handle_requests,
     search_for_file_within_peers,
 )
-from src.file_share.send_recv_tcp import start_file_server, receive_file_from_peer
+from src.file_share.connection_pool import ConnectionPool
+from src.file_share.download_state import DownloadState, get_state_path
+from src.file_share import send_recv_tcp
+from src.file_share.send_recv_tcp import (
+    start_file_server,
+    receive_file_from_peer,
+    receive_file_from_peers,
+)
 
 MY_FILE_REQUEST_PORT = 50001 + (os.getpid() % 10)
+PIECE_SIZE = 64 * 1024  # Piece size of the files served in download tests
 
 
 class TestSendFile(unittest.TestCase):
@@ -44,7 +57,7 @@ class TestSendFile(unittest.TestCase):
         self.threading_event.clear()  # Ensure the event is cleared before each test
 
     def server_thread_server_for_send_file(self, control_blk: ControlBlock):
-        start_file_server(control_blk)
+        start_file_server(control_blk, self.threading_event)
 
     def client_thread_recv_file(self, addr: tuple, filename: str):
         receive_file_from_peer(addr, filename)
@@ -82,6 +95,236 @@ class TestSendFile(unittest.TestCase):
         server_thread.join(timeout=5)
         client_thread.join(timeout=5)
 
+    def _serve_file(self, content: bytes, name: str, hashed: bool = True) -> tuple:
+        """
+        Share `content` as `name` from a file server on MY_FILE_REQUEST_PORT.
+
+        Returns (path of the shared file, its manifest, or None unless
+        `hashed`, and a ConnectionPool for the client). The server, pool and
+        file are cleaned up after the test.
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        file_path = os.path.join(tmp_dir.name, name)
+        with open(file_path, "wb") as file:
+            file.write(content)
+
+        server_control_block = ControlBlock()
+        manifest = None
+        if hashed:
+            manifest = load_manifest(file_path, PIECE_SIZE, tmp_dir.name)
+            server_control_block.add_file(file_path, manifest)
+        else:
+            server_control_block.file_list = [file_path]
+        server_thread = threading.Thread(
+            target=self.server_thread_server_for_send_file, args=(server_control_block,)
+        )
+        server_thread.daemon = True
+        server_thread.start()
+        self.addCleanup(server_thread.join, 5)
+        self.addCleanup(self.threading_event.set)
+        time.sleep(1)
+
+        pool = ConnectionPool()
+        self.addCleanup(pool.close_all)
+        return file_path, manifest, pool
+
+    def _remove_download(self, output_file: str) -> None:
+        """Delete `output_file` and what a download leaves next to it after the test."""
+
+        def remove():
+            for path in (
+                output_file,
+                output_file + ".previous",
+                get_state_path(output_file),
+            ):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self.addCleanup(remove)
+
+    def test_receive_file_from_peers(self):
+        """A multi-piece download should complete even if one peer is dead."""
+        content = os.urandom(PIECE_SIZE * 3 + 123)
+        _, _, pool = self._serve_file(content, "multi_piece.bin", hashed=False)
+        self._remove_download("downloaded_multi_piece.bin")
+
+        live_peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        dead_peer = ("127.0.0.1", 40000)
+        success = receive_file_from_peers(
+            [(live_peer, len(content)), (dead_peer, len(content))],
+            "multi_piece.bin",
+            piece_size=PIECE_SIZE,
+            pool=pool,
+        )
+        self.assertTrue(success)
+        with open("downloaded_multi_piece.bin", "rb") as file:
+            self.assertEqual(file.read(), content)
+
+    def test_resume_download(self):
+        """An interrupted download should only fetch the pieces it is missing."""
+        content = os.urandom(PIECE_SIZE * 4 + 321)
+        _, manifest, pool = self._serve_file(content, "resumable.bin")
+        output_file = "downloaded_resumable.bin"
+        self._remove_download(output_file)
+
+        # Leave behind what an interrupted download would: pieces 0 and 1 on
+        # disk, and piece 2 marked as written but corrupt.
+        partial = bytearray(len(content))
+        partial[: PIECE_SIZE * 2] = content[: PIECE_SIZE * 2]
+        with open(output_file, "wb") as file:
+            file.write(partial)
+        state = DownloadState(
+            get_state_path(output_file),
+            "resumable.bin",
+            len(content),
+            PIECE_SIZE,
+            manifest.piece_hashes,
+            manifest.root_hash,
+        )
+        state.save()
+        for index in (0, 1, 2):
+            state.mark_piece(index)
+        state.close()
+
+        peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],))
+        success = receive_file_from_peers(
+            [(peer, len(content))], "resumable.bin", pool=pool, resume=True
+        )
+        self.assertTrue(success)
+        with open(output_file, "rb") as file:
+            self.assertEqual(file.read(), content)
+        self.assertFalse(os.path.exists(get_state_path(output_file)))
+        # Pieces 0 and 1 were kept; the corrupt piece 2 was fetched again.
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],)) - received
+        self.assertEqual(received, len(content) - 2 * PIECE_SIZE)
+
+    def test_compressed_download(self):
+        """Pieces requested compressed should arrive intact with either codec."""
+        lines = [f"{i} GET /files/{i % 97} 200 {i * 31 % 4096}\n" for i in range(20000)]
+        content = "".join(lines).encode()
+        _, _, pool = self._serve_file(content, "server.log", hashed=False)
+        self._remove_download("downloaded_server.log")
+
+        peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        for codec in (COMPRESSION_ZLIB, COMPRESSION_LZMA):
+            success = receive_file_from_peers(
+                [(peer, len(content))],
+                "server.log",
+                piece_size=PIECE_SIZE,
+                pool=pool,
+                compression=codec,
+            )
+            self.assertTrue(success)
+            with open("downloaded_server.log", "rb") as file:
+                self.assertEqual(file.read(), content)
+
+    def test_download_by_content(self):
+        """A download by root hash should get that content whatever the holder calls it."""
+        content = os.urandom(PIECE_SIZE * 2 + 99)
+        _, manifest, pool = self._serve_file(content, "renamed.bin")
+        output_file = "downloaded_report.bin"
+        self._remove_download(output_file)
+
+        peers = [(("127.0.0.1", MY_FILE_REQUEST_PORT), len(content))]
+        # Same size, but not the content asked for
+        self.assertFalse(
+            receive_file_from_peers(peers, "report.bin", pool=pool, root_hash="ab" * 32)
+        )
+        success = receive_file_from_peers(
+            peers, "report.bin", pool=pool, root_hash=manifest.root_hash
+        )
+        self.assertTrue(success)
+        with open(output_file, "rb") as file:
+            self.assertEqual(file.read(), content)
+
+    def test_download_reuses_local_chunks(self):
+        """A new revision of an earlier download should only fetch what changed."""
+        old_content = os.urandom(6 * 1024 * 1024)
+        new_content = (
+            old_content[: 3 * 1024 * 1024]
+            + b"inserted" * 100
+            + old_content[3 * 1024 * 1024 :]
+        )
+        _, _, pool = self._serve_file(new_content, "disk.img")
+        output_file = "downloaded_disk.img"
+        self._remove_download(output_file)
+
+        # The old revision was downloaded to the same output file before.
+        with open(output_file, "wb") as file:
+            file.write(old_content)
+        chunk_store = ChunkStore(":memory:")
+        self.addCleanup(chunk_store.close)
+        chunk_store.add_file(os.path.abspath(output_file), chunk_file(output_file))
+
+        peer = ("127.0.0.1", MY_FILE_REQUEST_PORT)
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],))
+        success = receive_file_from_peers(
+            [(peer, len(new_content))], "disk.img", pool=pool, chunk_store=chunk_store
+        )
+        self.assertTrue(success)
+        with open(output_file, "rb") as file:
+            self.assertEqual(file.read(), new_content)
+        received = send_recv_tcp.BYTES_RECEIVED.get((peer[0],)) - received
+        self.assertLess(received, len(new_content) // 4)
+        self.assertFalse(os.path.exists(output_file + ".previous"))
+
+        # The new revision's chunks are now readable from the download.
+        length, chunk_hash = chunk_file(output_file)[-1]
+        self.assertEqual(
+            chunk_store.read_chunk(chunk_hash, length), new_content[-length:]
+        )
+
+    def test_failed_download_keeps_earlier_download(self):
+        """An earlier download should survive until a new one completes."""
+        old_content = os.urandom(5 * 1024 * 1024)
+        new_content = old_content + os.urandom(1024 * 1024)
+        file_path, _, pool = self._serve_file(new_content, "backup.tar")
+        output_file = "downloaded_backup.tar"
+        previous = output_file + ".previous"
+        self._remove_download(output_file)
+
+        # Corrupt the file behind the manifest's back, so every piece fetched
+        # from the peer fails verification.
+        mtime_ns = os.stat(file_path).st_mtime_ns
+        with open(file_path, "wb") as file:
+            file.write(os.urandom(len(new_content)))
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+        with open(output_file, "wb") as file:
+            file.write(old_content)
+        chunk_store = ChunkStore(":memory:")
+        self.addCleanup(chunk_store.close)
+        chunk_store.add_file(os.path.abspath(output_file), chunk_file(output_file))
+
+        peers = [(("127.0.0.1", MY_FILE_REQUEST_PORT), len(new_content))]
+        self.assertFalse(
+            receive_file_from_peers(
+                peers, "backup.tar", pool=pool, chunk_store=chunk_store
+            )
+        )
+        with open(previous, "rb") as file:
+            self.assertEqual(file.read(), old_content)
+        length, chunk_hash = chunk_file(previous)[0]
+        self.assertEqual(
+            chunk_store.read_chunk(chunk_hash, length), old_content[:length]
+        )
+
+        # Once the peer serves the right data, the retry completes and only
+        # then drops the earlier download.
+        with open(file_path, "wb") as file:
+            file.write(new_content)
+        os.utime(file_path, ns=(mtime_ns, mtime_ns))
+        self.assertTrue(
+            receive_file_from_peers(
+                peers, "backup.tar", pool=pool, chunk_store=chunk_store
+            )
+        )
+        with open(output_file, "rb") as file:
+            self.assertEqual(file.read(), new_content)
+        self.assertFalse(os.path.exists(previous))
+
 
 if __name__ == "__main__":
     unittest.main()
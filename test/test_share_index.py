@@ -0,0 +1,71 @@
+import unittest
+import tempfile
+import sys
+import os
+
+# Add the src directory to the Python module search path
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+)
+
+from src.common.control_block import ControlBlock
+from src.common.manifest import load_manifest
+from src.common.share_index import ShareIndex
+
+
+class TestShareIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.tmp.name, "shares.db")
+        self.cache_dir = os.path.join(self.tmp.name, "cache")
+        self.paths = []
+        for name in ("kept.bin", "changed.bin", "deleted.bin", "unhashed.bin"):
+            path = os.path.join(self.tmp.name, name)
+            with open(path, "wb") as file:
+                file.write(os.urandom(5000))
+            self.paths.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_restart_revalidates_only_changed_files(self):
+        kept, changed, deleted, unhashed = self.paths
+        control_blk = ControlBlock(ShareIndex(self.index_path))
+        for path in (kept, changed, deleted):
+            control_blk.add_file(path, load_manifest(path, 1024, self.cache_dir))
+        control_blk.add_files([(unhashed, os.stat(unhashed))])
+        root_hash = control_blk.get_shared_file("kept.bin").root_hash
+        control_blk.share_index.close()
+
+        with open(changed, "ab") as file:
+            file.write(b"more")
+        os.remove(deleted)
+
+        restarted = ControlBlock(ShareIndex(self.index_path))
+        self.assertEqual(sorted(restarted.file_list), sorted(self.paths))
+        entry = restarted.get_shared_file("kept.bin")
+        self.assertEqual(entry.root_hash, root_hash)
+        self.assertIsNone(entry.manifest)  # Piece hashes are read lazily
+
+        self.assertEqual(sorted(restarted.revalidate_files()), [changed, unhashed])
+        self.assertFalse(restarted.check_file_available("deleted.bin"))
+        self.assertEqual(restarted.get_file_size("changed.bin"), 5004)
+        self.assertIsNone(restarted.get_shared_file("changed.bin").root_hash)
+
+        manifest = restarted.get_manifest("kept.bin")
+        self.assertEqual(
+            manifest.piece_hashes,
+            load_manifest(kept, 1024, self.cache_dir).piece_hashes,
+        )
+        self.assertEqual(manifest.piece_size, 1024)
+
+        # Removals are persisted as well
+        restarted.remove_file("kept.bin")
+        restarted.share_index.close()
+        reloaded = ControlBlock(ShareIndex(self.index_path))
+        self.assertEqual(sorted(reloaded.file_list), sorted([changed, unhashed]))
+
+
+if __name__ == "__main__":
+    unittest.main()